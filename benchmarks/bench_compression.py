@@ -0,0 +1,68 @@
+# Benchmark: on-the-wire compression of .dat files.
+# For each codec and level, reports the compression ratio, the compression throughput (CPU cost) and the
+# effective transfer time (compression + sending) compared to sending the raw file, at several uplink speeds.
+# Run from the repository root: python benchmarks/bench_compression.py [--file data/output/123_out.dat]
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src import compression, local_generation
+
+
+def sample_files(tmp: Path):
+    """Typical files: a random starting vector and a Haar random channel"""
+    files = []
+    if local_generation.numpy_available():
+        for n in (256, 4096):
+            path = tmp / f"vector_{n}.dat"
+            local_generation.generate_vector_file(n * n, path)
+            files.append(path)
+        path = tmp / "kraus_64x4.dat"
+        local_generation.generate_kraus_file(64, 4, path)
+        files.append(path)
+    return files
+
+
+def compress_file(path: Path, encoding: str, level: int, piece_size: int = 1024 * 1024):
+    compressor = compression.Compressor(encoding, level)
+    size = 0
+    start = time.perf_counter()
+    with open(path, "rb") as file:
+        for piece in iter(lambda: file.read(piece_size), b""):
+            size += len(compressor.compress(piece))
+    size += len(compressor.flush())
+    return size, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", nargs="*", default=[], help=".dat files to use (default: generated samples)")
+    parser.add_argument("--uplinks", type=float, nargs="+", default=[5, 20, 100], help="uplink speeds in Mbit/s")
+    args = parser.parse_args()
+
+    levels = {"gzip": [1, 6], "zstd": [1, 3, 9]}
+    with tempfile.TemporaryDirectory() as tmp:
+        files = [Path(f) for f in args.file] or sample_files(Path(tmp))
+        if not files:
+            print("No files given and NumPy is not installed to generate samples")
+            return
+        header = f"{'file':<20}{'codec':<10}{'ratio':>8}{'saved':>10}{'MB/s':>9}" + "".join(f"{f'{u:g}Mbit [s]':>16}" for u in args.uplinks)
+        print(header)
+        for path in files:
+            raw = path.stat().st_size
+            print(f"{path.name:<20}{'raw':<10}{1.0:>8.2f}{0:>10}{'-':>9}" + "".join(f"{raw * 8 / (u * 1e6):>16.2f}" for u in args.uplinks))
+            for encoding in compression.available_encodings():
+                for level in levels[encoding]:
+                    size, seconds = compress_file(path, encoding, level)
+                    throughput = raw / seconds / 1e6 if seconds > 0 else float("inf")
+                    # Compression and sending overlap when streaming, so the slower of the two dominates
+                    times = "".join(f"{max(seconds, size * 8 / (u * 1e6)):>16.2f}" for u in args.uplinks)
+                    print(f"{path.name:<20}{f'{encoding}-{level}':<10}{raw / size:>8.2f}{raw - size:>10}{throughput:>9.1f}{times}")
+
+
+if __name__ == "__main__":
+    main()
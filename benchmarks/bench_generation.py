@@ -0,0 +1,83 @@
+# Benchmark: vector and kraus generation with the moe binary vs. the NumPy fast path.
+# Also checks that the NumPy files have the same format as the binary's (size, header, normalization), and the round
+# trip the worker requires before it uses local generation (local_generation.verify_with_binary).
+# Run from the repository root: python benchmarks/bench_generation.py [--repeat 5]
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src import dat_format, local_generation
+from src.process_manager import ProcessManager
+
+
+async def timed(coro_factory, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = await coro_factory()
+        times.append(time.perf_counter() - start)
+        if not out or not out[0]:
+            return None
+    return min(times)
+
+
+def check_format(binary_path: Path, local_path: Path, kind: str, n: int, d: int = 1):
+    """Compare a binary generated file with a local one. Returns a short verdict."""
+    import numpy as np
+    expected = dat_format.expected_size(kind, n, d)
+    sizes = (binary_path.stat().st_size, local_path.stat().st_size)
+    if sizes != (expected, expected):
+        return f"MISMATCH sizes binary={sizes[0]} local={sizes[1]} expected={expected}"
+    if kind == "vector":
+        ok = abs(np.linalg.norm(dat_format.read_vector(binary_path)) - 1) < 1e-8
+    else:
+        ops = dat_format.read_kraus(binary_path)
+        ok = np.allclose(sum(k.conj().T @ k for k in ops), np.eye(n), atol=1e-8)
+    return "ok" if ok else "MISMATCH contents (binary file does not read as normalized)"
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[4, 16, 64, 256])
+    parser.add_argument("--kraus", type=int, default=4, help="number of kraus operators")
+    parser.add_argument("--executable", default="./bin/moe")
+    args = parser.parse_args()
+
+    if not local_generation.numpy_available():
+        print("NumPy is not installed, nothing to benchmark")
+        return
+    manager = ProcessManager(args.executable, require_executable=False)
+    has_binary = manager.check_executable()
+    manager.printing = False
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        print(f"{'job':<8}{'N':>6}{'binary [ms]':>14}{'numpy [ms]':>14}{'speedup':>10}  format")
+        for n in args.sizes:
+            for kind in ("vector", "kraus"):
+                bin_path, loc_path = tmp / f"bin_{kind}_{n}.dat", tmp / f"loc_{kind}_{n}.dat"
+                if kind == "vector":
+                    local = lambda: local_generation.run_vector_generation(n, loc_path)
+                    binary = lambda: manager.run_vector_generation(n, str(bin_path))
+                else:
+                    local = lambda: local_generation.run_kraus_generation(n, args.kraus, loc_path)
+                    binary = lambda: manager.run_kraus_generation(n, args.kraus, str(bin_path))
+                t_local = await timed(local, args.repeat)
+                t_binary = await timed(binary, args.repeat) if has_binary else None
+                verdict = check_format(bin_path, loc_path, kind, n, args.kraus) if t_binary else "n/a (no binary)"
+                speedup = f"{t_binary / t_local:.1f}x" if t_binary and t_local else "n/a"
+                t_b = f"{1000 * t_binary:.2f}" if t_binary else "n/a"
+                print(f"{kind:<8}{n:>6}{t_b:>14}{1000 * t_local:>14.2f}{speedup:>10}  {verdict}")
+        if has_binary:
+            problem = await local_generation.verify_with_binary(manager, tmp)
+            print(f"Round trip with the binary: {problem or 'ok'}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
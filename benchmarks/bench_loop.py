@@ -0,0 +1,145 @@
+# Benchmark: event loop backends (asyncio, uvloop), on the work the client's loop actually does.
+#  - callbacks: task switches per second (asyncio.sleep(0) in a few tasks), the raw loop overhead
+#  - parse: progress lines per second through the process manager pipes and Worker.parse_line
+#  - http: authenticated API requests per second (APIHandler, concurrent) against the stand-in server
+# Every backend runs in a fresh interpreter, the stand-in server in another one so it does not share the loop:
+#   python benchmarks/bench_loop.py
+#   python benchmarks/bench_loop.py --save loop.json
+# Run from the repository root (like moe.py, the worker needs ./bin/moe).
+import argparse
+import asyncio
+import json
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from src import event_loop
+
+# Child process printing progress lines as fast as it can, like a minimization of a tiny channel
+PRINTER = "import sys\nfor i in range(int(sys.argv[1])): print(f'[Iteration {i + 1}] Loss: 0.5 Entropy: {2 - i * 1e-6:.8f}')"
+
+
+async def bench_callbacks(switches: int, tasks: int = 10):
+    async def switch(n):
+        for _ in range(n):
+            await asyncio.sleep(0)
+    start = time.perf_counter()
+    await asyncio.gather(*(switch(switches // tasks) for _ in range(tasks)))
+    return switches / (time.perf_counter() - start)
+
+
+async def bench_parse(lines: int, folder: str):
+    from src.worker import Worker, WorkerConfig
+    from src.job import Job
+    worker = Worker(WorkerConfig(data_folder=folder, token_cache="", record_trajectory=True))
+    worker.jobs = [Job(job_id=1, job_type="minimize", input_dimension=2, number_kraus=2)]
+    consumer = asyncio.create_task(worker.consume_output(worker.process_manager.stdout_queue))
+    start = time.perf_counter()
+    await worker.process_manager.run_process([sys.executable, "-c", PRINTER, str(lines)], tag=1)
+    await worker.process_manager.stdout_queue.put(None)
+    await consumer
+    elapsed = time.perf_counter() - start
+    if worker.jobs[0].current_iterations != lines:
+        raise RuntimeError(f"parsed {worker.jobs[0].current_iterations} of {lines} lines")
+    return lines / elapsed
+
+
+async def bench_http(requests: int, concurrency: int, port: int):
+    from src.api_handler import APIHandler
+    api_handler = APIHandler(f"http://localhost:{port}")
+    if not await api_handler.login("bench", "bench"):
+        raise RuntimeError(f"login failed: {api_handler.status}")
+    semaphore = asyncio.Semaphore(concurrency)
+    async def one():
+        async with semaphore:
+            if not await api_handler.check_login():
+                raise RuntimeError(api_handler.status)
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return requests / (time.perf_counter() - start)
+
+
+async def child(args):
+    with tempfile.TemporaryDirectory() as folder:
+        return {
+            "callbacks_per_s": max([await bench_callbacks(args.switches) for _ in range(args.repeat)]),
+            "lines_per_s": max([await bench_parse(args.lines, folder) for _ in range(args.repeat)]),
+            "requests_per_s": max([await bench_http(args.requests, args.concurrency, args.port) for _ in range(args.repeat)]),
+        }
+
+
+def run_child(backend: str, args):
+    loop, used = event_loop.new_event_loop(backend)
+    asyncio.set_event_loop(loop)
+    try:
+        results = loop.run_until_complete(child(args))
+    finally:
+        event_loop.close_loop(loop)
+    results["backend"] = used
+    print(json.dumps(results))
+
+
+def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"stand-in server did not come up on port {port}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backends", default="asyncio,uvloop", help="comma separated, see src/event_loop.py")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--switches", type=int, default=200000)
+    parser.add_argument("--lines", type=int, default=50000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--port", type=int, default=3098)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args)
+        return
+
+    server = subprocess.Popen([sys.executable, str(ROOT / "tools" / "stand_in_server.py"), "--port", str(args.port), "--jobs", "0"], stdout=subprocess.DEVNULL)
+    results = dict()
+    try:
+        wait_for_port(args.port)
+        for backend in args.backends.split(","):
+            if backend == "uvloop" and not event_loop.uvloop_available():
+                print("uvloop is not installed, skipped")
+                continue
+            command = [sys.executable, __file__, "--child", backend] + [f"--{name}={getattr(args, name)}" for name in ("repeat", "switches", "lines", "requests", "concurrency", "port")]
+            out = subprocess.run(command, capture_output=True, text=True)
+            if out.returncode != 0:
+                raise RuntimeError(f"{backend} failed: {out.stderr.strip()[-300:]}")
+            results[backend] = json.loads(out.stdout.strip().splitlines()[-1])
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(f"{'backend':<10}{'switches/s':>14}{'lines/s':>12}{'requests/s':>12}")
+    for backend, result in results.items():
+        print(f"{backend:<10}{result['callbacks_per_s']:>14.0f}{result['lines_per_s']:>12.0f}{result['requests_per_s']:>12.0f}")
+    if "asyncio" in results and "uvloop" in results:
+        ratios = {key: results["uvloop"][key] / results["asyncio"][key] for key in ("callbacks_per_s", "lines_per_s", "requests_per_s")}
+        print("uvloop / asyncio: " + ", ".join(f"{key} x{ratio:.2f}" for key, ratio in ratios.items()))
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
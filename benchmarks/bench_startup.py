@@ -0,0 +1,122 @@
+# Benchmark: cold start of the client.
+#  - import time of the interface (python -X importtime), with the slowest modules
+#  - wall time from starting a fresh interpreter to the first leased job, against the stand-in server
+# Results can be saved as JSON and compared with an earlier run, to catch startup regressions:
+#   python benchmarks/bench_startup.py --save startup.json
+#   python benchmarks/bench_startup.py --baseline startup.json --tolerance 0.2
+# Run from the repository root (like moe.py, leasing a job needs ./bin/moe).
+import argparse
+import asyncio
+import json
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "tools"))
+
+from stand_in_server import StandInServer
+
+# Child process for the time to first lease: log in and lease one job, as a worker does after a restart
+LEASE_SCRIPT = """
+import asyncio, sys
+from src.worker import Worker, WorkerConfig
+async def main():
+    worker = Worker(WorkerConfig(api_url=sys.argv[1], data_folder=sys.argv[2], token_cache=""))
+    await worker.login("bench", "bench")
+    if not await worker.get_job():
+        sys.exit(1)
+asyncio.run(main())
+"""
+
+
+def import_times(module: str, cwd: Path):
+    """Total import time of module and {module: cumulative seconds} of everything it imports"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=cwd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    times = dict()
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)", line)
+        if match:
+            times[match.group(4)] = int(match.group(2)) / 1e6
+    return times.get(module, 0.0), times
+
+
+def interpreter_time(cwd: Path, repeat: int):
+    """Wall time of an empty interpreter, for reference"""
+    return min(timed_run([sys.executable, "-c", "pass"], cwd) for _ in range(repeat))
+
+
+def timed_run(command, cwd: Path):
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=cwd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(command[:3])}... failed: {result.stderr.strip()[-300:]}")
+    return time.perf_counter() - start
+
+
+async def time_to_first_lease(cwd: Path, repeat: int, port: int):
+    with tempfile.TemporaryDirectory() as folder:
+        from aiohttp import web
+        server = StandInServer(Path(folder))
+        runner = web.AppRunner(server.app())
+        await runner.setup()
+        await web.TCPSite(runner, "localhost", port).start()
+        times = []
+        try:
+            for _ in range(repeat):
+                await server.add_job("generate_vector")
+                command = [sys.executable, "-c", LEASE_SCRIPT, f"http://localhost:{port}", str(Path(folder) / "data")]
+                times.append(await asyncio.to_thread(timed_run, command, cwd))
+        finally:
+            await runner.cleanup()
+    return min(times)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--module", default="src.gui", help="module whose import time is measured")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to show")
+    parser.add_argument("--port", type=int, default=3099)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown against the baseline")
+    args = parser.parse_args()
+    cwd = Path.cwd()
+
+    runs = [import_times(args.module, cwd) for _ in range(args.repeat)]
+    total, breakdown = min(runs, key=lambda run: run[0])
+    print(f"Import of {args.module}: {total * 1000:.1f} ms (best of {args.repeat})")
+    # Only top level packages, their submodules are included in their cumulative time
+    top_level = {name: t for name, t in breakdown.items() if "." not in name or name.startswith("src.")}
+    for name, t in sorted(top_level.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {name:<40}{t * 1000:>10.1f} ms")
+
+    results = {"import_ms": total * 1000}
+    results["interpreter_ms"] = interpreter_time(cwd, args.repeat) * 1000
+    results["first_lease_ms"] = await time_to_first_lease(cwd, args.repeat, args.port) * 1000
+    print(f"Empty interpreter: {results['interpreter_ms']:.1f} ms")
+    print(f"Start to first leased job: {results['first_lease_ms']:.1f} ms (best of {args.repeat})")
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+        regressed = False
+        for key in ("import_ms", "first_lease_ms"):
+            if key in baseline and results[key] > baseline[key] * (1 + args.tolerance):
+                print(f"REGRESSION {key}: {results[key]:.1f} ms, baseline {baseline[key]:.1f} ms")
+                regressed = True
+        sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,13 +1,32 @@
-import curses
+import argparse
 import asyncio
-# curses gui elements
-from src.gui import *
+import sys
+from src import event_loop
 
 
 def main():
     """Manages curses and background task cleanly"""
-    loop = asyncio.new_event_loop()
-    curses.wrapper(lambda stdscr: loop.run_until_complete(update_screen(stdscr)))
+    parser = argparse.ArgumentParser(description="QuantumHive worker client")
+    parser.add_argument("--headless", action="store_true", help="run without the interface (log in with saved tokens or MOE_USERNAME / MOE_PASSWORD)")
+    parser.add_argument("--loop", choices=event_loop.BACKENDS, default=event_loop.default_backend(), help="event loop backend (default: MOE_LOOP or auto, i.e. uvloop if installed)")
+    args = parser.parse_args()
+
+    loop, _ = event_loop.new_event_loop(args.loop)
+    asyncio.set_event_loop(loop)
+    try:
+        from src.worker import worker_config
+        if args.headless:
+            from src.headless import run_headless
+            if not loop.run_until_complete(run_headless(worker_config)):
+                sys.exit(1)
+            return
+
+        # curses gui elements
+        import curses
+        from src.gui import update_screen
+        curses.wrapper(lambda stdscr: loop.run_until_complete(update_screen(stdscr, worker_config)))
+    finally:
+        event_loop.close_loop(loop)
     # Start the background worker task
 
 
@@ -15,6 +34,3 @@ def main():
 # Main entry point
 if __name__ == "__main__":
     main()
-
-
-
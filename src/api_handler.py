@@ -1,9 +1,26 @@
-import aiohttp
-import aiofiles
+from src.lazy_import import lazy_import
 from pathlib import Path
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import uuid
+import asyncio
+import hashlib
+import json
+import re
+import time
+from src import compression
+from src.backoff import Backoff
+from src.resilience import APIError, TransientAPIError, RequestError, CircuitOpenError, TokenRefreshedError, CircuitBreaker, classify_status, classify_exception
+from email.utils import parsedate_to_datetime
+import datetime
+
+# aiohttp and aiofiles are slow to import, they are loaded on the first request
+aiohttp = lazy_import("aiohttp")
+aiofiles = lazy_import("aiofiles")
+
+def network_errors():
+    """Errors raised by aiohttp when the API cannot be reached or the connection drops"""
+    return (aiohttp.ClientError, asyncio.TimeoutError)
 class CursesError(Exception):
     """Custom exception for displaying errors in a curses popup."""
     def __init__(self, message: str):
@@ -17,14 +34,145 @@ class APIHandlerConfig:
     chunk_size: int = 1024 * 1024  # 1MB chunks
     max_request_filesize = 50 * 1024 * 1024  # 50MB
     split_larger_files = True
+    # Downloads
+    download_connections: int = 4 # Concurrent ranged requests for large files
+    parallel_download_threshold: int = 32 * 1024 * 1024 # Files at least this large are downloaded in parallel
+    download_segment_size: int = 8 * 1024 * 1024 # Size of one ranged request in parallel mode
+    status_interval: float = 0.5 # Minimum seconds between progress status updates
+    # On-the-wire compression of .dat files. Only used if the server accepts it (uploads) or sends it (downloads).
+    # Off by default: the .dat files hold random complex numbers, which barely compress (a few percent)
+    upload_compression: bool = False
+    upload_min_saving: float = 0.1 # Send raw unless a sample of the file compresses by at least this fraction
+    download_compression: bool = True
+    compression_level: int = None # None = codec default
+    # Retries. Transient errors are retried with exponential backoff and jitter (non idempotent calls only if safe).
+    max_retries: int = 4
+    retry_base_delay: float = 1.0
+    retry_max_delay: float = 30.0
+    # Circuit breaker: after this many consecutive transient failures, stop talking to the API for a while
+    breaker_failure_threshold: int = 5
+    breaker_reset_timeout: float = 60.0
+    # Timeouts in seconds, per endpoint (the name passed to request), with a default for everything else
+    default_timeout: float = 30.0
+    timeouts: dict = field(default_factory=lambda: {"upload": 600.0, "download": 3600.0})
+
+@dataclass
+class APIResponse:
+    status: int
+    headers: dict
+    data: object # Parsed JSON if the server sent JSON, text otherwise
+
 class APIHandler:
     def __init__(self, api_url: str, config: APIHandlerConfig = APIHandlerConfig()):
         self.config = config
         self.api_url = api_url
         self.access_token = ''
         self.refresh_token = ''
+        self.username = ''
+        self.token_cache = None # Optional TokenCache, updated whenever the tokens change
+        self.refresh_lock = asyncio.Lock()
 
         self.status = ""
+        self.last_status_update = 0.0
+        # Seconds the server asked us to wait before the next job request (Retry-After), None if not given
+        self.retry_after = None
+        # Whether the server supports long-poll job assignment. None until tried.
+        self.long_poll_supported = None
+        # Request layer state
+        self.circuit_breaker = CircuitBreaker(config.breaker_failure_threshold, config.breaker_reset_timeout)
+
+    def update_status(self, message: str, force: bool = False):
+        """Set the status, but not more often than every status_interval seconds (unless forced)"""
+        now = time.monotonic()
+        if force or now - self.last_status_update >= self.config.status_interval:
+            self.status = message
+            self.last_status_update = now
+
+    ##############################
+    # Request layer              #
+    ##############################
+
+    def timeout_for(self, name: str, timeout: float = None):
+        total = timeout if timeout is not None else self.config.timeouts.get(name, self.config.default_timeout)
+        return aiohttp.ClientTimeout(total=total)
+
+    async def execute(self, name: str, attempt, idempotent: bool = True):
+        """
+        Run the coroutine function attempt() until it succeeds, retrying transient errors with backoff and jitter.
+        Non idempotent calls are only retried if the request certainly did not reach the server.
+        Raises an APIError once retries are exhausted, the error is not retryable, or the circuit breaker is open.
+        """
+        backoff = Backoff(self.config.retry_base_delay, 2.0, self.config.retry_max_delay)
+        for n in range(self.config.max_retries + 1):
+            if not self.circuit_breaker.allow_request():
+                if self.circuit_breaker.trial:
+                    raise CircuitOpenError("API unavailable, a trial request is under way")
+                raise CircuitOpenError(f"API unavailable, retrying in {self.circuit_breaker.remaining:.0f} s")
+            try:
+                result = await attempt()
+            except APIError as e:
+                error = e
+            except network_errors() as e:
+                error = classify_exception(e)
+            except BaseException:
+                # Cancelled, or a bug: no verdict on the API, but do not block the next trial
+                self.circuit_breaker.release()
+                raise
+            else:
+                self.circuit_breaker.record_success()
+                return result
+            if isinstance(error, TransientAPIError) and not isinstance(error, TokenRefreshedError):
+                self.circuit_breaker.record_failure()
+            else:
+                # The API answered, so it is up
+                self.circuit_breaker.record_success()
+            if not error.retryable(idempotent) or n == self.config.max_retries:
+                raise error
+            delay = error.retry_after if error.retry_after is not None else backoff.next_delay()
+            self.update_status(f"[Warning] {name} failed ({error.message}), retry {n + 1} in {delay:.1f} s", force=True)
+            await asyncio.sleep(min(delay, self.config.retry_max_delay))
+
+    async def request(self, method: str, endpoint: str, name: str = None, idempotent: bool = None, auth: bool = True, expect: tuple = (200,), data=None, json=None, params: dict = None, headers: dict = None, timeout: float = None):
+        """
+        Send a request to the API through the retry/circuit breaker layer and return an APIResponse.
+        data may be a coroutine function building the body, so every attempt gets a fresh one (e.g. a FormData).
+        With auth, the access token is sent and refreshed once on a 401.
+        Unless idempotent says otherwise, only GET requests are retried after they may have reached the server.
+        """
+        name = name or endpoint
+        if idempotent is None:
+            idempotent = method == "GET"
+
+        async def attempt():
+            refreshed = False
+            while True:
+                request_headers = dict(headers or {})
+                if auth:
+                    request_headers["Authorization"] = f"Bearer {self.access_token}"
+                body = await data() if callable(data) else data
+                async with aiohttp.ClientSession(timeout=self.timeout_for(name, timeout)) as session:
+                    async with session.request(method, self.api_url + endpoint, headers=request_headers, data=body, json=json, params=params) as response:
+                        retry_after = self.parse_retry_after(response.headers.get("Retry-After"))
+                        if response.status == 401 and auth and not refreshed and self.refresh_token:
+                            # Access token expired: refresh and send the request again
+                            refreshed = True
+                            if await self.refresh_if_stale(request_headers["Authorization"].removeprefix("Bearer ")):
+                                continue
+                        if response.status not in expect:
+                            raise classify_status(response.status, await response.text(), retry_after)
+                        if response.content_type == "application/json":
+                            payload = await response.json()
+                        else:
+                            payload = await response.text()
+                        return APIResponse(response.status, dict(response.headers), payload)
+
+        return await self.execute(name, attempt, idempotent)
+
+    def report_error(self, what: str, error: APIError):
+        self.status = f"[Error] Failed to {what}: {error.message}"
+
+    # Calls that return None (or False) on failure take check=True to raise the APIError of that very call instead,
+    # for callers that have to tell a refusal (RequestError) from the API being unreachable (TransientAPIError).
 
     ##############################
     # Authentication functions   #
@@ -34,142 +182,114 @@ class APIHandler:
         self.status = "Logging in..."
         # Log in to get the token
         login_data = {"username": uid, "password": pwd}
+        try:
+            response = await self.request("POST", "/auth/login", auth=False, idempotent=True, data=login_data)
+        except APIError as e:
+            self.report_error("log in", e)
+            return False
+        self.access_token = response.data.get("access_token")
+        self.refresh_token = response.data.get("refresh_token")
+        self.username = uid
+        self.save_tokens()
+        self.status = "Logged in successfully"
+        return True
+
+    def restore_tokens(self, session: dict):
+        """Use the tokens of a saved session (see TokenCache)"""
+        self.access_token = session.get("access_token", "")
+        self.refresh_token = session.get("refresh_token", "")
+        self.username = session.get("username", "")
+
+    def save_tokens(self):
+        if self.token_cache:
+            self.token_cache.save(self.api_url, self.username, self.access_token, self.refresh_token)
 
-        # Use aiohttp for asynchronous HTTP request
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.api_url}/auth/login", data=login_data) as login_response:
-                if login_response.status != 200:
-                    self.status = f"[Error] Failed to log in: {await login_response.text()}"
-                    return False
-
-                # Parse the JSON response asynchronously
-                login_info = await login_response.json()
-                self.access_token = login_info.get("access_token")
-                self.refresh_token = login_info.get("refresh_token")
-                self.status = "Logged in successfully"
-                return True
-    
     async def refresh(self):
         self.status = "Refreshing token..."
-        # Refresh the token
+        # Refresh the token. Refresh tokens are single use, so this is not retried once sent.
         header = {"refresh": self.refresh_token}
+        try:
+            response = await self.request("POST", "/auth/refresh", auth=False, idempotent=False, headers=header)
+        except APIError as e:
+            self.report_error("refresh token", e)
+            return False
+        self.access_token = response.data.get("access_token")
+        self.refresh_token = response.data.get("refresh_token")
+        # The old refresh token is spent, a restart has to use the new one
+        self.save_tokens()
+        return True
 
-        # Use aiohttp to perform the request asynchronously
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.api_url}/auth/refresh", headers=header) as refresh_response:
-                if refresh_response.status != 200:
-                    self.status = f"[Error] Failed to refresh token: {await refresh_response.text()}"
-                    return False
-
-                # Parse the JSON response asynchronously
-                refresh_info = await refresh_response.json()
-                self.access_token = refresh_info.get("access_token")
-                self.refresh_token = refresh_info.get("refresh_token")
+    async def refresh_if_stale(self, used_token: str):
+        """Refresh after a 401 on used_token, unless a concurrent request already did (refresh tokens are single use)"""
+        async with self.refresh_lock:
+            if self.access_token != used_token:
                 return True
-            
-    def ensure_login(func):
-        async def wrapper(self, *args, **kwargs):
-            # Ping the server at /auth/ping to check if the access token is still valid
-            header = {"Authorization": f"Bearer {self.access_token}"}
-            
-            # Use aiohttp to perform the ping request asynchronously
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{self.api_url}/auth/ping", headers=header) as ping_response:
-                    if ping_response.status == 401:
-                        # Access token is invalid, try to refresh it
-                        if not await self.refresh():
-                            # Refresh failed, return False. TODO: raise an exception? Ask the user to log in again?
-                            return False
-                    elif ping_response.status != 200:
-                        # If there are other errors, print or handle them
-                        print(f"[Error] Failed to ping server: {await ping_response.text()}")
-                        return False
-
-            # We have a valid access token, call the original function
-            return await func(self, *args, **kwargs)
-
-        return wrapper
-
-    async def check_login(self):
-        # Ping the server at /auth/ping to check if the access token is still valid
-        header = {"Authorization": f"Bearer {self.access_token}"}
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{self.api_url}/auth/ping", headers=header) as ping_response:
-                if ping_response.status == 401:
-                    # Access token is invalid, try to refresh it
-                    if not await self.refresh():
-                        # Refresh failed, return False. TODO: raise an exception? Ask the user to log in again?
-                        return False
-                elif ping_response.status != 200:
-                    # Handle other errors, if needed
-                    print(f"[Error] Failed to ping server: {await ping_response.text()}")
-                    return False
-
+            return await self.refresh()
+
+    async def check_login(self, check: bool = False):
+        # Ping the server at /auth/ping to check if the access token is still valid (refreshing it if needed)
+        if not self.access_token:
+            return False
+        try:
+            await self.request("GET", "/auth/ping")
+        except APIError as e:
+            self.report_error("ping server", e)
+            if check:
+                raise
+            return False
         return True
 
     ##############################
     # Channel related functions  #
     ##############################
 
-    @ensure_login
     async def create_channel(self, input_dim: int, output_dim: int, num_kraus: int, method: str = "haar"):
         # This requires admin access
-        header = {"Authorization": f"Bearer {self.access_token}"}
         data = {"input_dimension": input_dim, "output_dimension": output_dim, "num_kraus": num_kraus, "method": method}
+        try:
+            return (await self.request("POST", "/channels/create", idempotent=False, data=data)).data
+        except APIError as e:
+            self.report_error("create channel", e)
+            return None
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.api_url}/channels/create", headers=header, data=data) as response:
-                if response.status == 200:
-                    return await response.json()
-                print(f"[Error] Failed to create channel: {await response.text()}, Status code: {response.status}")
-                return None    
-
-    @ensure_login
     async def list_channels(self):
-        header = {"Authorization": f"Bearer {self.access_token}"}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{self.api_url}/channels/list", headers=header) as response:
-                if response.status == 200:
-                    return await response.json()
-                print(f"[Error] Failed to list channels: {await response.text()}")
-                return None
-
-    @ensure_login
+        try:
+            return (await self.request("GET", "/channels/list")).data
+        except APIError as e:
+            self.report_error("list channels", e)
+            return None
+
     async def update_channel_minimization_attempts(self, channel_id, attempts):
-        header = {"Authorization": f"Bearer {self.access_token}"}
         min_attempts_data = {"channel_id": channel_id, "attempts": attempts}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.api_url}/channels/update-minimization-attempts", headers=header, data=min_attempts_data) as response:
-                if response.status == 200:
-                    return await response.json()
-                print(f"[Error] Failed to update minimization attempts: {await response.text()}")
-                return None
+        try:
+            return (await self.request("POST", "/channels/update-minimization-attempts", data=min_attempts_data)).data
+        except APIError as e:
+            self.report_error("update minimization attempts", e)
+            return None
 
     ##############################
     # File related functions     #
     ##############################
 
-    @ensure_login
-    async def request_upload_link(self):
+    async def request_upload_link(self, check: bool = False):
         self.status = "Requesting upload link..."
-        headers = {"Authorization": f"Bearer {self.access_token}"}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.api_url}/files/request-upload", headers=headers) as response:
-                if response.status == 200:
-                    self.status = "Upload link received"
-                    return await response.json()
-
-                raise CursesError(f"Failed to get upload link: {await response.text()}")
-
-
-    @ensure_login
-    async def upload_file(self, job_id: int, file_type: str, file_path: Path, upload_link: str):
+        try:
+            response = await self.request("POST", "/files/request-upload", idempotent=True)
+        except APIError as e:
+            self.report_error("get upload link", e)
+            if check:
+                raise
+            return None
+        self.status = "Upload link received"
+        return response.data
+
+
+    async def upload_file(self, job_id: int, file_type: str, file_path: Path, upload_link: str, encodings: list = None, check: bool = False):
+        # encodings are the content encodings the server accepts for this upload (from request_upload_link)
         self.status = "Uploading file..."
-        headers = {"Authorization": f"Bearer {self.access_token}"}
+        encoding = compression.choose_encoding(encodings) if self.config.upload_compression else None
+        if encoding and not await asyncio.to_thread(self.worth_compressing, file_path, encoding):
+            encoding = None
 
         self.status = f"Uploading {file_path.name} to {upload_link}..."
 
@@ -189,198 +309,368 @@ class APIHandler:
                 start = i * chunk_size
                 end = min(start + chunk_size, file_size)
 
-                # Move to the correct position in the file for each chunk
-                await file.seek(start)
-
-                # Read the chunk
-                chunk = await file.read(end - start)
-
-                # Prepare the data for the request
-                data = aiohttp.FormData()
-                data.add_field("job_id", str(job_id))
-                data.add_field("file_type", file_type)
-                data.add_field("total_chunks", str(n_uploads))
-                data.add_field("chunk_index", str(i+1))
-                data.add_field("session_id", session_id)
-
-                # Add the file chunk to the form
-                data.add_field(
-                    "file",
-                    chunk,
-                    filename=file_path.name,
-                    content_type="application/octet-stream"
-                )
-
-                async with aiohttp.ClientSession() as session:
-                    self.status = f"Sending chunk {i + 1}/{n_uploads}..."
-                    async with session.post(self.api_url + upload_link, headers=headers, data=data) as response:
-                        if response.status == 200:
-                            self.status = f"Chunk {i + 1}/{n_uploads} uploaded successfully"
-                        else:
-                            self.status = f"[Error] Failed to upload chunk {i + 1}: {await response.text()}"
-                            raise Exception(f"Upload failed: {await response.text()}")
+                # The form is built per attempt, as a retry has to read the chunk again.
+                # Chunks are identified by session_id and chunk_index, so sending one twice is harmless.
+                async def form():
+                    # Move to the correct position in the file for each chunk
+                    await file.seek(start)
+
+                    # Read the chunk. Compressed chunks are streamed piece by piece instead.
+                    chunk = await file.read(end - start) if not encoding else self.compressed_chunk(file, end - start, encoding)
+
+                    # Prepare the data for the request
+                    data = aiohttp.FormData()
+                    data.add_field("job_id", str(job_id))
+                    data.add_field("file_type", file_type)
+                    data.add_field("total_chunks", str(n_uploads))
+                    data.add_field("chunk_index", str(i+1))
+                    data.add_field("session_id", session_id)
+                    if encoding:
+                        # Every chunk is compressed on its own, the server decompresses and concatenates them
+                        data.add_field("content_encoding", encoding)
+                        data.add_field("original_size", str(end - start))
+
+                    # Add the file chunk to the form
+                    data.add_field(
+                        "file",
+                        chunk,
+                        filename=file_path.name,
+                        content_type="application/octet-stream"
+                    )
+                    return data
+
+                self.status = f"Sending chunk {i + 1}/{n_uploads}..."
+                try:
+                    await self.request("POST", upload_link, name="upload", idempotent=True, data=form)
+                except APIError as e:
+                    self.report_error(f"upload chunk {i + 1}", e)
+                    if check:
+                        raise
+                    return None
+                self.status = f"Chunk {i + 1}/{n_uploads} uploaded successfully"
 
         self.status = "File upload completed."
         return {"message": "File uploaded successfully"}
 
-    @ensure_login
+    def worth_compressing(self, file_path: Path, encoding: str):
+        """Whether the start of the file compresses by at least upload_min_saving"""
+        with open(file_path, "rb") as file:
+            sample = file.read(self.config.chunk_size)
+        if not sample:
+            return False
+        compressor = compression.Compressor(encoding, self.config.compression_level)
+        size = len(compressor.compress(sample)) + len(compressor.flush())
+        return size <= len(sample) * (1 - self.config.upload_min_saving)
+
+    async def compressed_chunk(self, file, length: int, encoding: str):
+        """Read length bytes from the current position of file and yield them compressed"""
+        compressor = compression.Compressor(encoding, self.config.compression_level)
+        remaining = length
+        while remaining > 0:
+            piece = await file.read(min(self.config.chunk_size, remaining))
+            if not piece:
+                break
+            remaining -= len(piece)
+            out = await asyncio.to_thread(compressor.compress, piece)
+            if out:
+                yield out
+        yield compressor.flush()
+
     async def request_download_link(self, file_id: str):
         self.status = "Requesting download link..."
-        headers = {"Authorization": f"Bearer {self.access_token}"}
         params = {"file_id": file_id}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.api_url}/files/request-download/", headers=headers, json=params) as response:
-                if response.status == 200:
-                    self.status = "Download link received"
-                    return await response.json()
-                self.status = f"[Error] Failed to get download link: {await response.text()}"
-                return None
-
-    @ensure_login
-    async def download_file(self, download_link: str, output_path: Path):
-        headers = {"Authorization": f"Bearer {self.access_token}"}
+        try:
+            response = await self.request("POST", "/files/request-download/", idempotent=True, json=params)
+        except APIError as e:
+            self.report_error("get download link", e)
+            return None
+        self.status = "Download link received"
+        return response.data
+
+    async def download_file(self, download_link: str, output_path: Path, checksum: str = None):
+        """
+        Download a file into output_path. Data goes to output_path.part first and is only renamed into place once its
+        size (and sha256 checksum, if known) have been verified. Interrupted downloads are resumed with HTTP Range
+        requests, large files are fetched with several concurrent ranged requests.
+        """
+        output_path = Path(output_path)
+        if output_path.exists() and not os.access(output_path, os.W_OK):
+            self.status = f"[Error] File {output_path} is locked or not writable."
+            return False
+
         self.status = f"Downloading file from {download_link} to {output_path}..."
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.api_url + download_link, headers=headers) as response:
-                self.status = f"Awaiting response status..."
-                if response.status == 200:
-                    self.status = f"Downloading file to {output_path}..."
-                    if os.path.exists(output_path) and os.access(output_path, os.W_OK):
-                        self.status = f"[Warning] File {output_path} already exists and is writable."
-                    else:
-                        if os.path.exists(output_path):
-                            self.status = f"[Error] File {output_path} is locked or not writable."
-                            return False
+        # Every retry picks up where the previous attempt stopped
+        try:
+            await self.execute("download", lambda: self.download_attempt(download_link, output_path, checksum))
+        except APIError as e:
+            self.report_error("download file", e)
+            return False
+        self.update_status(f"File downloaded successfully to {output_path}", force=True)
+        return True
+
+    async def download_attempt(self, download_link: str, output_path: Path, checksum: str = None):
+        part_path = Path(str(output_path) + ".part")
+        state_path = Path(str(output_path) + ".part.json") # Progress of a parallel download
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        url = self.api_url + download_link
+
+        # Content encodings are handled here (not by aiohttp), so ranges and sizes always refer to what we write
+        async with aiohttp.ClientSession(auto_decompress=False, timeout=self.timeout_for("download")) as session:
+            if state_path.exists():
+                # Resume an interrupted parallel download
+                with open(state_path, "r") as file:
+                    state = json.load(file)
+                total = state["total"]
+                await self.download_segments(session, url, headers, part_path, state_path, state)
+            else:
+                offset = part_path.stat().st_size if part_path.exists() else 0
+                range_headers = dict(headers, Range=f"bytes={offset}-")
+                # Offer compression for fresh downloads. Resumed ones must be byte exact.
+                range_headers["Accept-Encoding"] = compression.accept_encoding_header() if self.config.download_compression and offset == 0 else "identity"
+                async with session.get(url, headers=range_headers) as response:
+                    self.status = f"Awaiting response status..."
+                    encoding = response.headers.get("Content-Encoding", "identity").lower()
+                    if response.status == 401 and await self.refresh_if_stale(headers["Authorization"].removeprefix("Bearer ")):
+                        raise TokenRefreshedError()
+                    if response.status in (200, 206) and encoding != "identity":
+                        # Compressed response: not resumable, decompress into the .part file from the start
+                        total = response.headers.get("X-Uncompressed-Length")
+                        total = int(total) if total else None
+                        checksum = checksum or response.headers.get("X-Checksum-Sha256")
+                        try:
+                            await self.stream_to_file(response, part_path, 0, total, encoding)
+                        except (APIError, *network_errors()):
+                            part_path.unlink(missing_ok=True)
+                            raise
+                    elif response.status == 416 and offset > 0:
+                        # Nothing left to download, or the .part file is bogus. Verification below decides.
+                        total = self.total_size(response)
+                    elif response.status == 206:
+                        total = self.total_size(response)
+                        checksum = checksum or response.headers.get("X-Checksum-Sha256")
+                        if offset == 0 and total and total >= self.config.parallel_download_threshold and self.config.download_connections > 1:
+                            # Large file on a server supporting ranges: switch to segmented parallel download
+                            response.release()
+                            state = {"total": total, "segment_size": self.config.download_segment_size, "done": []}
+                            await self.download_segments(session, url, headers, part_path, state_path, state)
                         else:
-                            self.status = f"Creating file {output_path}..."
-                    async with aiofiles.open(output_path, 'wb') as file:
-                        self.status = f"Opened file {output_path} for writing..."
-                        i = 0
-                        async for chunk in response.content.iter_chunked(1024 * 1024):  # 1MB chunks
-                            self.status = f"Downloading chunk {i} of size {len(chunk)} bytes"
-                            i += 1
-                            await file.write(chunk)
-                    self.status = f"File downloaded successfully to {output_path}"
-                    return True
-                else:
-                    self.status = f"[Error] Failed to download file: {await response.text()}"
-                    return False
+                            await self.stream_to_file(response, part_path, offset, total)
+                    elif response.status == 200:
+                        # The server ignored the range, start from scratch
+                        total = response.content_length
+                        checksum = checksum or response.headers.get("X-Checksum-Sha256")
+                        await self.stream_to_file(response, part_path, 0, total)
+                    else:
+                        raise classify_status(response.status, await response.text(), self.parse_retry_after(response.headers.get("Retry-After")))
+
+        # Verify the download before moving it into place
+        if not await self.verify_download(part_path, total, checksum):
+            # Start over on the next attempt
+            part_path.unlink(missing_ok=True)
+            state_path.unlink(missing_ok=True)
+            raise TransientAPIError(self.status, safe=True)
+        os.replace(part_path, output_path)
+        state_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def total_size(response):
+        """Total file size from a Content-Range header (None if unknown)"""
+        match = re.search(r"/(\d+)$", response.headers.get("Content-Range", ""))
+        return int(match.group(1)) if match else None
+
+    async def stream_to_file(self, response, part_path: Path, offset: int, total: int = None, encoding: str = None):
+        # Append from offset (a 200 response starts over at 0). On errors the .part file is kept, the next attempt resumes from it.
+        mode = "ab" if offset > 0 else "wb"
+        received = offset
+        try:
+            decompressor = compression.Decompressor(encoding)
+        except ValueError:
+            # Not one we offered (e.g. br, or zstd without zstandard installed)
+            raise RequestError(f"Unsupported content encoding: {encoding}")
+        try:
+            async with aiofiles.open(part_path, mode) as file:
+                async for chunk in response.content.iter_chunked(self.config.chunk_size):
+                    chunk = decompressor.decompress(chunk)
+                    await file.write(chunk)
+                    received += len(chunk)
+                    self.update_status(f"Downloading {part_path.name}: {received}/{total or '?'} bytes")
+                await file.write(decompressor.flush())
+        except compression.ERRORS as e:
+            raise TransientAPIError(f"Corrupt compressed download: {e}")
+
+    async def download_segments(self, session, url: str, headers: dict, part_path: Path, state_path: Path, state: dict):
+        total, segment_size = state["total"], state["segment_size"]
+        n_segments = (total + segment_size - 1) // segment_size
+        done = set(state["done"])
+        todo = asyncio.Queue()
+        for i in range(n_segments):
+            if i not in done:
+                todo.put_nowait(i)
+
+        # Preallocate the file, so every segment can be written at its offset
+        if not part_path.exists() or part_path.stat().st_size != total:
+            with open(part_path, "ab") as file:
+                file.truncate(total)
+        self.update_status(f"Downloading {part_path.name} with {self.config.download_connections} connections...", force=True)
+
+        async def fetch_segments():
+            while not todo.empty():
+                i = todo.get_nowait()
+                start = i * segment_size
+                end = min(start + segment_size, total) - 1
+                segment_headers = dict(headers, Range=f"bytes={start}-{end}")
+                # Segments are written at their offset, so they must arrive as is (aiohttp offers gzip and deflate by default)
+                segment_headers["Accept-Encoding"] = "identity"
+                async with session.get(url, headers=segment_headers) as response:
+                    if response.status != 206:
+                        raise classify_status(response.status, "Range request failed")
+                    if response.headers.get("Content-Encoding", "identity").lower() != "identity":
+                        raise RequestError(f"Unexpected content encoding for a range: {response.headers['Content-Encoding']}")
+                    received = 0
+                    async with aiofiles.open(part_path, "r+b") as file:
+                        await file.seek(start)
+                        async for chunk in response.content.iter_chunked(self.config.chunk_size):
+                            # Never past the segment, that may be the done part of the next one
+                            await file.write(chunk[:max(end + 1 - start - received, 0)])
+                            received += len(chunk)
+                # The file is preallocated, so its size says nothing: a short segment has to be caught here
+                if received != end + 1 - start:
+                    raise TransientAPIError(f"Segment {i} has {received} bytes, expected {end + 1 - start}")
+                done.add(i)
+                # Record progress, so an interruption only loses the segments in flight
+                state["done"] = sorted(done)
+                with open(state_path, "w") as file:
+                    json.dump(state, file)
+                self.update_status(f"Downloading {part_path.name}: {len(done)}/{n_segments} segments")
+
+        fetchers = [asyncio.create_task(fetch_segments()) for _ in range(self.config.download_connections)]
+        try:
+            await asyncio.gather(*fetchers)
+        finally:
+            # After the first failure, stop the other fetchers before a retry starts new ones on the same .part file
+            for fetcher in fetchers:
+                fetcher.cancel()
+            await asyncio.gather(*fetchers, return_exceptions=True)
+
+    async def verify_download(self, part_path: Path, total: int = None, checksum: str = None):
+        if not part_path.exists():
+            self.status = f"[Error] Downloaded file {part_path} is missing"
+            return False
+        size = part_path.stat().st_size
+        if total is not None and size != total:
+            self.status = f"[Error] Downloaded file has {size} bytes, expected {total}"
+            return False
+        if checksum:
+            digest = await asyncio.to_thread(self.sha256, part_path)
+            if digest.lower() != checksum.lower():
+                self.status = f"[Error] Checksum mismatch for {part_path.name}"
+                return False
+        return True
+
+    @staticmethod
+    def sha256(path: Path):
+        h = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                h.update(block)
+        return h.hexdigest()
 
     ##############################
     # Job related functions      #
-    ############################## 
-       
-    @ensure_login
-    async def get_job(self):
-        header = {"Authorization": f"Bearer {self.access_token}"}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{self.api_url}/jobs/request", headers=header) as response:
-                if response.status == 200:
-                    return await response.json()
-                # If the server returns 204, it means there are no jobs available
-                if response.status == 204:
-                    return None
-                print(f"[Error] Failed to get job: {await response.text()}")
-                return None
+    ##############################
 
-    @ensure_login
-    async def ping_job(self, job_id: int):
-        headers = {"Authorization": f"Bearer {self.access_token}"}
+    async def get_job(self, params: dict = None):
+        # params are optional hints for the scheduler, e.g. {"kraus_id": ...} to prefer jobs on an already downloaded channel
+        # Leasing is not idempotent: a lost response may have leased a job already, so only safe retries are made.
+        try:
+            response = await self.request("GET", "/jobs/request", idempotent=False, expect=(200, 204), params=params)
+        except APIError as e:
+            self.retry_after = e.retry_after
+            self.report_error("get job", e)
+            return None
+        self.retry_after = self.parse_retry_after(response.headers.get("Retry-After"))
+        # If the server returns 204, it means there are no jobs available
+        if response.status == 204:
+            return None
+        return response.data
+
+    async def wait_for_job(self, wait: float = 60.0, params: dict = None):
+        """
+        Long-poll for a job: the server holds the request open until a job is available (returned) or wait seconds
+        passed (None). If the server does not know the endpoint, long_poll_supported is set to False and the caller
+        should fall back to get_job.
+        """
+        query = dict(params or {}, wait=str(wait))
+        try:
+            # Leave the server some slack to answer after its own timeout
+            response = await self.request("GET", "/jobs/subscribe", idempotent=False, expect=(200, 204, 404, 405, 501), params=query, timeout=wait + 15)
+        except APIError as e:
+            self.retry_after = e.retry_after
+            self.report_error("wait for job", e)
+            return None
+        self.retry_after = self.parse_retry_after(response.headers.get("Retry-After"))
+        if response.status in (404, 405, 501):
+            self.long_poll_supported = False
+            self.status = "Server does not support long-poll, polling for jobs instead"
+            return None
+        self.long_poll_supported = True
+        if response.status == 204:
+            return None
+        return response.data
+
+    @staticmethod
+    def parse_retry_after(value: str):
+        """Seconds to wait from a Retry-After header (either seconds or an HTTP date)"""
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max((when - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0)
+
+    async def job_request(self, endpoint: str, what: str, data: dict, check: bool = False, idempotent: bool = False):
+        """POST to one of the /jobs endpoints. Returns the JSON answer, or None on failure."""
+        # Only calls that set a state or read one (idempotent) are retried once they may have reached the server.
+        # Completing or cancelling a job twice is not harmless.
+        try:
+            return (await self.request("POST", endpoint, idempotent=idempotent, data=data)).data
+        except APIError as e:
+            self.report_error(what, e)
+            if check:
+                raise
+            return None
+
+    async def ping_job(self, job_id: int, iterations: int = None, entropy: float = None, check: bool = False):
+        # The latest progress can travel along with the ping
         data = {"job_id": job_id}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.api_url}/jobs/ping", headers=headers, data=data) as response:
-                if response.status == 200:
-                    return await response.json()
-                print(f"[Error] Failed to ping job: {await response.text()}")
-                return None
-    
-    @ensure_login
+        if iterations:
+            data["num_iterations"] = iterations
+        if entropy is not None:
+            data["entropy"] = entropy
+        return await self.job_request("/jobs/ping", "ping job", data, check, idempotent=True)
+
     async def pause_job(self, job_id: int):
-        headers = {"Authorization": f"Bearer {self.access_token}"}
-        data = {"job_id": job_id}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.api_url}/jobs/pause", headers=headers, data=data) as response:
-                if response.status == 200:
-                    return await response.json()
-                print(f"[Error] Failed to pause job: {await response.text()}")
-                return None
-        
-    @ensure_login
-    async def resume_job(self, job_id: int):
-        headers = {"Authorization": f"Bearer {self.access_token}"}
-        data = {"job_id": job_id}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.api_url}/jobs/resume", headers=headers, data=data) as response:
-                if response.status == 200:
-                    return await response.json()
-                print(f"[Error] Failed to resume job: {await response.text()}")
-                return None
-    
-    # Asynchronous version of the complete_job method
-    @ensure_login
-    async def complete_job(self, job_id: int):
-        headers = {"Authorization": f"Bearer {self.access_token}"}
-        data = {"job_id": job_id}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.api_url}/jobs/complete", headers=headers, data=data) as response:
-                if response.status == 200:
-                    return await response.json()
-                print(f"[Error] Failed to complete job: {await response.text()}")
-                return None
-    
-    @ensure_login
-    async def cancel_job(self, job_id: int):
-        headers = {"Authorization": f"Bearer {self.access_token}"}
-        data = {"job_id": job_id}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.api_url}/jobs/cancel", headers=headers, data=data) as response:
-                if response.status == 200:
-                    return await response.json()
-                print(f"[Error] Failed to cancel job: {await response.text()}")
-                return None
-
-    # Asynchronous version of the update_iterations method
-    @ensure_login
+        return await self.job_request("/jobs/pause", "pause job", {"job_id": job_id}, idempotent=True)
+
+    async def resume_job(self, job_id: int, check: bool = False):
+        return await self.job_request("/jobs/resume", "resume job", {"job_id": job_id}, check, idempotent=True)
+
+    async def complete_job(self, job_id: int, check: bool = False):
+        return await self.job_request("/jobs/complete", "complete job", {"job_id": job_id}, check)
+
+    async def cancel_job(self, job_id: int, check: bool = False):
+        return await self.job_request("/jobs/cancel", "cancel job", {"job_id": job_id}, check)
+
     async def update_iterations(self, job_id: int, iterations: int):
-        headers = {"Authorization": f"Bearer {self.access_token}"}
-        data = {"job_id": job_id, "num_iterations": iterations}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.api_url}/jobs/update-iterations", headers=headers, data=data) as response:
-                if response.status == 200:
-                    return await response.json()
-                print(f"[Error] Failed to update iterations: {await response.text()}")
-                return None
-
-    @ensure_login
+        return await self.job_request("/jobs/update-iterations", "update iterations", {"job_id": job_id, "num_iterations": iterations}, idempotent=True)
+
     async def update_entropy(self, job_id: int, entropy: float):
-        headers = {"Authorization": f"Bearer {self.access_token}"}
-        data = {"job_id": job_id, "entropy": entropy}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.api_url}/jobs/update-entropy", headers=headers, data=data) as response:
-                if response.status == 200:
-                    return await response.json()
-                print(f"[Error] Failed to update entropy: {await response.text()}")
-                return None
- 
-
-    @ensure_login
-    async def get_status(self, job_id: int):
-        headers = {"Authorization": f"Bearer {self.access_token}"}
-        data = {"job_id": job_id}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.api_url}/jobs/status", headers=headers, data=data) as response:
-                if response.status == 200:
-                    return await response.json()
-                print(f"[Error] Failed to get status: {await response.text()}")
-                return None
-    
\ No newline at end of file
+        return await self.job_request("/jobs/update-entropy", "update entropy", {"job_id": job_id, "entropy": entropy}, idempotent=True)
+
+    async def get_status(self, job_id: int, check: bool = False):
+        return await self.job_request("/jobs/status", "get status", {"job_id": job_id}, check, idempotent=True)
@@ -0,0 +1,24 @@
+import random
+# Exponential backoff with jitter. Used to space out retries, so a fleet of idle or failing workers does not
+# hit the API in lockstep.
+
+class Backoff():
+    def __init__(self, base: float = 1.0, factor: float = 2.0, maximum: float = 300.0, jitter: bool = True):
+        self.base = base
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+        self.attempts = 0
+
+    def reset(self):
+        """Call after a success: the next delay starts from base again"""
+        self.attempts = 0
+
+    def next_delay(self):
+        """Delay before the next attempt. Grows by factor on every call, up to maximum."""
+        delay = min(self.maximum, self.base * self.factor ** self.attempts)
+        self.attempts += 1
+        if self.jitter:
+            # "Equal jitter": keep at least half the delay, randomize the rest
+            delay = random.uniform(delay / 2, delay)
+        return delay
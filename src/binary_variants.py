@@ -0,0 +1,119 @@
+import json
+import os
+import platform
+from dataclasses import dataclass, field
+from pathlib import Path
+# Several builds of the moe binary can live side by side in bin/ (e.g. AVX2 and AVX-512, OpenBLAS and MKL).
+# The variants are described in bin/variants.json:
+#   [{"name": "avx512-mkl", "path": "bin/moe-avx512-mkl", "requires": ["avx512f"]}, ...]
+# Without that file, bin/moe and every bin/moe-<name> are variants, and the CPU features they need are guessed
+# from the name (e.g. moe-avx2-openblas needs avx2). The worker runs the ones this CPU supports through a short
+# benchmark, and uses the fastest that works. The choice is cached until the variants or the CPU change.
+
+# Name parts that mean a CPU feature (as in the flags of /proc/cpuinfo)
+FEATURE_TOKENS = {"sse4": "sse4_2", "avx": "avx", "avx2": "avx2", "fma": "fma", "avx512": "avx512f", "neon": "asimd", "sve": "sve"}
+
+
+@dataclass
+class BinaryVariant():
+    name: str
+    path: str
+    requires: list = field(default_factory=list) # CPU features (flags) the build needs
+
+    def supported(self, flags: set):
+        return all(feature in flags for feature in self.requires)
+
+
+def cpu_flags():
+    """CPU features of this host (empty if unknown)"""
+    flags = set()
+    try:
+        with open("/proc/cpuinfo", "r") as file:
+            for line in file:
+                name, _, value = line.partition(":")
+                # "flags" on x86, "Features" on ARM
+                if name.strip() in ("flags", "Features"):
+                    flags.update(value.split())
+                    break
+    except OSError:
+        pass
+    if platform.machine() in ("arm64", "aarch64"):
+        # NEON is part of every 64 bit ARM CPU
+        flags.add("asimd")
+    return flags
+
+
+def discover(bin_folder: str = "./bin"):
+    """The variants in bin_folder, the default binary (moe) first"""
+    bin_folder = Path(bin_folder)
+    default_path = bin_folder / "moe"
+    manifest = bin_folder / "variants.json"
+    if manifest.exists():
+        with open(manifest, "r") as file:
+            return [BinaryVariant(**variant) for variant in json.load(file) if os.path.exists(variant["path"])]
+    variants = []
+    if os.path.exists(default_path):
+        variants.append(BinaryVariant("default", str(default_path)))
+    for path in sorted(bin_folder.glob("moe-*")):
+        # moe-serve and the like are not builds. A build is executable and named after what it was built for.
+        if not os.access(path, os.X_OK) or path.suffix:
+            continue
+        name = path.name.removeprefix("moe-")
+        requires = [FEATURE_TOKENS[token] for token in name.lower().split("-") if token in FEATURE_TOKENS]
+        variants.append(BinaryVariant(name, str(path), requires))
+    return variants
+
+
+def compatible(variants: list, flags: set):
+    """The variants this CPU can run. Without known flags, only those that need nothing special."""
+    return [variant for variant in variants if variant.supported(flags)]
+
+
+def load_choice(path: Path, variants: list, flags: set):
+    """The cached choice, if it was made among the same variants on the same CPU"""
+    try:
+        with open(path, "r") as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if cache.get("candidates") != candidates_key(variants) or cache.get("flags") != sorted(flags):
+        return None
+    for variant in variants:
+        if variant.name == cache.get("variant"):
+            return variant
+    return None
+
+
+def save_choice(path: Path, variant: BinaryVariant, variants: list, flags: set, results: dict):
+    with open(path, "w") as file:
+        json.dump({"variant": variant.name, "candidates": candidates_key(variants), "flags": sorted(flags), "flops": results}, file)
+
+
+def candidates_key(variants: list):
+    # Name, path, size and modification time: a rebuilt binary means a new benchmark
+    key = []
+    for variant in variants:
+        stat = os.stat(variant.path)
+        key.append([variant.name, variant.path, stat.st_size, int(stat.st_mtime)])
+    return key
+
+
+async def benchmark(variants: list, timeout: float = None):
+    """Measure every variant. Returns the fastest one that works (None if none does) and {name: flops}."""
+    # Imported here, calibration imports the process manager side of things
+    from src.calibration import measure_moe
+    from src.process_manager import ProcessManager
+    results = dict()
+    for variant in variants:
+        manager = ProcessManager(variant.path, require_executable=False)
+        manager.printing = False
+        # Nobody reads the output of the benchmark, drop it instead of queueing it
+        manager.stdout_queue = None
+        manager.stderr_queue = None
+        flops = await measure_moe(manager, timeout)
+        # A build for the wrong CPU dies with SIGILL, and one that hangs is given up on. Both count as not working.
+        results[variant.name] = flops or 0.0
+    working = [variant for variant in variants if results[variant.name] > 0]
+    if not working:
+        return None, results
+    return max(working, key=lambda variant: results[variant.name]), results
@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import tempfile
+import time
+from dataclasses import dataclass, asdict, field
+from pathlib import Path
+from src import cost_model, local_generation
+from src.cost_model import CostModel
+from src.job import Job
+# Host calibration: what this host can do, measured once and cached.
+# The profile (cores, memory, measured speed, binary build) is sent along with job requests, so the scheduler can
+# hand big channels to big hosts. The speed is measured with a short minimization by the binary, or with a NumPy
+# matrix product on hosts without one. It is measured again when the binary changes or the profile gets old.
+
+# Size of the calibration minimization
+CALIBRATION_DIMENSION = 128
+CALIBRATION_KRAUS = 4
+CALIBRATION_ITERATIONS = 20
+
+
+@dataclass
+class HostProfile():
+    cores: int
+    memory: int # Total memory in bytes (0 if unknown)
+    flops: float = 0.0 # Measured floating point operations per second (0 if not measured)
+    method: str = "none" # How flops was measured: moe, numpy or none
+    build: str = "" # sha256 prefix of the binary ("" without binary)
+    platform: str = field(default_factory=platform.platform)
+    calibrated_at: float = field(default_factory=time.time)
+
+    def params(self):
+        """Query parameters for job requests"""
+        params = {"cores": str(self.cores), "memory": str(self.memory // 2**20)}
+        if self.flops:
+            params["mflops"] = str(int(self.flops / 1e6))
+        if self.build:
+            params["build"] = self.build
+        return params
+
+
+def binary_build(executable_path: str):
+    """Short sha256 of the binary, identifies the build ("" if there is none)"""
+    try:
+        h = hashlib.sha256()
+        with open(executable_path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                h.update(block)
+        return h.hexdigest()[:12]
+    except OSError:
+        return ""
+
+
+def calibration_job():
+    return Job(job_id=0, job_type="minimize", input_dimension=CALIBRATION_DIMENSION, output_dimension=CALIBRATION_DIMENSION, number_kraus=CALIBRATION_KRAUS)
+
+
+async def measure_moe(process_manager, timeout: float = None):
+    """flops of the binary on a short minimization (None if it failed or took longer than timeout seconds)"""
+    try:
+        return await asyncio.wait_for(run_measurement(process_manager), timeout)
+    except asyncio.TimeoutError:
+        # The running process is killed on cancellation (see ProcessManager.run_process)
+        print(f"[Warning] {process_manager.executable_path} did not finish the calibration in {timeout:.0f} s")
+        return None
+
+
+async def run_measurement(process_manager):
+    with tempfile.TemporaryDirectory() as folder:
+        vector_path, kraus_path, output_path = (str(Path(folder) / name) for name in ("vector.dat", "kraus.dat", "out.dat"))
+        out = await process_manager.run_vector_generation(CALIBRATION_DIMENSION, vector_path, tag="calibration")
+        if not out or not out[0]:
+            return None
+        out = await process_manager.run_kraus_generation(CALIBRATION_DIMENSION, CALIBRATION_KRAUS, kraus_path, tag="calibration")
+        if not out or not out[0]:
+            return None
+        start = time.perf_counter()
+        out = await process_manager.run_singleshot_minimization(output_path, vector_path, kraus_path, iterations=CALIBRATION_ITERATIONS, tag="calibration")
+        elapsed = time.perf_counter() - start
+        if not out or not out[0] or elapsed <= 0:
+            return None
+    # Includes the process start, so this rather underestimates the host
+    flops_per_iteration = CostModel(flops_per_second=1.0).seconds_per_iteration(calibration_job())
+    return flops_per_iteration * CALIBRATION_ITERATIONS / elapsed
+
+
+def measure_numpy(size: int = 256, repeat: int = 3):
+    """flops of a complex matrix product with NumPy (None without NumPy)"""
+    if not local_generation.numpy_available():
+        return None
+    np = local_generation.load_numpy()
+    a = np.random.standard_normal((size, size)) + 1j * np.random.standard_normal((size, size))
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        a @ a
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return 8 * size ** 3 / best if best else None
+
+
+async def calibrate(process_manager, use_binary: bool = True, timeout: float = None):
+    """Measure this host. timeout bounds the measurement with the binary."""
+    profile = HostProfile(cores=os.cpu_count() or 1, memory=cost_model.total_memory() or 0)
+    if use_binary:
+        profile.build = binary_build(process_manager.executable_path)
+        flops = await measure_moe(process_manager, timeout)
+        if flops:
+            profile.flops, profile.method = flops, "moe"
+            return profile
+    flops = await asyncio.to_thread(measure_numpy)
+    if flops:
+        profile.flops, profile.method = flops, "numpy"
+    return profile
+
+
+def load_profile(path: Path, executable_path: str, use_binary: bool, max_age: float):
+    """The cached profile, if it still describes this host (same cores, same binary, not too old)"""
+    try:
+        with open(path, "r") as file:
+            profile = HostProfile(**json.load(file))
+    except (OSError, ValueError, TypeError):
+        return None
+    if profile.cores != (os.cpu_count() or 1) or time.time() - profile.calibrated_at > max_age:
+        return None
+    if profile.build != (binary_build(executable_path) if use_binary else ""):
+        return None
+    return profile
+
+
+def save_profile(path: Path, profile: HostProfile):
+    with open(path, "w") as file:
+        json.dump(asdict(profile), file)
@@ -8,7 +8,7 @@ class Canvas:
         self.height = 0
         self.lines = []
 
-        self.scrolling = False
+        self.scrolling = False # When full, a new line pushes out the oldest one (instead of being dropped)
 
     def from_list(self, str_list):
         # never allow more lines than max_height
@@ -36,6 +36,9 @@ class Canvas:
             self.lines[y].write_text(text, x)
 
     def add_line(self, text):
+        if self.scrolling and self.lines and self.height >= self.max_height:
+            self.lines.pop(0)
+            self.height = len(self.lines)
         if self.height < self.max_height:
             # if text is longer than width, extend the canvas
             if len(text) > self.width:
@@ -0,0 +1,75 @@
+import zlib
+# Streaming compression for .dat files on the wire.
+# gzip is always available (zlib). zstd is used if the optional zstandard package is installed.
+# Compressor / Decompressor work on pieces of data, so files never have to be held in memory.
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# In order of preference
+ENCODINGS = ["zstd", "gzip"]
+
+# Raised by Decompressor on corrupt data
+ERRORS = (zlib.error,) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def available_encodings():
+    return [encoding for encoding in ENCODINGS if encoding != "zstd" or zstandard is not None]
+
+
+def choose_encoding(accepted):
+    """Best encoding we support among those the other side accepts (None = send raw)"""
+    if not accepted:
+        return None
+    accepted = [a.strip().lower() for a in accepted]
+    for encoding in available_encodings():
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def accept_encoding_header():
+    """Value for an Accept-Encoding header"""
+    return ", ".join(available_encodings() + ["identity"])
+
+
+class Compressor():
+    def __init__(self, encoding: str, level: int = None):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self.compressor = zlib.compressobj(level if level is not None else 6, zlib.DEFLATED, 31) # 31 = gzip container
+        elif encoding == "zstd" and zstandard is not None:
+            self.compressor = zstandard.ZstdCompressor(level=level if level is not None else 3).compressobj()
+        elif encoding in (None, "identity"):
+            self.compressor = None
+        else:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+
+    def compress(self, data: bytes):
+        return self.compressor.compress(data) if self.compressor else data
+
+    def flush(self):
+        return self.compressor.flush() if self.compressor else b""
+
+
+class Decompressor():
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self.decompressor = zlib.decompressobj(31)
+        elif encoding == "zstd" and zstandard is not None:
+            self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        elif encoding in (None, "identity"):
+            self.decompressor = None
+        else:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+
+    def decompress(self, data: bytes):
+        return self.decompressor.decompress(data) if self.decompressor else data
+
+    def flush(self):
+        if self.decompressor and hasattr(self.decompressor, "flush"):
+            return self.decompressor.flush()
+        return b""
@@ -0,0 +1,83 @@
+import os
+from dataclasses import dataclass
+# Cost model of the jobs: memory footprint and time per iteration, from the dimensions in the job data.
+# Used for admission control: a job is only started if its estimate fits in the memory that is available.
+# The coefficients are rough (the binary's internals are not visible from here) and err on the large side.
+
+BYTES_PER_ENTRY = 16 # complex128
+
+
+@dataclass
+class CostModel():
+    process_overhead: int = 32 * 1024 * 1024 # Binary, libraries and buffers, independent of the channel
+    kraus_copies: float = 2.0 # The kraus operators as loaded, plus one working copy
+    matrix_workspace: float = 6.0 # N x N work matrices (output state, eigendecomposition, gradient)
+    flops_per_second: float = 1e9 # Host speed. Replace with a measured value where available.
+
+    @staticmethod
+    def dimensions(job):
+        """(input dimension, output dimension, number of kraus operators) of a job, with sane defaults"""
+        n_in = job.input_dimension or 1
+        n_out = job.output_dimension or n_in
+        return n_in, n_out, job.number_kraus or 1
+
+    def memory(self, job):
+        """Estimated peak memory of a job in bytes"""
+        n_in, n_out, d = self.dimensions(job)
+        if job.job_type == "minimize":
+            entries = self.kraus_copies * d * n_in * n_out + self.matrix_workspace * max(n_in, n_out) ** 2 + 4 * n_in
+        elif job.job_type == "generate_kraus":
+            # Ginibre matrix, its QR factors and the output
+            entries = 3 * d * n_in * n_out
+        else:
+            entries = 2 * n_in
+        return int(self.process_overhead + BYTES_PER_ENTRY * entries)
+
+    def seconds_per_iteration(self, job):
+        """Estimated time of one minimization iteration"""
+        n_in, n_out, d = self.dimensions(job)
+        # Apply the kraus operators and their adjoints (8 flops per complex multiply-add), plus the eigendecomposition
+        # of the output state for the entropy
+        flops = 8 * d * (2 * n_in * n_out + 2 * n_out ** 2) + 10 * n_out ** 3
+        return flops / self.flops_per_second
+
+    def seconds(self, job, iterations: int = 0):
+        """Estimated run time of a job (of iterations iterations, for minimizations)"""
+        n_in, n_out, d = self.dimensions(job)
+        if job.job_type == "minimize":
+            return iterations * self.seconds_per_iteration(job)
+        if job.job_type == "generate_kraus":
+            # QR decomposition of the (d * N_out) x N_in Ginibre matrix
+            return 16 * d * n_out * n_in ** 2 / self.flops_per_second
+        return 8 * n_in / self.flops_per_second
+
+
+def meminfo(key: str):
+    """A value of /proc/meminfo in bytes (None if unknown)"""
+    try:
+        with open("/proc/meminfo", "r") as file:
+            for line in file:
+                name, _, value = line.partition(":")
+                if name == key:
+                    return int(value.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def sysconf_memory(pages: str):
+    try:
+        return os.sysconf(pages) * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def available_memory():
+    """Memory that can be used without swapping, in bytes (None if unknown)"""
+    available = meminfo("MemAvailable")
+    return available if available is not None else sysconf_memory("SC_AVPHYS_PAGES")
+
+
+def total_memory():
+    total = meminfo("MemTotal")
+    return total if total is not None else sysconf_memory("SC_PHYS_PAGES")
@@ -0,0 +1,52 @@
+import struct
+# Reading and writing of the .dat files exchanged with the moe binary and the server.
+# Layout (little endian):
+#   vector file: int64 N, followed by N complex128 entries (real and imaginary part as two float64).
+#   kraus file:  int64 d (number of kraus operators), int64 N (dimension), followed by d*N*N complex128 entries,
+#                operator by operator, each operator row-major.
+# The layout is kept in this module only, so the local generators and any future readers cannot drift apart.
+# benchmarks/bench_generation.py checks it against files written by the binary.
+
+HEADER_FORMAT = "<q"
+
+
+def write_vector(path, vector):
+    """Write a complex numpy vector"""
+    import numpy as np
+    vector = np.ascontiguousarray(vector, dtype="<c16")
+    with open(path, "wb") as file:
+        file.write(struct.pack(HEADER_FORMAT, vector.shape[0]))
+        file.write(vector.tobytes())
+
+
+def read_vector(path):
+    import numpy as np
+    with open(path, "rb") as file:
+        (n,) = struct.unpack(HEADER_FORMAT, file.read(8))
+        return np.frombuffer(file.read(16 * n), dtype="<c16")
+
+
+def write_kraus(path, operators):
+    """Write a (d, N, N) complex numpy array of kraus operators"""
+    import numpy as np
+    operators = np.ascontiguousarray(operators, dtype="<c16")
+    d, n, _ = operators.shape
+    with open(path, "wb") as file:
+        file.write(struct.pack(HEADER_FORMAT, d))
+        file.write(struct.pack(HEADER_FORMAT, n))
+        file.write(operators.tobytes())
+
+
+def read_kraus(path):
+    import numpy as np
+    with open(path, "rb") as file:
+        (d,) = struct.unpack(HEADER_FORMAT, file.read(8))
+        (n,) = struct.unpack(HEADER_FORMAT, file.read(8))
+        return np.frombuffer(file.read(16 * d * n * n), dtype="<c16").reshape(d, n, n)
+
+
+def expected_size(kind: str, n: int, d: int = 1):
+    """Size in bytes of a vector or kraus file"""
+    if kind == "vector":
+        return 8 + 16 * n
+    return 16 + 16 * d * n * n
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+from collections import Counter, deque
+from pathlib import Path
+# Diagnostics of the event loop. The interface, the worker, the output parser, the pings and all HTTP traffic share
+# one asyncio loop, so anything blocking it freezes all of them.
+#  - LoopMonitor: schedules a wakeup every interval seconds and measures how late it comes (the loop lag)
+#  - log_slow_callbacks: asyncio debug mode, logs every callback that blocks the loop for too long to a file
+#  - SamplingProfiler: samples the stack of the loop thread from a side thread, written as folded stacks
+#    ("outer;inner;leaf count" per line), which flamegraph.pl and speedscope read
+
+
+class LoopMonitor():
+    def __init__(self, interval: float = 0.5, window: int = 120):
+        self.interval = interval
+        self.lags = deque(maxlen=window) # Lag of the last window wakeups, in seconds
+        self.slow_callbacks = 0 # Counted by SlowCallbackHandler
+        self.backend = None # Event loop implementation, "asyncio" or "uvloop" (see event_loop)
+
+    @property
+    def last(self):
+        return self.lags[-1] if self.lags else 0.0
+
+    @property
+    def max(self):
+        return max(self.lags, default=0.0)
+
+    @property
+    def mean(self):
+        return sum(self.lags) / len(self.lags) if self.lags else 0.0
+
+    async def run(self, on_lag=None, threshold: float = 1.0):
+        """Measure forever (cancel to stop). on_lag(lag) is awaited for lags above threshold seconds."""
+        self.backend = type(asyncio.get_running_loop()).__module__.split(".")[0]
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - expected, 0.0)
+            self.lags.append(lag)
+            if on_lag and lag > threshold:
+                await on_lag(lag)
+
+
+class SlowCallbackHandler(logging.Handler):
+    """Counts the slow callback warnings of asyncio for the monitor"""
+    def __init__(self, monitor: LoopMonitor):
+        super().__init__(logging.WARNING)
+        self.monitor = monitor
+
+    def emit(self, record):
+        if record.getMessage().startswith("Executing"):
+            self.monitor.slow_callbacks += 1
+
+
+def log_slow_callbacks(loop, path: Path, threshold: float, monitor: LoopMonitor = None):
+    """Log callbacks that run longer than threshold seconds to path (asyncio debug mode, which costs some speed)"""
+    loop.slow_callback_duration = threshold
+    loop.set_debug(True)
+    logger = logging.getLogger("asyncio")
+    logger.setLevel(logging.WARNING)
+    # To a file only, output on the terminal would garble the interface
+    logger.propagate = False
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    logger.addHandler(handler)
+    if monitor:
+        logger.addHandler(SlowCallbackHandler(monitor))
+
+
+class SamplingProfiler():
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.counts = Counter() # Stack (outermost first) -> number of samples
+        self.samples = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, thread_id: int = None):
+        """Sample the stack of thread_id (default: the calling thread, i.e. the event loop)"""
+        if self.running:
+            return
+        target = thread_id or threading.get_ident()
+        self.counts.clear()
+        self.samples = 0
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.sample, args=(target,), name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def sample(self, target: int):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.counts[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def top(self, n: int = 3):
+        """The n functions with the most samples at the top of the stack, as (function, share of the samples)"""
+        leaves = Counter()
+        for stack, count in self.counts.items():
+            leaves[stack[-1]] += count
+        return [(function, count / self.samples) for function, count in leaves.most_common(n)] if self.samples else []
+
+    def write(self, path: Path):
+        with open(path, "w") as file:
+            for stack, count in self.counts.most_common():
+                file.write(f"{';'.join(stack)} {count}\n")
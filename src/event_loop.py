@@ -0,0 +1,42 @@
+import asyncio
+import importlib.util
+import os
+# Event loop backend. uvloop (libuv based) runs the same asyncio code with less overhead per callback, which adds up
+# with several slots parsing thousands of progress lines a second and many HTTP requests. It is optional:
+#   auto    - uvloop if it is installed, otherwise the default loop
+#   uvloop  - uvloop, warn and use the default loop if it is not installed
+#   asyncio - the default loop
+# The backend is chosen with moe.py --loop, or the MOE_LOOP environment variable. See benchmarks/bench_loop.py.
+
+BACKENDS = ("auto", "uvloop", "asyncio")
+
+
+def uvloop_available():
+    return importlib.util.find_spec("uvloop") is not None
+
+
+def default_backend():
+    backend = os.environ.get("MOE_LOOP", "auto")
+    return backend if backend in BACKENDS else "auto"
+
+
+def new_event_loop(backend: str = "auto"):
+    """A new event loop of the backend, and the name of the backend it ended up with"""
+    if backend in ("auto", "uvloop"):
+        if uvloop_available():
+            import uvloop
+            return uvloop.new_event_loop(), "uvloop"
+        if backend == "uvloop":
+            print("[Warning] uvloop is not installed (pip install uvloop), using the default event loop")
+    return asyncio.new_event_loop(), "asyncio"
+
+
+def close_loop(loop):
+    """Cancel what is left running (e.g. the loop monitor) and close the loop"""
+    pending = asyncio.all_tasks(loop)
+    for task in pending:
+        task.cancel()
+    if pending:
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    loop.run_until_complete(loop.shutdown_asyncgens())
+    loop.close()
@@ -0,0 +1,175 @@
+import glob
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+# Resource governor: keeps the worker out of the way of the people using the host.
+# It samples the host (CPU load, time since the last keyboard/mouse/terminal input, battery) and decides
+# whether the running processes may use the CPU freely (run), at low priority (nice), or not at all (pause).
+# The readings use /proc and /sys on Linux. Whatever cannot be read is ignored, so elsewhere the governor just runs.
+# The load is the CPU time the host spent busy since the previous sample, minus the CPU time of the worker and its
+# processes (all their threads). The load average would still count the worker's threads for a minute after a pause.
+
+RUN = "run"
+NICE = "nice"
+PAUSE = "pause"
+
+
+@dataclass
+class GovernorConfig():
+    check_interval: float = 5.0 # Seconds between host samples
+    # Load of everything but the worker, per CPU. Above max_load the processes are paused, below resume_load they resume.
+    max_load: float = 0.75
+    resume_load: float = 0.5
+    # Input in the last user_idle_time seconds means someone is using the machine: apply user_active_action
+    user_idle_time: float = 300.0
+    user_active_action: str = NICE # run, nice or pause
+    niceness: int = 19 # Niceness of the processes in nice mode
+    pause_on_battery: bool = True
+    # Pauses longer than this are reported to the server (pause_job / resume_job)
+    report_pause_after: float = 120.0
+
+
+def load_per_cpu(own: int = 0):
+    """1 minute load average per CPU, without the own runnable processes (None if unknown)"""
+    try:
+        load = os.getloadavg()[0]
+    except (OSError, AttributeError):
+        return None
+    return max(load - own, 0.0) / (os.cpu_count() or 1)
+
+
+def clock_ticks():
+    try:
+        return os.sysconf("SC_CLK_TCK")
+    except (ValueError, OSError, AttributeError):
+        return 100
+
+
+def host_cpu_seconds():
+    """CPU seconds all CPUs spent busy since boot (None if unknown)"""
+    line = (read_value(Path("/proc/stat")) or "").split("\n")[0].split()
+    if not line or line[0] != "cpu":
+        return None
+    # user nice system idle iowait irq softirq steal (guest time is part of user)
+    ticks = [int(value) for value in line[1:9]]
+    return (sum(ticks) - ticks[3] - ticks[4]) / clock_ticks()
+
+
+def process_cpu_seconds(pid, children: bool = False):
+    """CPU seconds used by all threads of a process, with children also those of its exited children (None if unknown)"""
+    stat = read_value(Path(f"/proc/{pid}/stat"))
+    if not stat:
+        return None
+    # The fields after the command name (which may contain spaces), starting at field 3
+    fields = stat[stat.rfind(")") + 2:].split()
+    utime, stime, cutime, cstime = (int(value) for value in fields[11:15])
+    return (utime + stime + (cutime + cstime if children else 0)) / clock_ticks()
+
+
+class CpuMeter():
+    """Load of the host without the worker, per CPU, over the time between two samples"""
+    def __init__(self):
+        self.last = None
+
+    def sample(self, pids=()):
+        """pids are the worker's running processes. Exited ones count through the worker's children time."""
+        host = host_cpu_seconds()
+        own = process_cpu_seconds("self", children=True)
+        if host is not None and own is not None:
+            own += sum(seconds for seconds in map(process_cpu_seconds, pids) if seconds is not None)
+        now = (time.monotonic(), host, own)
+        last, self.last = self.last, now
+        if last is None or None in last or None in now or now[0] <= last[0]:
+            return None
+        others = (now[1] - last[1]) - (now[2] - last[2])
+        return max(others, 0.0) / (now[0] - last[0]) / (os.cpu_count() or 1)
+
+
+def user_idle_seconds():
+    """Seconds since the last keyboard, mouse or terminal input (None if unknown)"""
+    # Input devices and terminals get their access time updated when they are read, like `w` does for its IDLE column
+    latest = None
+    for pattern in ("/dev/input/event*", "/dev/pts/[0-9]*", "/dev/tty[0-9]*"):
+        for path in glob.glob(pattern):
+            try:
+                accessed = os.stat(path).st_atime
+            except OSError:
+                continue
+            latest = accessed if latest is None else max(latest, accessed)
+    if latest is None:
+        return None
+    return max(time.time() - latest, 0.0)
+
+
+def read_value(path: Path):
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+def on_battery():
+    """True on battery, False on mains, None if there is no power supply information (e.g. servers)"""
+    mains = None
+    for supply in glob.glob("/sys/class/power_supply/*"):
+        supply = Path(supply)
+        supply_type = read_value(supply / "type")
+        if supply_type == "Mains":
+            mains = bool(mains) or read_value(supply / "online") == "1"
+        elif supply_type == "Battery" and read_value(supply / "status") == "Discharging":
+            return True
+    if mains is None:
+        return None
+    return not mains
+
+
+class ResourceGovernor():
+    def __init__(self, config: GovernorConfig = GovernorConfig()):
+        self.config = config
+        self.state = RUN
+        self.reason = ""
+        self.since = time.monotonic() # When the state last changed
+        self.cpu_meter = CpuMeter()
+        self.cpu_meter.sample() # Baseline for the first update
+
+    @property
+    def paused(self):
+        return self.state == PAUSE
+
+    @property
+    def duration(self):
+        """Seconds in the current state"""
+        return time.monotonic() - self.since
+
+    def sample(self, pids=()):
+        """Read the host state. pids are the worker's running processes."""
+        load = self.cpu_meter.sample(pids)
+        if load is None:
+            # No /proc/stat: fall back to the load average, without the processes that are not frozen
+            load = load_per_cpu(0 if self.paused else len(pids))
+        return {"load": load, "idle": user_idle_seconds(), "battery": on_battery()}
+
+    def decide(self, sample: dict):
+        """State and reason for a host sample"""
+        if self.config.pause_on_battery and sample["battery"]:
+            return PAUSE, "on battery"
+        load = sample["load"]
+        # Hysteresis: once paused for load, wait until it dropped well below the limit
+        limit = self.config.resume_load if self.state == PAUSE and self.reason.startswith("host busy") else self.config.max_load
+        if load is not None and load > limit:
+            return PAUSE, f"host busy (load {load:.2f} per CPU)"
+        idle = sample["idle"]
+        if idle is not None and idle < self.config.user_idle_time and self.config.user_active_action != RUN:
+            return self.config.user_active_action, "host in use"
+        return RUN, ""
+
+    def update(self, pids=()):
+        """Sample the host and update the state. Returns whether the state changed."""
+        state, reason = self.decide(self.sample(pids))
+        self.reason = reason
+        if state == self.state:
+            return False
+        self.state = state
+        self.since = time.monotonic()
+        return True
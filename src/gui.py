@@ -3,9 +3,11 @@ from src.canvas import Canvas
 from src.menu import Menu
 from src.menu_element import MenuElement, Spacing, Title, InputField, Text
 from src.gui_element import GUIElement
+from src.log_view import LogView
 # Functionality
-from src.worker import worker
+from src.worker import Worker, WorkerConfig
 from src.api_handler import CursesError
+from src.rate_estimator import format_duration
 # Library
 import asyncio
 import curses
@@ -19,13 +21,6 @@ import datetime
 
 
 
-# TODO:
-# Probably also want to display the total time elapsed for the job
-# Maybe also have the iterations per second
-
-
-
-
 banner = [
     "   ___                _              _  _ _         ",
     "  / _ \\ _  _ __ _ _ _| |_ _  _ _ __ | || (_)_ _____ ",
@@ -40,6 +35,9 @@ options = {
 
 
 
+# The worker is built by update_screen once the first frame is drawn (setting it up touches the disk)
+worker = None
+
 # One time initialization of the banner and the menus
 banner_canvas = Canvas(max_width=60, max_height=6)
 banner_canvas.from_list(banner)
@@ -80,6 +78,9 @@ def logout_action():
     menu = logged_out_menu
     worker.api_handler.access_token = ""
     worker.api_handler.refresh_token = ""
+    # Otherwise the next start logs in again with the saved tokens
+    if worker.api_handler.token_cache:
+        worker.api_handler.token_cache.clear()
     worker.username = None
     worker.logged_in = False
 async def login_action():
@@ -96,8 +97,8 @@ quit_btn = MenuElement("Quit", links=quit_confirm)
 username_field = InputField("Username")
 password_field = InputField("Password", hidden=True)
 login_button = MenuElement("Login", action=login_action)
-start_worker_btn = MenuElement("Start worker", action=worker.start, links=worker_started_popup)
-stop_worker_btn = MenuElement("Stop worker", action=worker.stop, links=worker_stopped_popup)
+start_worker_btn = MenuElement("Start worker", action=lambda: worker.start(), links=worker_started_popup)
+stop_worker_btn = MenuElement("Stop worker", action=lambda: worker.stop(), links=worker_stopped_popup)
 
 
 # Compose the menus
@@ -206,8 +207,11 @@ stats_gui.add_element(Title("Worker status"))
 stats_gui.add_element(Spacing())
 stats_gui.add_element(Title(f"Worker is %running_status%."))
 stats_gui.add_element(Title(f"Current task: %current_task%."))
+stats_gui.add_element(Title(f"Binary: %binary%."))
 stats_gui.add_element(Spacing())
 stats_gui.add_element(Title(f"Last server update: %last_update%."))
+stats_gui.add_element(Title(f"Next job request: %next_poll%."))
+stats_gui.add_element(Title(f"Loop lag: %loop_lag%."))
 
 # Job GUI
 job_gui = GUIElement(max_width=100, max_heigh=100)
@@ -218,6 +222,10 @@ job_gui.add_element(Title(f"Current task: %current_task%."))
 job_gui.add_element(Spacing())
 job_gui.add_element(Title(f"Current entropy: %entropy%."))
 job_gui.add_element(Title(f"Current iteration: %iteration%."))
+job_gui.add_element(Spacing())
+job_gui.add_element(Title(f"Elapsed: %elapsed%, ETA: %eta%."))
+job_gui.add_element(Title(f"Speed: %rate% it/s."))
+job_gui.add_element(Title(f"Jobs in batch: %batch%."))
 
 
 # Command GUI
@@ -231,21 +239,50 @@ command_gui.add_element(Title(f"%update3%"))
 # api handler gui
 api_handler_gui = GUIElement(max_width=100, max_heigh=100)
 
+# Log panel, below the others (scrolls with the arrow and page keys while the menu is hidden). Set up with the worker.
+log_view = None
+
 
 
 
 ######################################
 #           MAIN LOOP                #
 ######################################
-async def update_screen(stdscr):
+async def update_screen(stdscr, config: WorkerConfig):
     """Main curses UI loop with async updates"""
 
-    global menu, logged_in_menu_not_running, logged_in_menu_running, logged_out_menu, current_menu, welcome_gui, stats_gui
+    global worker, log_view
 
     curses.curs_set(0)  # Hide cursor
     stdscr.nodelay(1)  # Non-blocking input
     stdscr.timeout(50)  # Refresh every 50ms (20fps, decent for a terminal)
 
+    # Show something right away, then set up the worker (folders, outbox, log, CPU features)
+    stdscr.clear()
+    stdscr.addstr(0, 0, "Starting the QuantumHive worker...")
+    stdscr.refresh()
+    worker = Worker(config)
+    log_view = LogView(worker.log)
+
+    # SIGTERM / SIGINT hand back the jobs before exiting
+    worker.install_signal_handlers()
+    # Log in with the tokens of the last run, if they are still valid. In the background, so the screen shows up right away.
+    restore_task = asyncio.create_task(worker.restore_login())
+    # Loop lag, shown in the stats (see diagnostics)
+    monitor_task = asyncio.create_task(worker.monitor_loop())
+    try:
+        await screen_loop(stdscr)
+    finally:
+        # The background tasks of the interface end with it
+        for task in (restore_task, monitor_task):
+            task.cancel()
+        await asyncio.gather(restore_task, monitor_task, return_exceptions=True)
+
+
+async def screen_loop(stdscr):
+    """Draw the screen and handle input until the user quits or a signal arrives"""
+
+    global menu, logged_in_menu_not_running, logged_in_menu_running, logged_out_menu, current_menu, welcome_gui, stats_gui
 
     # Start by initializing the screen
     height, width = stdscr.getmaxyx()
@@ -259,6 +296,10 @@ async def update_screen(stdscr):
 
 
     while True:
+        if worker.shutdown_task:
+            # A signal arrived, wait for the worker to hand back its jobs and exit
+            await worker.shutdown_task
+            return
         try:
             # Get terminal size
             height, width = stdscr.getmaxyx() # These are indexed starting from 1! Reduce them by one or risk overflow
@@ -292,7 +333,7 @@ async def update_screen(stdscr):
             # Print help screen at the bottom
             if not show_menu:
                 help_canvas = Canvas(max_width=width, max_height=height)
-                help_canvas.add_line("Press 'm' to toggle menu, 'q' to quit")
+                help_canvas.add_line("Press 'm' to toggle menu, 'p' to start / stop profiling, arrows / PgUp / PgDn to scroll the log, 'q' to quit")
                 screen.replace(help_canvas, 1, height-2)        
             
             # select the current gui and menus depending on login status
@@ -308,15 +349,25 @@ async def update_screen(stdscr):
                 welcome_gui.replace_text_occurences(f"%login_status%", "logged in")
 
                 stats_gui.reset_texts()
-                stats_gui.replace_text_occurences(f"%running_status%", "running" if worker.running else "not running")
+                stats_gui.replace_text_occurences(f"%running_status%", ("running" + (f" ({worker.governor.state}: {worker.governor.reason})" if worker.governor.reason else "")) if worker.running else "not running")
                 stats_gui.replace_text_occurences(f"%current_task%", worker.job_type if worker.has_job else "none")
+                stats_gui.replace_text_occurences(f"%binary%", worker.variant.name if worker.variant and worker.can_minimize else "none")
                 stats_gui.replace_text_occurences(f"%last_update%", f"{(datetime.datetime.now()-worker.last_checked).seconds} s")
+                stats_gui.replace_text_occurences(f"%next_poll%", f"in {max((worker.next_poll-datetime.datetime.now()).total_seconds(), 0):.0f} s" if worker.next_poll and not worker.has_job else "n/a")
+                stats_gui.replace_text_occurences(f"%loop_lag%", f"{worker.loop_monitor.last * 1000:.0f} ms, max {worker.loop_monitor.max * 1000:.0f} ms ({worker.loop_monitor.backend})")
 
                 job_gui.reset_texts()
                 job_gui.replace_text_occurences(f"%job_status%", "running" if worker.has_job else "not running")
                 job_gui.replace_text_occurences(f"%current_task%", worker.job_type if worker.has_job and worker.job_type else "none")
                 job_gui.replace_text_occurences(f"%entropy%", str(worker.current_entropy) if worker.has_job else "n/a")
                 job_gui.replace_text_occurences(f"%iteration%", str(worker.current_iterations) if worker.has_job and worker.current_iterations else "n/a")
+                job_gui.replace_text_occurences(f"%elapsed%", format_duration(worker.rate_estimator.elapsed) if worker.has_job else "n/a")
+                job_gui.replace_text_occurences(f"%eta%", format_duration(worker.eta) if worker.has_job else "n/a")
+                job_gui.replace_text_occurences(f"%batch%", str(len(worker.jobs)))
+                if worker.stalled:
+                    job_gui.replace_text_occurences(f"%rate%", "stalled, 0.00")
+                else:
+                    job_gui.replace_text_occurences(f"%rate%", f"{worker.iterations_per_second:.2f}" if worker.has_job and worker.iterations_per_second else "n/a")
 
 
 
@@ -339,12 +390,18 @@ async def update_screen(stdscr):
                 stats_gui.replace_text_occurences(f"%running_status%", "not running")
                 stats_gui.replace_text_occurences(f"%current_task%", "none")
                 stats_gui.replace_text_occurences(f"%last_update%", "n/a")
+                stats_gui.replace_text_occurences(f"%next_poll%", "n/a")
+                stats_gui.replace_text_occurences(f"%loop_lag%", f"{worker.loop_monitor.last * 1000:.0f} ms, max {worker.loop_monitor.max * 1000:.0f} ms ({worker.loop_monitor.backend})")
 
                 job_gui.reset_texts()
                 job_gui.replace_text_occurences(f"%job_status%", "not running")
                 job_gui.replace_text_occurences(f"%current_task%", "none")
                 job_gui.replace_text_occurences(f"%entropy%", "n/a")
                 job_gui.replace_text_occurences(f"%iteration%", "n/a")
+                job_gui.replace_text_occurences(f"%elapsed%", "n/a")
+                job_gui.replace_text_occurences(f"%eta%", "n/a")
+                job_gui.replace_text_occurences(f"%rate%", "n/a")
+                job_gui.replace_text_occurences(f"%batch%", "0")
 
 
                 menu = logged_out_menu
@@ -378,6 +435,12 @@ async def update_screen(stdscr):
             api_handler_gui_canvas = api_handler_gui.to_canvas(border=True)
             lll = stats_gui_canvas.width + job_gui_canvas.width + command_gui_canvas.width + 4
             screen.replace(api_handler_gui_canvas, lll, 13)
+
+            # The log fills the space between the panels and the help line, if there is any
+            log_top = 13 + max(stats_gui_canvas.height, job_gui_canvas.height, command_gui_canvas.height, api_handler_gui_canvas.height) + 1
+            log_height = height - 2 - log_top
+            if log_height >= 4:
+                screen.replace(log_view.to_canvas(width - 2, log_height), 1, log_top)
             
 
             very_long_text_gui_canvas = welcome_message_gui.to_canvas(border=False)
@@ -399,17 +462,18 @@ async def update_screen(stdscr):
                 if not show_menu:
                     if key == ord("m"):
                         toggle_menu()
+                    elif key == ord("p"):
+                        worker.toggle_profiler()
                     elif key == ord("q"):
                         raise KeyboardInterrupt()
+                    else:
+                        log_view.handle_input(key)
                 if show_menu:
                     current_menu = await current_menu.handle_input(key)
             except KeyboardInterrupt:
                 # Exit the program
-                # Await the worker to finish
-                # TODO : implement
-                if worker.task:
-                    worker.stop()
-                    await worker.task
+                # Stop the worker and hand back its jobs
+                await worker.shutdown()
                 return
         # Clear screen
             stdscr.clear()
@@ -0,0 +1,37 @@
+import asyncio
+import os
+from src.worker import Worker, WorkerConfig
+# Runs the worker without the curses interface, e.g. as a service on many hosts.
+# It logs in with the tokens saved by an earlier run (see TokenCache), or with MOE_USERNAME / MOE_PASSWORD from the
+# environment, starts working right away and hands its jobs back on SIGTERM / SIGINT.
+# run_headless returns False if the worker could not log in or stopped by itself (moe.py then exits with status 1).
+
+async def run_headless(config: WorkerConfig):
+    worker = Worker(config)
+    worker.install_signal_handlers()
+    # Loop lag warnings, and SIGUSR1 toggles a profile (see diagnostics)
+    monitor_task = asyncio.create_task(worker.monitor_loop())
+    try:
+        if not await worker.restore_login():
+            username, password = os.environ.get("MOE_USERNAME"), os.environ.get("MOE_PASSWORD")
+            if not username or not password:
+                print("[Error] Not logged in. Log in once with the interface, or set MOE_USERNAME and MOE_PASSWORD.")
+                return False
+            if not await worker.login(username, password):
+                print(f"[Error] Login failed. {worker.api_handler.status}")
+                return False
+        print(f"Logged in as {worker.username}, starting the worker")
+        worker.start()
+        # Work until a signal arrives, or the worker ends on its own
+        while worker.shutdown_task is None and not worker.task.done():
+            await asyncio.sleep(0.5)
+        if worker.shutdown_task is None:
+            # Raises what the worker crashed with
+            await worker.task
+            print("[Error] The worker stopped unexpectedly")
+            return False
+        await worker.shutdown_task
+        return True
+    finally:
+        monitor_task.cancel()
+        await asyncio.gather(monitor_task, return_exceptions=True)
@@ -0,0 +1,85 @@
+import asyncio
+import time
+from dataclasses import dataclass
+# Heartbeat scheduling for job leases.
+# Every leased job is pinged at a fraction of its lease duration (as told by the server with the job or in the ping
+# response), measured from the last successful renewal. Failed pings are retried sooner, so a few lost pings do not
+# cost the lease. Without leases nothing is scheduled at all.
+
+@dataclass
+class Lease():
+    job_id: int
+    duration: float # Seconds the server keeps the job for us without a ping
+    renewed: float # time.monotonic() of the last successful ping (or of the lease)
+    next_ping: float = 0.0
+    lost: bool = False # The server refused a ping, no more pings for this job
+
+
+class HeartbeatScheduler():
+    def __init__(self, default_duration: float = 90.0, fraction: float = 1 / 3, retry_interval: float = 5.0):
+        self.default_duration = default_duration # Used when the server does not say
+        self.fraction = fraction
+        self.retry_interval = retry_interval
+        self.leases = dict() # job_id -> Lease
+        self.changed = asyncio.Event() # Set when leases are added or removed, wakes wait()
+
+    def schedule(self, lease: Lease, now: float):
+        lease.next_ping = now + max(lease.duration * self.fraction, 1.0)
+
+    def sync(self, durations: dict):
+        """Track exactly the given {job_id: lease duration or None} leases"""
+        # Changes notified so far are covered by this sync
+        self.changed.clear()
+        now = time.monotonic()
+        for job_id in list(self.leases):
+            if job_id not in durations:
+                del self.leases[job_id]
+        for job_id, duration in durations.items():
+            if job_id not in self.leases:
+                lease = Lease(job_id, duration or self.default_duration, now)
+                self.schedule(lease, now)
+                self.leases[job_id] = lease
+
+    def renewed(self, job_id: int, duration: float = None):
+        lease = self.leases.get(job_id)
+        if lease is None:
+            return
+        now = time.monotonic()
+        lease.renewed = now
+        if duration:
+            lease.duration = duration
+        self.schedule(lease, now)
+
+    def failed(self, job_id: int, lost: bool = False):
+        lease = self.leases.get(job_id)
+        if lease is None:
+            return
+        lease.lost = lost
+        # Try again soon, but not past the expiry
+        now = time.monotonic()
+        lease.next_ping = min(now + self.retry_interval, max(lease.renewed + lease.duration - 1.0, now))
+
+    def due(self):
+        """Job ids that should be pinged now"""
+        now = time.monotonic()
+        return [lease.job_id for lease in self.leases.values() if not lease.lost and lease.next_ping <= now]
+
+    def next_due(self):
+        """Seconds until the next ping (None if there is nothing to ping)"""
+        pending = [lease.next_ping for lease in self.leases.values() if not lease.lost]
+        if not pending:
+            return None
+        return max(min(pending) - time.monotonic(), 0.0)
+
+    def notify(self):
+        self.changed.set()
+
+    async def wait(self, timeout: float = None):
+        """Sleep until the next ping is due, a lease changed (notify), or timeout"""
+        delay = self.next_due()
+        if timeout is not None:
+            delay = timeout if delay is None else min(delay, timeout)
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
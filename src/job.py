@@ -0,0 +1,67 @@
+from src.rate_estimator import RateEstimator
+from src.stopping_policy import StoppingPolicy
+from src.trajectory import Trajectory
+
+from dataclasses import dataclass, field
+
+@dataclass
+class Job():
+    job_id: int
+    job_type: str
+    job_status: str = None
+    kraus_file_id: str = None
+    vector_file_id: str = None
+    channel_id: int = None
+    number_kraus: int = None
+    input_dimension: int = None
+    output_dimension: int = None
+    target_entropy: float = None
+    lease_duration: float = None # Seconds the server keeps the job for us without a ping (None = not told)
+    memory_estimate: int = 0 # Bytes, see CostModel
+    deferred_since: float = None # time.monotonic() since when the job waits for memory to start
+
+    # Progress. These are also used to update the server!
+    current_entropy: float = None
+    current_iterations: int = 0
+    rate_estimator: RateEstimator = field(default_factory=RateEstimator)
+    trajectory: Trajectory = field(default_factory=Trajectory) # Full entropy history (downsampled), saved with the output
+    stopping_policy: StoppingPolicy = field(default_factory=StoppingPolicy)
+    early_stop_reason: str = None
+    # Stall watchdog: time.monotonic() of the process start and of the last progress line
+    started_at: float = None
+    last_progress: float = None
+    stall_reason: str = None
+    restarts: int = 0 # Restarts from the checkpoint after a stall
+    iteration_offset: int = 0 # Iterations done before the last restart (the binary counts from 0 again)
+    # The server gave the job to someone else (e.g. while we were suspended). It is dropped, its result is discarded.
+    lease_lost: bool = False
+
+    @classmethod
+    def from_dict(cls, job_dic: dict):
+        """Build a job from the response of /jobs/request"""
+        job = cls(
+            job_id=job_dic["job_id"],
+            job_type=job_dic["job_type"],
+            job_status=job_dic["job_status"],
+            kraus_file_id=job_dic["kraus_id"],
+            vector_file_id=job_dic["vector_id"],
+        )
+        job_data = job_dic["job_data"]
+        # Extract the job specific data
+        if job.job_type == "generate_kraus":
+            job.channel_id = job_data["channel_id"]
+            job.number_kraus = job_data["number_kraus"]
+            job.input_dimension = job_data["input_dimension"]
+            job.output_dimension = job_data["output_dimension"]
+        elif job.job_type == "generate_vector":
+            job.input_dimension = job_data["input_dimension"]
+            job.channel_id = job_data["channel_id"]
+        elif job.job_type == "minimize":
+            job.channel_id = job_data["channel_id"]
+            job.number_kraus = job_data["number_kraus"]
+            job.input_dimension = job_data["input_dimension"]
+            job.output_dimension = job_data["output_dimension"]
+        # The server may supply a target entropy (e.g. the best known value for the channel)
+        job.target_entropy = job_data.get("target_entropy")
+        job.lease_duration = job_dic.get("lease_duration")
+        return job
@@ -0,0 +1,17 @@
+import importlib.util
+import sys
+# Deferred imports, to keep startup fast. Heavy modules (aiohttp, aiofiles) are only loaded once they are used.
+# lazy_import returns the module object right away; its code runs on the first attribute access.
+
+def lazy_import(name: str):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
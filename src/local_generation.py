@@ -0,0 +1,115 @@
+import asyncio
+import importlib.util
+from pathlib import Path
+from src import dat_format
+# In-process generation of random starting vectors and Haar random kraus operators with NumPy.
+# This is an optional fast path for the cheapest jobs: no process is spawned, and hosts without a compiled
+# binary can still take generation jobs. NumPy is optional, check numpy_available() before use.
+# The .dat layout (see dat_format) is not specified by the binary, so verify_with_binary checks it with a round trip
+# before locally generated files are used for real jobs.
+
+np = None # Imported on first use, NumPy is slow to import
+
+
+def numpy_available():
+    return np is not None or importlib.util.find_spec("numpy") is not None
+
+
+def load_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+    return np
+
+
+def random_vector(N: int, rng=None):
+    """Uniformly (Haar) distributed unit vector in C^N"""
+    np = load_numpy()
+    rng = rng if rng is not None else np.random.default_rng()
+    vector = rng.standard_normal(N) + 1j * rng.standard_normal(N)
+    return vector / np.linalg.norm(vector)
+
+
+def haar_kraus(N: int, d: int, rng=None):
+    """
+    d kraus operators of size N x N of a Haar random channel, i.e. the blocks of a Haar random isometry C^N -> C^(d*N).
+    The operators satisfy sum_k K_k^dagger K_k = 1.
+    """
+    np = load_numpy()
+    rng = rng if rng is not None else np.random.default_rng()
+    # Ginibre matrix, then QR. Fixing the phases of the diagonal of R makes the distribution exactly Haar.
+    ginibre = rng.standard_normal((d * N, N)) + 1j * rng.standard_normal((d * N, N))
+    q, r = np.linalg.qr(ginibre)
+    phases = np.diagonal(r) / np.abs(np.diagonal(r))
+    isometry = q * phases
+    return isometry.reshape(d, N, N)
+
+
+def generate_vector_file(N: int, output_path):
+    dat_format.write_vector(output_path, random_vector(N))
+
+
+def generate_kraus_file(N: int, d: int, output_path):
+    dat_format.write_kraus(output_path, haar_kraus(N, d))
+
+
+async def verify_with_binary(process_manager, folder, N: int = 4, d: int = 2):
+    """
+    Round trip with the binary: its vector and kraus files must read back as normalized, and a minimization must
+    accept locally generated files and write a vector that reads back as well. Returns None if the formats agree,
+    otherwise what went wrong.
+    """
+    if not numpy_available():
+        return "NumPy is not installed"
+    np = load_numpy()
+    folder = Path(folder)
+    paths = {name: folder / f"verify_{name}.dat" for name in ("vector", "kraus", "local_vector", "local_kraus", "result")}
+    try:
+        for out in (await process_manager.run_vector_generation(N, str(paths["vector"]), tag="verify"),
+                    await process_manager.run_kraus_generation(N, d, str(paths["kraus"]), tag="verify")):
+            if not out or not out[0]:
+                return f"the binary could not generate test files ({out[2] if out else 'no result'})"
+        if paths["vector"].stat().st_size != dat_format.expected_size("vector", N) or paths["kraus"].stat().st_size != dat_format.expected_size("kraus", N, d):
+            return "the files of the binary have an unexpected size"
+        if abs(np.linalg.norm(dat_format.read_vector(paths["vector"])) - 1) > 1e-8:
+            return "the vector of the binary does not read as normalized"
+        operators = dat_format.read_kraus(paths["kraus"])
+        if not np.allclose(sum(k.conj().T @ k for k in operators), np.eye(N), atol=1e-8):
+            return "the kraus operators of the binary do not read as a channel"
+        await asyncio.to_thread(generate_vector_file, N, paths["local_vector"])
+        await asyncio.to_thread(generate_kraus_file, N, d, paths["local_kraus"])
+        out = await process_manager.run_singleshot_minimization(str(paths["result"]), str(paths["local_vector"]), str(paths["local_kraus"]), iterations=1, tag="verify")
+        if not out or not out[0]:
+            return f"the binary did not accept locally generated files ({out[2] if out else 'no result'})"
+        if paths["result"].stat().st_size != dat_format.expected_size("vector", N) or abs(np.linalg.norm(dat_format.read_vector(paths["result"])) - 1) > 1e-6:
+            return "the minimized vector does not read back as a normalized vector"
+    except (OSError, ValueError) as e:
+        return f"verification failed: {e}"
+    finally:
+        for path in paths.values():
+            path.unlink(missing_ok=True)
+    return None
+
+
+# Same signatures and return values as the corresponding ProcessManager methods.
+# The work runs in a thread, so large generations do not block the event loop.
+
+async def run_vector_generation(N: int, output_path):
+    if not numpy_available():
+        return False, None, "NumPy is not installed"
+    try:
+        await asyncio.to_thread(generate_vector_file, N, output_path)
+    except (OSError, ValueError) as e:
+        return False, None, f"Local vector generation failed: {e}"
+    return True, "Vector generated locally", None
+
+
+async def run_kraus_generation(N: int, d: int, output_path):
+    if not numpy_available():
+        return False, None, "NumPy is not installed"
+    try:
+        await asyncio.to_thread(generate_kraus_file, N, d, output_path)
+    except (OSError, ValueError, MemoryError) as e:
+        return False, None, f"Local kraus generation failed: {e}"
+    return True, "Kraus operators generated locally", None
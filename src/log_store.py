@@ -0,0 +1,109 @@
+import gzip
+import os
+import re
+from collections import deque
+from pathlib import Path
+# Log of the worker: its updates and all output of the binary, at constant memory however long the jobs run.
+# Lines are numbered from 0. The latest memory_lines lines are kept in memory. Once there are more, the oldest
+# segment_lines of them are written to a gzip compressed segment in the log folder ({first line}-{count}.log.gz).
+# The oldest segments are deleted to keep the folder under disk_budget bytes. Segments of earlier runs are kept
+# (flush writes out the lines in memory on shutdown), so the log continues across restarts.
+# Reading (get) only loads the lines asked for, plus the one segment they come from.
+
+SEGMENT_NAME = re.compile(r"(\d+)-(\d+)\.log\.gz$")
+
+
+class LogStore():
+    def __init__(self, folder: Path, memory_lines: int = 2000, segment_lines: int = 1000, disk_budget: int = 50 * 2**20):
+        self.folder = Path(folder)
+        self.memory_lines = max(memory_lines, segment_lines)
+        self.segment_lines = segment_lines
+        self.disk_budget = disk_budget
+        self.segments = deque() # (first line, number of lines, path, size in bytes), oldest first
+        self.recent = deque() # Lines from memory_start on
+        self.cached = None # (path, lines) of the segment read last
+        os.makedirs(self.folder, exist_ok=True)
+        self.load()
+        self.memory_start = self.segments[-1][0] + self.segments[-1][1] if self.segments else 0
+
+    def load(self):
+        """Pick up the segments of earlier runs"""
+        for path in self.folder.iterdir():
+            match = SEGMENT_NAME.match(path.name)
+            if match:
+                self.segments.append((int(match.group(1)), int(match.group(2)), path, path.stat().st_size))
+        self.segments = deque(sorted(self.segments))
+
+    @property
+    def first(self):
+        """Number of the oldest line still available"""
+        return self.segments[0][0] if self.segments else self.memory_start
+
+    @property
+    def end(self):
+        """Number of the next line"""
+        return self.memory_start + len(self.recent)
+
+    def __len__(self):
+        return self.end - self.first
+
+    @property
+    def disk_usage(self):
+        return sum(segment[3] for segment in self.segments)
+
+    def add(self, line: str):
+        self.recent.append(line.replace("\n", " "))
+        if len(self.recent) > self.memory_lines:
+            self.spill(self.segment_lines)
+
+    def spill(self, count: int):
+        # Move the oldest count lines in memory to a new segment (compressed quickly, this runs on the event loop)
+        lines = [self.recent.popleft() for _ in range(min(count, len(self.recent)))]
+        if not lines:
+            return
+        path = self.folder / f"{self.memory_start:012d}-{len(lines)}.log.gz"
+        with gzip.open(path, "wt", compresslevel=1, encoding="utf-8") as file:
+            file.write("\n".join(lines))
+        self.segments.append((self.memory_start, len(lines), path, path.stat().st_size))
+        self.memory_start += len(lines)
+        # Stay within the disk budget, the newest segment is always kept
+        while len(self.segments) > 1 and self.disk_usage > self.disk_budget:
+            _, _, old_path, _ = self.segments.popleft()
+            Path(old_path).unlink(missing_ok=True)
+
+    def flush(self):
+        """Write the lines in memory to disk, e.g. before exiting"""
+        self.spill(len(self.recent))
+
+    def get(self, start: int, count: int):
+        """Lines start to start + count (fewer at the ends of the log)"""
+        start = max(start, self.first)
+        stop = min(start + count, self.end)
+        lines = []
+        index = start
+        while index < stop:
+            if index >= self.memory_start:
+                lines.extend(self.recent[i] for i in range(index - self.memory_start, stop - self.memory_start))
+                break
+            first, length, path, _ = self.segment_of(index)
+            segment = self.read_segment(path)
+            lines.extend(segment[index - first:min(stop, first + length) - first])
+            index = first + length
+        return lines
+
+    def segment_of(self, index: int):
+        for segment in self.segments:
+            if segment[0] <= index < segment[0] + segment[1]:
+                return segment
+        raise IndexError(index)
+
+    def read_segment(self, path: Path):
+        # Scrolling reads the same segment over and over, keep the last one
+        if self.cached is None or self.cached[0] != path:
+            try:
+                with gzip.open(path, "rt", encoding="utf-8") as file:
+                    self.cached = (path, file.read().split("\n"))
+            except (OSError, EOFError):
+                # Cut short by a crash, or deleted meanwhile
+                self.cached = (path, [])
+        return self.cached[1]
@@ -0,0 +1,49 @@
+import curses
+from src.canvas import Canvas
+# Scrollable view of the log (see LogStore) for the curses interface.
+# Only the lines in the viewport are read from the log, so scrolling back through days of output is cheap.
+# Follows the end of the log until scrolled up. Keys: Up / Down, Page Up / Page Down, Home, End (follow again).
+
+class LogView():
+    def __init__(self, log_store):
+        self.log = log_store
+        self.offset = 0 # Lines scrolled up from the end of the log (0 = follow the log)
+        self.page = 10 # Number of visible lines, set when drawn
+
+    def scroll(self, lines: int):
+        self.offset = min(max(self.offset + lines, 0), max(len(self.log) - self.page, 0))
+
+    def handle_input(self, key):
+        """Scroll on the navigation keys. Returns whether the key was used."""
+        steps = {curses.KEY_UP: 1, curses.KEY_DOWN: -1, curses.KEY_PPAGE: self.page, curses.KEY_NPAGE: -self.page, curses.KEY_HOME: len(self.log), curses.KEY_END: -len(self.log)}
+        if key not in steps:
+            return False
+        self.scroll(steps[key])
+        return True
+
+    def to_canvas(self, width: int, height: int):
+        """The visible part of the log, with a border, in width x height characters"""
+        self.page = max(height - 3, 1)
+        # The log may have been cut at the front meanwhile
+        self.scroll(0)
+        end = self.log.end - self.offset
+        lines = self.log.get(end - self.page, self.page)
+        body = Canvas(max_width=width - 4, max_height=self.page)
+        body.scrolling = True
+        for line in lines:
+            body.add_line(line[:width - 4])
+        canvas = Canvas(max_width=width, max_height=height)
+        status = "following" if self.offset == 0 else "Up/Down/PgUp/PgDn to scroll, End to follow"
+        title = f" Log: lines {end - len(lines) + 1}-{end} of {self.log.end} ({status})" if lines else " Log (empty)"
+        canvas.add_line(title[:width - 2].ljust(width - 2))
+        for line in body.lines:
+            canvas.add_line(" " + line.text)
+        # Keep the size fixed, also while the log is short
+        while canvas.height < height - 2:
+            canvas.add_line("")
+        canvas.resize()
+        for line in canvas.lines:
+            line.resize(width - 2)
+        canvas.width = width - 2
+        canvas.add_border(extend=True)
+        return canvas
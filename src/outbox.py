@@ -0,0 +1,99 @@
+import json
+import os
+import time
+from dataclasses import dataclass, asdict
+from pathlib import Path
+# Durable journal of finished jobs whose results still have to be reported to the API.
+# A job enters the outbox as soon as its output is on disk, and leaves it once the server has accepted the
+# upload and the completion. The journal is rewritten atomically on every change, so it survives crashes and
+# restarts: entries left over from a previous run are delivered when the worker starts again.
+
+@dataclass
+class OutboxEntry():
+    job_id: int
+    job_type: str
+    file_type: str # "kraus" or "vector"
+    path: str # Output file to upload
+    iterations: int = 0
+    entropy: float = None
+    trajectory: str = None # Entropy trajectory to upload along with the output (None = do not upload)
+    uploaded: bool = False # The file went through, only the completion is left
+    attempts: int = 0
+
+
+class Outbox():
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.entries = dict() # job_id -> OutboxEntry, in the order they were added
+        self.load()
+
+    def load(self):
+        # A damaged journal must not keep the worker from starting. What cannot be read is set aside for inspection.
+        try:
+            with open(self.path, "r") as file:
+                items = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.set_aside(f"it cannot be read ({e})")
+            return
+        if not isinstance(items, list):
+            self.set_aside("it is not a list of entries")
+            return
+        bad = []
+        for item in items:
+            try:
+                entry = OutboxEntry(**item)
+            except TypeError:
+                bad.append(item)
+                continue
+            self.entries[entry.job_id] = entry
+        if bad:
+            aside = self.aside_path()
+            with open(aside, "w") as file:
+                json.dump(bad, file)
+            print(f"[Warning] Skipped {len(bad)} unreadable outbox entries, moved to {aside}")
+            self.save()
+
+    def aside_path(self):
+        return self.path.with_name(f"{self.path.name}.corrupt-{int(time.time())}")
+
+    def set_aside(self, reason: str):
+        aside = self.aside_path()
+        try:
+            os.replace(self.path, aside)
+        except OSError:
+            aside = None
+        print(f"[Warning] Starting with an empty outbox, {reason}" + (f". The journal was moved to {aside}" if aside else ""))
+
+    def save(self):
+        # Write a new file and rename it over the old one, so a crash never leaves a half written journal
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp_path, "w") as file:
+            json.dump([asdict(entry) for entry in self.entries.values()], file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+
+    def add(self, entry: OutboxEntry):
+        self.entries[entry.job_id] = entry
+        self.save()
+
+    def update(self, entry: OutboxEntry):
+        self.entries[entry.job_id] = entry
+        self.save()
+
+    def remove(self, job_id: int):
+        if self.entries.pop(job_id, None) is not None:
+            self.save()
+
+    @property
+    def job_ids(self):
+        return list(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        # Iterate over a copy, entries are removed while draining
+        return iter(list(self.entries.values()))
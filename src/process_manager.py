@@ -1,20 +1,42 @@
 import os
+import signal
 import asyncio
+from src.process_pool import MoeProcessPool, ProcessPoolConfig
 # Process manager is responsible for running the command line moe commands and managing the output
 
 class ProcessManager():
-    def __init__(self, executable_path: str = "./bin/moe"):
+    def __init__(self, executable_path: str = "./bin/moe", require_executable: bool = True):
         self.executable_path = executable_path
-        if not self.check_executable():
+        # Checked once, the binary does not come and go
+        self.executable_found = self.check_executable()
+        if require_executable and not self.executable_found:
             raise Exception("Executable not found")
         pass
 
         self.logging = False
         self.printing = True
+        # Output lines of the processes. Set a queue to None to discard that output (nobody reads it).
         self.stdout_queue = asyncio.Queue()
         self.stderr_queue = asyncio.Queue()
 
-        self.process = None
+        # Running processes, keyed by tag (e.g. the job id). Output lines are put in the queues as (tag, line)
+        self.processes = dict()
+        # Optional pool of warm processes for short jobs (vector and kraus generation)
+        self.pool = None
+        # Niceness of the processes, also applied to the ones started later (see renice_process)
+        self.niceness = 0
+
+    @property
+    def process(self):
+        """Any running process (None if nothing runs)"""
+        return next(iter(self.processes.values()), None)
+
+    def all_processes(self):
+        """Running processes and warm pool members (idle ones are not in processes)"""
+        processes = list(self.processes.values())
+        if self.pool:
+            processes.extend(member.process for member in self.pool.members if member.process not in processes)
+        return [process for process in processes if process.returncode is None]
     
     def check_executable(self):
         if not os.path.exists(self.executable_path):
@@ -22,23 +44,50 @@ class ProcessManager():
             return False
         return True
 
-    async def run_vector_generation(self, N: int, output_path: str):
+    def set_executable(self, executable_path: str):
+        """Switch to another build of the binary. Running processes keep the old one."""
+        self.executable_path = executable_path
+        self.executable_found = self.check_executable()
+
+    async def start_pool(self, config: ProcessPoolConfig = ProcessPoolConfig()):
+        """Start warm processes. Returns False if the binary does not support the job feed protocol."""
+        self.pool = MoeProcessPool(self.executable_path, config, self.stderr_queue, self.processes)
+        if not await self.pool.start():
+            print(f"[Warning] {self.executable_path} does not support serve mode, using one-shot exec")
+            self.pool = None
+            return False
+        return True
+
+    async def close_pool(self):
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+
+    async def run_short_process(self, command: list, tag=None):
+        # Short jobs go to a warm process if possible. If the pool cannot take the job, fall back to one-shot exec.
+        if self.pool and self.pool.available:
+            out = await self.pool.run(command[1:], tag, self.stdout_queue)
+            if out is not None:
+                return out
+        return await self.run_process(command, tag)
+
+    async def run_vector_generation(self, N: int, output_path: str, tag=None):
         command = [self.executable_path, "vector", "-N", str(N), "-o", output_path]
         if not self.printing:
             command.append("-s")
         if self.logging:
             command.append("-l")
-        return await self.run_process(command)
+        return await self.run_short_process(command, tag)
 
-    async def run_kraus_generation(self, N: int, d: int, output_path: str):
+    async def run_kraus_generation(self, N: int, d: int, output_path: str, tag=None):
         command = [self.executable_path, "kraus", "haar", "-d", str(d), "-N", str(N), "-o", output_path]
         if not self.printing:
             command.append("-s")
         if self.logging:
             command.append("-l")
-        return await self.run_process(command)
+        return await self.run_short_process(command, tag)
 
-    async def run_singleshot_minimization(self, output_path: str, vector_path: str, kraus_path: str, predict: bool = False, target_entropy: float = -1.0, iterations: int = 0, checkpointing: bool = False, checkpoint_path: str = "./checkpoint.dat", checkpoint_interval: int = 100):
+    async def run_singleshot_minimization(self, output_path: str, vector_path: str, kraus_path: str, predict: bool = False, target_entropy: float = -1.0, iterations: int = 0, checkpointing: bool = False, checkpoint_path: str = "./checkpoint.dat", checkpoint_interval: int = 100, tag=None):
         command = [self.executable_path, "singleshot", "-v", vector_path, "-k", kraus_path, "-S","-o", output_path]
         if predict and target_entropy > 0:
             command.append("-p")
@@ -59,49 +108,129 @@ class ProcessManager():
             command.append("-s")
         if self.logging:
             command.append("-l")
-        return await self.run_process(command)
+        return await self.run_process(command, tag)
 
-    async def run_process(self, command: list):
-        # Start the subprocess asynchronously
-        if not self.process:
-            self.process = await asyncio.create_subprocess_exec(
-                *command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            ) # the await simply waits for the process to be created
+    async def run_process(self, command: list, tag=None):
+        # Start the subprocess asynchronously. Several processes can run at the same time, as long as their tags differ.
+        if tag in self.processes:
+            return False, None, f"A process with tag {tag} is already running"
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True # Own process group, so kill_process also gets any children holding the pipes
+        ) # the await simply waits for the process to be created
+        self.processes[tag] = process
+        if self.niceness:
+            # Right away, so the threads the binary starts inherit it
+            self.renice(process.pid, self.niceness)
 
     # Asynchronously read stdout and stderr and put them into
-    # the respective queues
+    # the respective queues, tagged so the consumer can tell processes apart
         async def read_output():
             while True:
-                line = await self.process.stdout.readline()
+                line = await process.stdout.readline()
                 if not line:  # EOF
                     break
                 line_decoded = line.decode('utf-8').rstrip()
-                await self.stdout_queue.put(line_decoded)
+                if self.stdout_queue is not None:
+                    await self.stdout_queue.put((tag, line_decoded))
 
         async def read_error():
             while True:
-                line = await self.process.stderr.readline()
+                line = await process.stderr.readline()
                 if not line:  # EOF
                     break
                 line_decoded = line.decode('utf-8').rstrip()
-                await self.stderr_queue.put(line_decoded)
+                if self.stderr_queue is not None:
+                    await self.stderr_queue.put((tag, line_decoded))
 
-        # Run the output readers
-        await asyncio.gather(read_output(), read_error())
+        try:
+            # Run the output readers
+            await asyncio.gather(read_output(), read_error())
 
-        # Wait for the process to finish and get the return code
-        return_code = await self.process.wait()
-        # reset the process
-        self.process = None
+            # Wait for the process to finish and get the return code
+            return_code = await process.wait()
+        except asyncio.CancelledError:
+            # The caller gave up on it (e.g. a timeout), do not leave the process behind
+            self.kill_group(process)
+            raise
+        finally:
+            # reset the process
+            self.processes.pop(tag, None)
 
         # return the result
         if return_code != 0:
             return False, None, f"Process failed with return code {return_code}"
         return True, "Process completed successfully", None
     
-    def stop_process(self):
-        # Just send sigterm to the process, it should handle it
-        if self.process:
-            self.process.terminate()
+    def stop_process(self, tag=None):
+        # Just send sigterm to the process, it should handle it. Without a tag, all running processes are stopped.
+        if tag is None:
+            targets = list(self.processes.values())
+        else:
+            targets = [self.processes[tag]] if tag in self.processes else []
+        for process in targets:
+            if process.returncode is None:
+                process.terminate()
+                # A suspended process only acts on the SIGTERM once it runs again
+                process.send_signal(signal.SIGCONT)
+
+    def suspend_process(self):
+        # Freeze all running processes (SIGSTOP). They keep their state and continue after resume_process.
+        for process in list(self.processes.values()):
+            if process.returncode is None:
+                process.send_signal(signal.SIGSTOP)
+
+    def resume_process(self):
+        for process in list(self.processes.values()):
+            if process.returncode is None:
+                process.send_signal(signal.SIGCONT)
+
+    def renice_process(self, niceness: int):
+        # Set the niceness of all running processes and of those started later. Lowering it again needs privileges, so that may fail silently.
+        self.niceness = niceness
+        for process in self.all_processes():
+            self.renice(process.pid, niceness)
+
+    @staticmethod
+    def renice(pid: int, niceness: int):
+        # On Linux the niceness belongs to a thread, PRIO_PROCESS with the pid only changes the main one. Renice every thread.
+        try:
+            tids = [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+        except (OSError, ValueError):
+            tids = [pid]
+        for tid in tids:
+            try:
+                os.setpriority(os.PRIO_PROCESS, tid, niceness)
+            except (OSError, AttributeError):
+                pass
+
+    def kill_process(self, tag=None):
+        # Last resort, for processes that did not exit after stop_process
+        targets = list(self.processes.values()) if tag is None else [self.processes[tag]] if tag in self.processes else []
+        for process in targets:
+            self.kill_group(process)
+
+    @staticmethod
+    def kill_group(process):
+        if process.returncode is not None:
+            return
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except PermissionError:
+            process.kill()
+        except ProcessLookupError:
+            pass
+
+    async def terminate_process(self, tag, grace: float = 10.0):
+        # SIGTERM (the binary saves its state), then SIGKILL if it is still there after grace seconds.
+        # A hung process may not get to handle the SIGTERM.
+        process = self.processes.get(tag)
+        if process is None:
+            return
+        self.stop_process(tag)
+        try:
+            await asyncio.wait_for(process.wait(), timeout=grace)
+        except asyncio.TimeoutError:
+            self.kill_group(process)
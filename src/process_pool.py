@@ -0,0 +1,248 @@
+import asyncio
+import json
+import signal
+from dataclasses import dataclass
+# The process pool keeps warm moe processes alive and feeds them jobs over stdin, so short jobs do not pay for
+# exec, dynamic linking and BLAS initialization every time.
+#
+# Job feed protocol (moe serve):
+#   - The pool starts "moe serve". The binary answers with a control line once it is ready.
+#   - A job is one JSON line on stdin: {"id": 1, "argv": ["vector", "-N", "4", "-o", "out.dat"]}, where argv is
+#     exactly what would follow the executable in a one-shot call.
+#   - While running a job, the binary prints its usual output. When done, it prints a control line with the exit code.
+#   - {"id": 0, "argv": ["ping"]} is answered with a pong control line (health check).
+#   - Control lines start with CONTROL_PREFIX followed by JSON: {"event": "ready"}, {"event": "done", "id": 1, "code": 0}
+#     and {"event": "pong"}.
+# A binary without serve support exits or stays silent. The pool then reports itself unsupported and the process
+# manager falls back to one-shot exec.
+# A busy process is registered in processes (ProcessManager.processes) under the tag of its job, so it can be stopped,
+# paused, reniced and watched like a one-shot one.
+
+CONTROL_PREFIX = "@@moe "
+
+@dataclass
+class ProcessPoolConfig():
+    size : int = 1 # Number of warm processes
+    max_jobs_per_process : int = 100 # Processes are recycled after this many jobs
+    startup_timeout : float = 5.0 # Seconds to wait for the ready line
+    job_timeout : float = 600.0 # Seconds a single pooled job may take
+    health_check_interval : float = 30.0 # Seconds between pings of idle processes
+    health_check_timeout : float = 5.0
+
+
+class PooledProcess():
+    def __init__(self, process):
+        self.process = process
+        self.jobs_done = 0
+        self.tag = None # Tag of the job it runs, None while idle
+        self.stderr_task = None
+
+    @property
+    def alive(self):
+        return self.process.returncode is None
+
+    async def read_control(self, timeout: float, stdout_queue: asyncio.Queue = None, tag=None):
+        """Read lines until a control line arrives. Other lines are forwarded to stdout_queue. Returns None on EOF or timeout."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                line = await asyncio.wait_for(self.process.stdout.readline(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return None
+            if not line: # EOF, the process died
+                return None
+            line_decoded = line.decode('utf-8').rstrip()
+            if line_decoded.startswith(CONTROL_PREFIX):
+                try:
+                    return json.loads(line_decoded[len(CONTROL_PREFIX):])
+                except json.JSONDecodeError:
+                    continue
+            if stdout_queue is not None:
+                await stdout_queue.put((tag, line_decoded))
+
+    async def send(self, job_id: int, argv: list):
+        self.process.stdin.write((json.dumps({"id": job_id, "argv": [str(a) for a in argv]}) + "\n").encode('utf-8'))
+        await self.process.stdin.drain()
+
+    async def kill(self):
+        if self.alive:
+            self.process.kill()
+        await self.process.wait()
+        if self.stderr_task:
+            self.stderr_task.cancel()
+            try:
+                await self.stderr_task
+            except asyncio.CancelledError:
+                pass
+
+
+class MoeProcessPool():
+    def __init__(self, executable_path: str, config: ProcessPoolConfig = ProcessPoolConfig(), stderr_queue: asyncio.Queue = None, processes: dict = None):
+        self.executable_path = executable_path
+        self.config = config
+        self.stderr_queue = stderr_queue
+        self.processes = processes if processes is not None else dict() # tag -> process of the busy members
+
+        self.supported = None # None until start() has probed the binary
+        self.idle = asyncio.Queue()
+        self.members = []
+        self.next_id = 1
+        self.health_task = None
+        self.restarts = 0
+
+    @property
+    def available(self):
+        return bool(self.supported)
+
+    async def spawn(self):
+        """Start one warm process. Returns None if the binary does not speak the protocol."""
+        try:
+            process = await asyncio.create_subprocess_exec(
+                self.executable_path, "serve",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True # Own process group, like one-shot processes (see ProcessManager.kill_group)
+            )
+        except OSError:
+            return None
+        member = PooledProcess(process)
+        control = await member.read_control(self.config.startup_timeout)
+        if not control or control.get("event") != "ready":
+            await member.kill()
+            return None
+        member.stderr_task = asyncio.create_task(self.forward_stderr(member))
+        self.members.append(member)
+        return member
+
+    async def forward_stderr(self, member: PooledProcess):
+        while True:
+            line = await member.process.stderr.readline()
+            if not line:
+                break
+            if self.stderr_queue is not None:
+                await self.stderr_queue.put((member.tag, line.decode('utf-8').rstrip()))
+
+    async def start(self):
+        """Start the warm processes. Returns False (and leaves the pool unavailable) if the binary has no serve mode."""
+        for _ in range(self.config.size):
+            member = await self.spawn()
+            if not member:
+                break
+            await self.idle.put(member)
+        self.supported = len(self.members) > 0
+        if self.supported:
+            self.health_task = asyncio.create_task(self.health_check_loop())
+        return self.supported
+
+    async def replace(self, member: PooledProcess):
+        """Kill a process and put a fresh one in its place"""
+        await member.kill()
+        if member in self.members:
+            self.members.remove(member)
+        self.restarts += 1
+        new_member = await self.spawn()
+        if new_member:
+            await self.idle.put(new_member)
+        elif not self.members:
+            # We lost every process and cannot start new ones, fall back to one-shot exec
+            self.supported = False
+
+    async def acquire(self):
+        """An idle process, or None once the pool has none left (every process died and none could be started)"""
+        while self.available:
+            try:
+                return await asyncio.wait_for(self.idle.get(), timeout=1.0)
+            except asyncio.TimeoutError:
+                continue
+        return None
+
+    async def run(self, argv: list, tag=None, stdout_queue: asyncio.Queue = None):
+        """
+        Run one job on a warm process. Returns the same (success, message, error) tuple as ProcessManager.run_process,
+        or None if the job could not be run on the pool (the caller should then use one-shot exec).
+        """
+        if not self.available or tag in self.processes:
+            return None
+        member = await self.acquire()
+        if member is None:
+            return None
+        if not member.alive:
+            await self.replace(member)
+            return None
+        job_id = self.next_id
+        self.next_id += 1
+        member.tag = tag
+        self.processes[tag] = member.process
+        try:
+            await member.send(job_id, argv)
+            control = await member.read_control(self.config.job_timeout, stdout_queue, tag)
+        except (BrokenPipeError, ConnectionResetError):
+            control = None
+        except asyncio.CancelledError:
+            # The caller gave up on the job (e.g. a timeout). The process may still be working on it, so it cannot be reused.
+            await self.replace(member)
+            raise
+        finally:
+            self.processes.pop(tag, None)
+            member.tag = None
+        if not control or control.get("event") != "done" or control.get("id") != job_id:
+            try:
+                return_code = await asyncio.wait_for(member.process.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                return_code = None # Still running: hung or protocol error
+            await self.replace(member)
+            if return_code in (-signal.SIGTERM, -signal.SIGKILL):
+                # Stopped on purpose (stop_process, the watchdog, a shutdown), the job must not run again
+                return False, None, f"Process failed with return code {return_code}"
+            # Crash, hang or protocol error. Let the caller retry in one-shot mode.
+            return None
+        member.jobs_done += 1
+        if member.jobs_done >= self.config.max_jobs_per_process:
+            await self.replace(member)
+        else:
+            await self.idle.put(member)
+        return_code = control.get("code", 0)
+        if return_code != 0:
+            return False, None, f"Process failed with return code {return_code}"
+        return True, "Process completed successfully", None
+
+    async def health_check_loop(self):
+        while self.available:
+            await asyncio.sleep(self.config.health_check_interval)
+            # Only idle processes are checked, busy ones are obviously working. run() may take some of them while
+            # earlier ones are checked, then the sweep ends early.
+            for _ in range(self.idle.qsize()):
+                try:
+                    member = self.idle.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                healthy = False
+                if member.alive:
+                    try:
+                        await member.send(0, ["ping"])
+                        control = await member.read_control(self.config.health_check_timeout)
+                        healthy = bool(control) and control.get("event") == "pong"
+                    except (BrokenPipeError, ConnectionResetError):
+                        healthy = False
+                if healthy:
+                    await self.idle.put(member)
+                else:
+                    await self.replace(member)
+
+    async def close(self):
+        self.supported = False
+        if self.health_task:
+            self.health_task.cancel()
+        for member in list(self.members):
+            if member.alive:
+                try:
+                    member.process.stdin.close()
+                except OSError:
+                    pass
+            await member.kill()
+        self.members = []
@@ -0,0 +1,117 @@
+import time
+from collections import deque
+# The rate estimator keeps a rolling window of (time, iteration, entropy) samples of a running minimization.
+# From the window it estimates the iterations per second, the slope of the entropy (per iteration) and an ETA
+# to either a target entropy or an iteration cap.
+
+class RateEstimator():
+    def __init__(self, window: int = 50):
+        self.window = window
+        self.samples = deque(maxlen=window) # (timestamp, iteration, entropy)
+        self.start_time = None
+
+    def reset(self):
+        """Forget all samples, e.g. when a new job starts"""
+        self.samples.clear()
+        self.start_time = None
+
+    def add(self, iteration: int, entropy: float, timestamp: float = None):
+        """Add a parsed progress line to the window"""
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        if self.start_time is None:
+            self.start_time = timestamp
+        # Ignore repeated or out of order iterations, they carry no rate information
+        if self.samples and iteration <= self.samples[-1][1]:
+            return
+        self.samples.append((timestamp, iteration, entropy))
+
+    @property
+    def iteration(self):
+        """Last seen iteration (0 if none)"""
+        return self.samples[-1][1] if self.samples else 0
+
+    @property
+    def entropy(self):
+        """Last seen entropy (None if none)"""
+        return self.samples[-1][2] if self.samples else None
+
+    @property
+    def full(self):
+        """True once the rolling window holds window samples"""
+        return len(self.samples) == self.window
+
+    @property
+    def elapsed(self):
+        """Seconds since the first sample"""
+        if self.start_time is None:
+            return 0.0
+        return time.monotonic() - self.start_time
+
+    @property
+    def iterations_per_second(self):
+        if len(self.samples) < 2:
+            return None
+        t0, i0, _ = self.samples[0]
+        t1, i1, _ = self.samples[-1]
+        if t1 <= t0:
+            return None
+        return (i1 - i0) / (t1 - t0)
+
+    @property
+    def entropy_slope(self):
+        """Least squares slope of the entropy per iteration over the window (negative while converging)"""
+        if len(self.samples) < 2:
+            return None
+        n = len(self.samples)
+        mean_i = sum(s[1] for s in self.samples) / n
+        mean_e = sum(s[2] for s in self.samples) / n
+        var_i = sum((s[1] - mean_i) ** 2 for s in self.samples)
+        if var_i == 0:
+            return None
+        cov = sum((s[1] - mean_i) * (s[2] - mean_e) for s in self.samples)
+        return cov / var_i
+
+    def iterations_to_target(self, target_entropy: float):
+        """Extrapolated number of iterations until the target entropy is reached, None if it is not reachable at the current slope"""
+        slope = self.entropy_slope
+        if not self.samples or slope is None:
+            return None
+        _, _, entropy = self.samples[-1]
+        if entropy <= target_entropy:
+            return 0
+        if slope >= 0:
+            return None
+        return (target_entropy - entropy) / slope
+
+    def eta(self, target_entropy: float = None, max_iterations: int = 0):
+        """
+        Seconds until the job finishes, either by reaching the target entropy or the iteration cap (whichever comes first).
+        Returns None if no estimate is possible.
+        """
+        rate = self.iterations_per_second
+        if not rate or rate <= 0:
+            return None
+        remaining = []
+        if target_entropy is not None:
+            to_target = self.iterations_to_target(target_entropy)
+            if to_target is not None:
+                remaining.append(to_target)
+        if max_iterations and max_iterations > 0:
+            remaining.append(max(max_iterations - self.samples[-1][1], 0))
+        if not remaining:
+            return None
+        return min(remaining) / rate
+
+    def is_stalled(self, timeout: float):
+        """True if no new iteration has been seen for more than timeout seconds"""
+        if not self.samples:
+            return False
+        return time.monotonic() - self.samples[-1][0] > timeout
+
+
+def format_duration(seconds):
+    """Format a number of seconds as h:mm:ss (or n/a)"""
+    if seconds is None:
+        return "n/a"
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{(seconds % 3600) // 60:02d}:{seconds % 60:02d}"
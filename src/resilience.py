@@ -0,0 +1,128 @@
+import asyncio
+import time
+from src.lazy_import import lazy_import
+# Error classification and the circuit breaker used by the request layer of the APIHandler.
+#
+# Every failed API call ends up as one of these errors:
+#   TransientAPIError: the API could not be reached, timed out, or answered 5xx / 429. Worth retrying.
+#                      safe=True means the request was certainly not processed (e.g. connection refused, 503),
+#                      so even non idempotent requests may be retried.
+#   AuthError:         401 that a token refresh could not fix. The user needs to log in again.
+#   RequestError:      any other 4xx. Retrying will not help.
+#   CircuitOpenError:  the circuit breaker is open, the request was not even attempted.
+#   TokenRefreshedError: a 401 after which the access token was refreshed. Sent again right away, and not counted
+#                      as a failure by the circuit breaker (the API answered).
+
+
+aiohttp = lazy_import("aiohttp")
+
+
+class APIError(Exception):
+    def __init__(self, message: str, status: int = None, retry_after: float = None):
+        self.message = message
+        self.status = status
+        self.retry_after = retry_after
+        super().__init__(message)
+
+    def retryable(self, idempotent: bool):
+        return False
+
+
+class TransientAPIError(APIError):
+    def __init__(self, message: str, status: int = None, retry_after: float = None, safe: bool = False):
+        super().__init__(message, status, retry_after)
+        self.safe = safe
+
+    def retryable(self, idempotent: bool):
+        return self.safe or idempotent
+
+
+class AuthError(APIError):
+    pass
+
+
+class RequestError(APIError):
+    pass
+
+
+class CircuitOpenError(APIError):
+    pass
+
+
+class TokenRefreshedError(TransientAPIError):
+    def __init__(self):
+        super().__init__("Access token refreshed", 401, retry_after=0, safe=True)
+
+
+def classify_status(status: int, text: str, retry_after: float = None):
+    """Error for an unexpected HTTP status"""
+    message = f"HTTP {status}: {text[:200]}"
+    if status in (429, 503):
+        # The server explicitly refused to handle the request
+        return TransientAPIError(message, status, retry_after, safe=True)
+    if status >= 500:
+        return TransientAPIError(message, status, retry_after)
+    if status == 401:
+        return AuthError(message, status)
+    return RequestError(message, status)
+
+
+def classify_exception(error: Exception):
+    """Error for an exception raised by aiohttp"""
+    if isinstance(error, aiohttp.ClientConnectorError):
+        # We never got to send the request
+        return TransientAPIError(f"Cannot reach the API: {error}", safe=True)
+    if isinstance(error, asyncio.TimeoutError):
+        return TransientAPIError("Request timed out")
+    return TransientAPIError(f"Connection error: {error}")
+
+
+class CircuitBreaker():
+    """
+    Counts consecutive transient failures. After failure_threshold of them the circuit opens: requests fail fast for
+    reset_timeout seconds. Then exactly one trial request is let through (half open), the others keep failing fast
+    until it is done. Success closes the circuit, failure opens it again.
+    Every allowed request must end in record_success, record_failure or release.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False # The half open trial request is under way
+
+    @property
+    def is_open(self):
+        """True while requests are refused (not during the half open trial)"""
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
+
+    @property
+    def remaining(self):
+        """Seconds until the next trial request is allowed"""
+        if self.opened_at is None:
+            return 0.0
+        return max(self.reset_timeout - (time.monotonic() - self.opened_at), 0.0)
+
+    def allow_request(self):
+        if self.opened_at is None:
+            return True
+        if self.is_open or self.trial:
+            return False
+        self.trial = True
+        return True
+
+    def release(self):
+        """An allowed request ended without telling anything about the API (e.g. it was cancelled)"""
+        self.trial = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def record_failure(self):
+        self.trial = False
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            # (Re)open. In half open state a single failure is enough.
+            self.opened_at = time.monotonic()
@@ -0,0 +1,75 @@
+from src.rate_estimator import RateEstimator
+# Stopping policies decide whether a running minimization should be terminated early.
+# The worker calls check() after every parsed progress line. A policy returns None to keep going,
+# or a short reason string to stop the process, upload the current vector and report the job.
+# Custom policies subclass StoppingPolicy and are assigned to Worker.stopping_policy.
+
+class StoppingPolicy():
+    """Base policy: never stops a job"""
+    def __init__(self):
+        self.target_entropy = None
+
+    def reset(self, target_entropy: float = None):
+        """Called when a new job starts, with the server supplied target entropy (if any)"""
+        self.target_entropy = target_entropy
+
+    def check(self, estimator: RateEstimator):
+        return None
+
+
+class PlateauPolicy(StoppingPolicy):
+    """Stop when the entropy improvement per iteration drops below a threshold while still far above the target"""
+    def __init__(self, min_iterations: int = 1000, min_improvement: float = 1e-7, margin: float = 1e-3):
+        super().__init__()
+        self.min_iterations = min_iterations
+        self.min_improvement = min_improvement
+        self.margin = margin
+
+    def check(self, estimator: RateEstimator):
+        # Give the minimization some time and a full window before judging it
+        if estimator.iteration < self.min_iterations or not estimator.full:
+            return None
+        # If we know where the job should end up, only stop jobs that plateaued far above it
+        if self.target_entropy is not None and estimator.entropy <= self.target_entropy + self.margin:
+            return None
+        slope = estimator.entropy_slope
+        if slope is not None and -slope < self.min_improvement:
+            return f"Entropy plateaued at {estimator.entropy} (improvement {-slope:.2e}/it)"
+        return None
+
+
+class UnreachableTargetPolicy(StoppingPolicy):
+    """Stop when the target entropy cannot be reached within the given number of iterations at the current slope"""
+    def __init__(self, min_iterations: int = 1000, horizon: int = 100000):
+        super().__init__()
+        self.min_iterations = min_iterations
+        self.horizon = horizon
+
+    def check(self, estimator: RateEstimator):
+        if self.target_entropy is None:
+            return None
+        if estimator.iteration < self.min_iterations or not estimator.full:
+            return None
+        remaining = estimator.iterations_to_target(self.target_entropy)
+        if remaining is None or remaining > self.horizon:
+            return f"Target entropy {self.target_entropy} unreachable from {estimator.entropy}"
+        return None
+
+
+class CombinedPolicy(StoppingPolicy):
+    """Stop as soon as any of the policies wants to stop"""
+    def __init__(self, *policies: StoppingPolicy):
+        super().__init__()
+        self.policies = list(policies)
+
+    def reset(self, target_entropy: float = None):
+        super().reset(target_entropy)
+        for policy in self.policies:
+            policy.reset(target_entropy)
+
+    def check(self, estimator: RateEstimator):
+        for policy in self.policies:
+            reason = policy.check(estimator)
+            if reason:
+                return reason
+        return None
@@ -0,0 +1,26 @@
+import time
+# Detects that the machine was suspended (laptop sleep, VM pause, SIGSTOP).
+# The monotonic clock stops while the machine sleeps (and a stopped process does not run at all), but wall clock time
+# keeps going. Comparing the two between regular checks shows how long we were away.
+
+class SuspendDetector():
+    def __init__(self, interval: float = 5.0, threshold: float = 30.0):
+        self.interval = interval # Expected seconds between calls to check
+        self.threshold = threshold # Unaccounted seconds that count as a suspend
+        self.reset()
+
+    def reset(self):
+        self.last_wall = time.time()
+        self.last_monotonic = time.monotonic()
+
+    def check(self):
+        """Call every interval seconds. Returns the seconds we were suspended since the last call, or None."""
+        wall, monotonic = time.time(), time.monotonic()
+        wall_delta = wall - self.last_wall
+        monotonic_delta = monotonic - self.last_monotonic
+        self.last_wall, self.last_monotonic = wall, monotonic
+        # Time the monotonic clock missed (sleep), or a check that came far too late (stopped, or frozen VM)
+        gap = max(wall_delta - monotonic_delta, monotonic_delta - self.interval)
+        if gap >= self.threshold:
+            return gap
+        return None
@@ -0,0 +1,73 @@
+import json
+import os
+import stat
+import uuid
+from pathlib import Path
+# On-disk cache of the API tokens, so a restarted worker is logged in right away (no password, no /auth/login).
+# The file is only readable by the owner. Only tokens are stored, never the password.
+# It lives in a folder of its own that only the owner may enter, as the data folder is world writable. The folder is
+# opened once without following symlinks and checked, then the file is read and written relative to that handle,
+# so nobody else can plant, swap or read the file, not even by renaming the folder in between.
+
+class TokenCache():
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def open_folder(self):
+        """Descriptor of the folder of the cache (created if needed), or None if it is not private to us"""
+        folder = self.path.parent
+        try:
+            os.makedirs(folder, mode=0o700, exist_ok=True)
+            fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+        except OSError:
+            return None
+        info = os.fstat(fd)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+            os.close(fd)
+            return None
+        if info.st_mode & 0o077:
+            os.fchmod(fd, 0o700)
+        return fd
+
+    def load(self):
+        """The saved session ({"api_url", "username", "access_token", "refresh_token"}), or None"""
+        folder = self.open_folder()
+        if folder is None:
+            return None
+        try:
+            fd = os.open(self.path.name, os.O_RDONLY | os.O_NOFOLLOW, dir_fd=folder)
+            with os.fdopen(fd, "r") as file:
+                session = json.load(file)
+        except (OSError, ValueError):
+            return None
+        finally:
+            os.close(folder)
+        if not session.get("refresh_token"):
+            return None
+        return session
+
+    def save(self, api_url: str, username: str, access_token: str, refresh_token: str):
+        session = {"api_url": api_url, "username": username, "access_token": access_token, "refresh_token": refresh_token}
+        folder = self.open_folder()
+        if folder is None:
+            print(f"[Warning] Not saving the login: {self.path.parent} is not a private folder")
+            return
+        # A new file (O_EXCL) with owner-only permissions from the start, swapped in atomically
+        tmp_name = f"{self.path.name}.{uuid.uuid4().hex}.tmp"
+        try:
+            fd = os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600, dir_fd=folder)
+            try:
+                with os.fdopen(fd, "w") as file:
+                    json.dump(session, file)
+                os.replace(tmp_name, self.path.name, src_dir_fd=folder, dst_dir_fd=folder)
+            except BaseException:
+                os.unlink(tmp_name, dir_fd=folder)
+                raise
+        finally:
+            os.close(folder)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,98 @@
+import struct
+import sys
+import time
+from array import array
+from pathlib import Path
+# Entropy trajectory of a minimization: (iteration, entropy, seconds since start) of every progress line.
+# Memory is bounded: once capacity points are stored, every second point is dropped and from then on only every
+# stride-th iteration is recorded (stride doubles each time). The first and the latest point are always kept.
+# Saved as a small binary sidecar next to the job output ({job_id}_trajectory.dat):
+#   header "<4sHIII": magic b"MOET", version, number of points, stride, 0 (reserved), then the arrays
+#   iterations (int64), entropies (float64) and times (float32), all little endian.
+
+MAGIC = b"MOET"
+VERSION = 1
+HEADER = struct.Struct("<4sHIII")
+
+
+class Trajectory():
+    def __init__(self, capacity: int = 4096):
+        self.capacity = max(capacity, 2)
+        self.stride = 1
+        self.iterations = array("q")
+        self.entropies = array("d")
+        self.times = array("f")
+        self.start_time = None
+        self.last = None # Latest point, also if the stride skipped it
+
+    def __len__(self):
+        return len(self.iterations) + (1 if self.pending else 0)
+
+    @property
+    def pending(self):
+        """True if the latest point is not in the arrays"""
+        return self.last is not None and (not self.iterations or self.last[0] != self.iterations[-1])
+
+    def add(self, iteration: int, entropy: float, timestamp: float = None):
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        if self.start_time is None:
+            self.start_time = timestamp
+        # The iterations only go forward (a restart from a checkpoint repeats some, those are not recorded again)
+        if self.last is not None and iteration <= self.last[0]:
+            return
+        self.last = (iteration, entropy, timestamp - self.start_time)
+        if self.iterations and iteration % self.stride != 0:
+            return
+        self.append(*self.last)
+        if len(self.iterations) >= self.capacity:
+            self.downsample()
+
+    def append(self, iteration: int, entropy: float, seconds: float):
+        self.iterations.append(iteration)
+        self.entropies.append(entropy)
+        self.times.append(seconds)
+
+    def downsample(self):
+        # Keep the first point and every second one after it, and record half as often from now on
+        self.iterations = self.iterations[::2]
+        self.entropies = self.entropies[::2]
+        self.times = self.times[::2]
+        self.stride *= 2
+
+    def points(self):
+        """All recorded points as (iteration, entropy, seconds), including the latest one"""
+        points = list(zip(self.iterations, self.entropies, self.times))
+        if self.pending:
+            points.append(self.last)
+        return points
+
+    def save(self, path: Path):
+        iterations, entropies, times = array("q", self.iterations), array("d", self.entropies), array("f", self.times)
+        if self.pending:
+            iterations.append(self.last[0])
+            entropies.append(self.last[1])
+            times.append(self.last[2])
+        if sys.byteorder != "little":
+            for values in (iterations, entropies, times):
+                values.byteswap()
+        with open(path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, VERSION, len(iterations), self.stride, 0))
+            file.write(iterations.tobytes())
+            file.write(entropies.tobytes())
+            file.write(times.tobytes())
+
+    @classmethod
+    def load(cls, path: Path):
+        with open(path, "rb") as file:
+            magic, version, count, stride, _ = HEADER.unpack(file.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a trajectory file")
+            trajectory = cls(capacity=max(2 * count, 2))
+            trajectory.stride = stride
+            for values in (trajectory.iterations, trajectory.entropies, trajectory.times):
+                values.frombytes(file.read(count * values.itemsize))
+                if sys.byteorder != "little":
+                    values.byteswap()
+        if count:
+            trajectory.last = (trajectory.iterations[-1], trajectory.entropies[-1], trajectory.times[-1])
+        return trajectory
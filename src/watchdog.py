@@ -0,0 +1,56 @@
+import time
+from dataclasses import dataclass
+from src.cost_model import CostModel
+# Stall watchdog: decides when a running process of a job is hung.
+# A minimization prints a progress line every iteration. If none came for a while, the binary is stuck (deadlock,
+# livelock, a wedged filesystem...). Any job is also hung if it runs far longer than its size allows.
+# The limits are per job, scaled with the cost model's estimate, so big channels get more time than small ones.
+
+@dataclass
+class WatchdogConfig():
+    stall_timeout : float = 600.0 # Seconds without a progress line before a minimization is stalled
+    stall_factor : float = 50.0 # ... or this many times the estimated time per iteration, if that is longer
+    max_runtime : float = 0.0 # Run time limit of minimizations without an iteration cap (0 = no limit)
+    runtime_factor : float = 10.0 # Jobs of known length may take this many times their estimate (plus stall_timeout)
+
+
+class StallWatchdog():
+    def __init__(self, config: WatchdogConfig = WatchdogConfig(), cost_model: CostModel = None):
+        self.config = config
+        self.cost_model = cost_model or CostModel()
+
+    def stall_limit(self, job):
+        """Seconds a job may go without progress (None for jobs that print no progress)"""
+        if job.job_type != "minimize":
+            return None
+        return max(self.config.stall_timeout, self.config.stall_factor * self.cost_model.seconds_per_iteration(job))
+
+    def runtime_limit(self, job, max_iterations: int = 0):
+        """Seconds a job may run in total (None = no limit)"""
+        if job.job_type == "minimize" and max_iterations <= 0:
+            return self.config.max_runtime or None
+        iterations = max(max_iterations - job.iteration_offset, 0)
+        return self.config.stall_timeout + self.config.runtime_factor * self.cost_model.seconds(job, iterations)
+
+    def check(self, job, max_iterations: int = 0, now: float = None):
+        """Why the job is hung, or None if it is fine (or not running)"""
+        if job.started_at is None:
+            return None
+        now = time.monotonic() if now is None else now
+        limit = self.stall_limit(job)
+        last_progress = job.last_progress or job.started_at
+        if limit is not None and now - last_progress > limit:
+            return f"no progress for {now - last_progress:.0f} s"
+        limit = self.runtime_limit(job, max_iterations)
+        if limit is not None and now - job.started_at > limit:
+            return f"running for {now - job.started_at:.0f} s, limit {limit:.0f} s"
+        return None
+
+    @staticmethod
+    def shift(jobs, seconds: float):
+        """Do not count seconds in which the jobs could not run (e.g. paused by the governor)"""
+        for job in jobs:
+            if job.started_at is not None:
+                job.started_at += seconds
+            if job.last_progress is not None:
+                job.last_progress += seconds
@@ -1,24 +1,52 @@
 from src.api_handler import APIHandler
+from src.resilience import APIError, RequestError, AuthError
 from src.process_manager import ProcessManager
+from src.rate_estimator import RateEstimator, format_duration
+from src.stopping_policy import StoppingPolicy, PlateauPolicy, UnreachableTargetPolicy, CombinedPolicy
+from src.job import Job
+from src.trajectory import Trajectory
+from src.diagnostics import LoopMonitor, SamplingProfiler
+from src.log_store import LogStore
+from src import diagnostics
+from src.outbox import Outbox, OutboxEntry
+from src.process_pool import ProcessPoolConfig
+from src import local_generation
+from src.backoff import Backoff
+from src.suspend_detector import SuspendDetector
+from src.governor import ResourceGovernor, GovernorConfig, PAUSE, NICE
+from src.heartbeat import HeartbeatScheduler
+from src.token_cache import TokenCache
+from src.cost_model import CostModel
+from src.watchdog import StallWatchdog, WatchdogConfig
+from src import cost_model
+from src import calibration
+from src import binary_variants
 
 import asyncio
+import copy
 import json
 import datetime
 import re
+import shutil
+import signal
+import time
 from dataclasses import dataclass
-from os import makedirs
+from os import makedirs, cpu_count
 from pathlib import Path
 from collections import deque
 
 class AsyncDeque:
-    def __init__(self, maxsize=10):
+    def __init__(self, maxsize=10, sink=None):
         self.deque = deque(maxlen=maxsize)
         self.lock = asyncio.Lock()
+        self.sink = sink # Also called with every item, e.g. to keep a full log
 
     async def add(self, item):
         """Safely add an item to the deque."""
         async with self.lock:
             self.deque.append(item)
+        if self.sink:
+            self.sink(item)
 
     async def get_last(self, index=0):
         """Safely get an item (default: most recent)"""
@@ -41,11 +69,130 @@ class WorkerConfig():
     in_subfolder : str = "input"
     out_subfolder : str = "output"
     db : str = "moe.json"
+    token_cache : str = "private/session.json" # Saved API tokens, so restarts need no login ("" = do not save). Its folder is made owner-only.
+    outbox : str = "outbox.json" # Journal of results not yet accepted by the server
     
     commands_stored : int = 10
+    # Log of the worker updates and all output of the binary (see LogStore). The latest log_memory_lines lines stay in
+    # memory, older ones go to compressed segments in log_folder, the oldest are deleted beyond log_disk_budget bytes.
+    log_folder : str = "logs"
+    log_memory_lines : int = 2000
+    log_segment_lines : int = 1000
+    log_disk_budget : int = 50 * 2**20
 
     ping_interval : int = 10
+    # Leases are pinged at heartbeat_fraction of the lease duration the server gives with the job (or in the ping answer).
+    # If it does not say, they are pinged every job_ping_interval seconds.
     job_ping_interval : int = 30
+    heartbeat_fraction : float = 1 / 3
+
+    # Job polling. Empty or failed job requests back off exponentially (with jitter) up to poll_max_interval.
+    poll_min_interval : float = 1.0
+    poll_max_interval : float = 300.0
+    poll_backoff_factor : float = 2.0
+    poll_jitter : bool = True
+    # Long-poll: hold one request open and let the server hand out a job as soon as one exists.
+    # Falls back to polling if the server does not support it.
+    long_poll : bool = False
+    long_poll_wait : float = 60.0
+    # Retrying results in the outbox backs off up to this many seconds
+    outbox_max_interval : float = 300.0
+
+    # Suspend detection: every suspend_check_interval seconds, compare the wall clock with the monotonic clock.
+    # More than suspend_threshold unaccounted seconds means the machine slept, and the leases are checked.
+    suspend_check_interval : float = 5.0
+    suspend_threshold : float = 30.0
+
+    # Shutdown (SIGTERM / SIGINT): seconds to checkpoint and hand back the running jobs before giving up
+    shutdown_deadline : float = 20.0
+
+    # Diagnostics (see diagnostics): the event loop lag is measured every loop_lag_interval seconds, lags above
+    # loop_lag_warning are reported. With log_slow_callbacks, callbacks blocking the loop for more than slow_callback
+    # seconds are logged to slow_callback_log (asyncio debug mode, costs some speed).
+    # SIGUSR1 or 'p' in the interface starts and stops a sampling profile, saved in profile_folder.
+    loop_lag_interval : float = 0.5
+    loop_lag_warning : float = 1.0
+    log_slow_callbacks : bool = False
+    slow_callback : float = 0.1
+    slow_callback_log : str = "slow_callbacks.log"
+    profile_folder : str = "profiles"
+    profile_interval : float = 0.005
+
+    # Progress estimation
+    rate_window : int = 50 # Number of progress lines used to estimate iterations/sec and the entropy slope
+    # Entropy trajectory of every minimization, saved as {job_id}_trajectory.dat next to the output (see Trajectory)
+    record_trajectory : bool = True
+    trajectory_points : int = 4096 # Memory bound, the trajectory is downsampled beyond this many points
+    upload_trajectory : bool = False # Upload the trajectory along with the output
+    max_iterations : int = 0 # Iteration cap passed to the minimization (0 = no cap)
+    stall_warning : int = 60 # Seconds without a new iteration before a job is shown as stalled
+
+    # Stall watchdog: a process without a progress line for stall_timeout seconds (or stall_factor times the estimated
+    # time per iteration), or running runtime_factor times longer than estimated, is stopped (SIGKILL after kill_grace
+    # seconds). A minimization restarts from its last checkpoint up to stall_restarts times, then it is handed back.
+    watchdog : bool = True
+    watchdog_interval : float = 10.0
+    stall_timeout : float = 600.0
+    stall_factor : float = 50.0
+    max_runtime : float = 0.0 # Run time limit of minimizations without an iteration cap (0 = no limit)
+    runtime_factor : float = 10.0
+    kill_grace : float = 10.0
+    stall_restarts : int = 1
+    checkpoint_interval : int = 1000 # Minimizations save a checkpoint every this many iterations (0 = never)
+
+    # Early termination of non-converging minimizations
+    early_stopping : bool = False
+    early_stopping_min_iterations : int = 1000 # Never stop before this many iterations
+    plateau_min_improvement : float = 1e-7 # Entropy decrease per iteration below which a job has plateaued
+    plateau_margin : float = 1e-3 # Plateaus closer than this to the target entropy are not stopped
+    target_horizon : int = 100000 # Stop if the target entropy is projected further than this many iterations away
+    use_prediction : bool = False # Pass the target entropy to the binary's own prediction (-p -t)
+
+    # Batching: lease up to this many minimizations on the same kraus file, so it is downloaded once. The binary takes
+    # one starting vector per call, so every job of a batch is still its own process (paying its own startup and kraus
+    # load). At most batch_parallel of them run at the same time (0 = one per core), the others wait for the next round.
+    minimize_batch_size : int = 1
+    batch_parallel : int = 0
+
+    # Admission control: only start jobs whose estimated memory (see CostModel) fits in memory_safety_factor of the
+    # available memory. Jobs that can never fit on this host, or waited admission_max_wait seconds, are handed back.
+    admission_control : bool = True
+    memory_safety_factor : float = 0.8
+    admission_max_wait : float = 600.0
+
+    # Host calibration: measure the host once (cached in host_profile for calibration_max_age seconds, or until the
+    # binary changes) and advertise it with job requests, so the scheduler can assign jobs by size
+    calibrate : bool = True
+    host_profile : str = "host_profile.json"
+    calibration_max_age : float = 7 * 24 * 3600
+    # Startup checks with the binary (calibration, build benchmark, file format check) give up after this many seconds
+    startup_check_timeout : float = 120.0
+    advertise_host : bool = True
+
+    # Builds of the binary (see binary_variants): use the fastest one this CPU can run, benchmarked once and cached
+    # in binary_choice until the builds or the CPU change
+    bin_folder : str = "./bin"
+    select_variant : bool = True
+    binary_variant : str = "" # Use this variant, without benchmark
+    binary_choice : str = "binary_variant.json"
+
+    # Warm process pool for vector and kraus generation (0 = always spawn a new process)
+    process_pool_size : int = 0
+    process_pool_max_jobs : int = 100 # Recycle a warm process after this many jobs
+
+    # Generate vectors / kraus operators in Python with NumPy instead of the binary. Only used once a round trip with the
+    # binary has confirmed the file format (see local_generation.verify_with_binary), unless local_generation_unverified.
+    # With both enabled and local_generation_unverified, the worker runs without a compiled binary (and hands
+    # minimizations back).
+    local_vector_generation : bool = False
+    local_kraus_generation : bool = False
+    local_generation_unverified : bool = False
+
+    # Resource governor: pause or renice the running processes while the host is busy, in use or on battery
+    governor : bool = False
+    governor_max_load : float = 0.75 # Load per CPU (without the worker) above which processes are paused
+    governor_user_action : str = "nice" # What to do while someone uses the machine: run, nice or pause
+    governor_pause_on_battery : bool = True
 
 class Worker():
     def __init__(self, config: WorkerConfig = WorkerConfig()):
@@ -54,8 +201,19 @@ class Worker():
 
         # Initialize the API handler and the process manager
         self.api_handler = APIHandler(self.config.api_url)
-        self.process_manager = ProcessManager()
-        if not self.process_manager.check_executable():
+        generation_only = config.local_vector_generation and config.local_kraus_generation and config.local_generation_unverified and local_generation.numpy_available()
+        # The builds of the binary this CPU can run. Start with the default (or the configured one), see select_binary.
+        self.cpu_flags = binary_variants.cpu_flags()
+        self.variants = binary_variants.compatible(binary_variants.discover(config.bin_folder), self.cpu_flags)
+        self.variant = next((variant for variant in self.variants if variant.name == config.binary_variant), None)
+        if config.binary_variant and self.variant is None:
+            print(f"[Warning] Binary variant {config.binary_variant} not found or not supported by this CPU")
+        if self.variant is None and self.variants:
+            self.variant = self.variants[0]
+        executable_path = self.variant.path if self.variant else str(Path(config.bin_folder) / "moe")
+        self.process_manager = ProcessManager(executable_path, require_executable=not generation_only)
+        self.can_minimize = self.process_manager.executable_found
+        if not self.can_minimize and not generation_only:
             raise Exception("Executable not found")
         
         # Ensure save folder exists. Convert the paths to Path objects
@@ -75,33 +233,53 @@ class Worker():
         ### Files database ###
         # {"in_files": {"file_id": {"type": "kraus/vector", "path": "path/to/file"}}, "out_files": {"job_id": {"type": "kraus/vector", "path": "path/to/file"}}}
 
-        # If db file exists, load it
+        # Loaded from db_path on first use (see the db property), it is not needed to start up
         self.db_path = self.data_folder / config.db
-        if self.db_path.exists():
-            with open(self.db_path, "r") as file:
-                self.db = json.load(file)
-        else:
-            self.db = dict()
+        self.db_data = None
+
+        # Saved login of an earlier run (see restore_login)
+        if config.token_cache:
+            self.api_handler.token_cache = TokenCache(self.data_folder / config.token_cache)
 
         # Initialize the flags and variables
         self.running = False # Flag to indicate if the worker is running
-        self.has_job = False # Flag to indicate if the worker has a job
         self.stopped = False # Flag to indicate if the worker has been stopped (not just paused)
 
-        self.job_id = None
-        self.job_type = None
-        self.job_status = None
-        self.kraus_file_id = None
-        self.vector_file_id = None
-        self.channel_id = None
-        self.number_kraus = None
-        self.input_dimension = None
-        self.output_dimension = None
-        # These are also used to update the server!
-        self.current_entropy = None
-        self.current_iterations = 0
+        # Jobs currently being run. Usually one, several when minimizations are batched.
+        self.jobs = []
+        # Jobs that were leased while building a batch, but could not join it. They are run next.
+        self.pending_jobs = deque()
+        # Early termination. Any StoppingPolicy can be assigned here, each job gets its own copy.
+        if config.early_stopping:
+            self.stopping_policy = CombinedPolicy(
+                PlateauPolicy(config.early_stopping_min_iterations, config.plateau_min_improvement, config.plateau_margin),
+                UnreachableTargetPolicy(config.early_stopping_min_iterations, config.target_horizon)
+            )
+        else:
+            self.stopping_policy = StoppingPolicy()
         # Background task
         self.task = None
+        self.shutdown_task = None # Set once a shutdown was requested (see request_shutdown)
+        self.stop_event = asyncio.Event() # Set on stop, wakes the background tasks
+        self.cost_model = CostModel()
+        self.loop_monitor = LoopMonitor(config.loop_lag_interval)
+        self.profiler = SamplingProfiler(config.profile_interval)
+        self.watchdog = StallWatchdog(WatchdogConfig(config.stall_timeout, config.stall_factor, config.max_runtime, config.runtime_factor), self.cost_model)
+        self.host_profile = None # HostProfile, see calibrate_host
+        self.local_generation_verified = False # The binary reads our .dat files, see verify_local_generation
+        self.heartbeat = HeartbeatScheduler(default_duration=config.job_ping_interval / config.heartbeat_fraction, fraction=config.heartbeat_fraction)
+        self.suspend_detector = SuspendDetector(config.suspend_check_interval, config.suspend_threshold)
+        self.governor = ResourceGovernor(GovernorConfig(max_load=config.governor_max_load, resume_load=config.governor_max_load * 2 / 3, user_active_action=config.governor_user_action, pause_on_battery=config.governor_pause_on_battery))
+        self.pause_reported = False # The server was told the jobs are paused
+        # Polling schedule for new jobs
+        self.poll_backoff = Backoff(config.poll_min_interval, config.poll_backoff_factor, config.poll_max_interval, config.poll_jitter)
+        self.next_poll = None # datetime of the next job request, for the gui
+        self.wake_event = asyncio.Event() # Set to interrupt a long wait between polls (e.g. on stop)
+        self.long_poll_idle = False # The last long-poll ended normally without a job, so there is no need to back off
+        # Finished jobs waiting to be reported. Drained in the background, so computing does not wait for the API.
+        self.outbox = Outbox(self.data_folder / config.outbox)
+        self.outbox_event = asyncio.Event() # Set when a result is added
+        self.outbox_backoff = Backoff(config.poll_min_interval, 2.0, config.outbox_max_interval, config.poll_jitter)
 
         # These are used to display info to the gui
         # TIMESTAMPS
@@ -109,8 +287,83 @@ class Worker():
         self.logged_in = False
         self.username = None
         # CONSOLE OUTPUTS
-        self.last_commands = AsyncDeque(maxsize=config.commands_stored)
+        self.log = LogStore(self.data_folder / config.log_folder, config.log_memory_lines, config.log_segment_lines, config.log_disk_budget)
+        self.last_commands = AsyncDeque(maxsize=config.commands_stored, sink=self.log_line)
+
+    ##############################
+    # Current job (for the gui)  #
+    ##############################
+
+    @property
+    def job(self):
+        """The first job of the current batch (None if there is no job)"""
+        return self.jobs[0] if self.jobs else None
+
+    @property
+    def has_job(self):
+        return len(self.jobs) > 0
+
+    @property
+    def job_id(self):
+        return self.job.job_id if self.job else None
 
+    @property
+    def job_type(self):
+        return self.job.job_type if self.job else None
+
+    @property
+    def current_entropy(self):
+        return self.job.current_entropy if self.job else None
+
+    @property
+    def current_iterations(self):
+        return self.job.current_iterations if self.job else 0
+
+    @property
+    def rate_estimator(self):
+        return self.job.rate_estimator if self.job else RateEstimator()
+
+    @property
+    def iterations_per_second(self):
+        # For a batch, the total throughput of all jobs
+        rates = [job.rate_estimator.iterations_per_second for job in self.jobs]
+        rates = [rate for rate in rates if rate]
+        return sum(rates) if rates else None
+
+    @property
+    def eta(self):
+        """Seconds until the current job reaches its target entropy or iteration cap (None if unknown)"""
+        if not self.job:
+            return None
+        return self.job.rate_estimator.eta(self.job.target_entropy, self.config.max_iterations)
+
+    @property
+    def stalled(self):
+        # Jobs paused by the governor make no progress on purpose
+        return not self.governor.paused and any(job.rate_estimator.is_stalled(self.config.stall_warning) for job in self.jobs)
+
+    @property
+    def db(self):
+        """Files database. If the db file exists, it is loaded on first use."""
+        if self.db_data is None:
+            self.db_data = dict()
+            if self.db_path.exists():
+                try:
+                    with open(self.db_path, "r") as file:
+                        self.db_data = json.load(file)
+                except ValueError:
+                    print(f"[Warning] {self.db_path} is damaged, starting with an empty files database")
+        return self.db_data
+
+    def find_job(self, job_id):
+        for job in self.jobs + list(self.pending_jobs):
+            if job.job_id == job_id:
+                return job
+        return None
+
+    ##############################
+    # Server interaction         #
+    ##############################
 
     async def login(self, uid: str, pwd: str):
         self.logged_in = await self.api_handler.login(uid,pwd)
@@ -118,6 +371,29 @@ class Worker():
             self.username = uid
         return self.logged_in
     
+    async def restore_login(self):
+        """Log in with the tokens saved by an earlier run. Returns whether that worked."""
+        token_cache = self.api_handler.token_cache
+        session = token_cache.load() if token_cache else None
+        if not session or session.get("api_url") != self.config.api_url:
+            return False
+        self.api_handler.restore_tokens(session)
+        # An expired access token is refreshed on the way
+        try:
+            self.logged_in = await self.api_handler.check_login(check=True)
+        except AuthError:
+            # The tokens are no longer valid, a password login is needed
+            self.logged_in = False
+            token_cache.clear()
+            self.api_handler.restore_tokens(dict())
+        except APIError:
+            # The API could not be reached, the tokens may still be good
+            self.logged_in = False
+        self.last_checked = datetime.datetime.now()
+        if self.logged_in:
+            self.username = self.api_handler.username
+        return self.logged_in
+
     async def is_logged_in(self):
         # if the last check was too long ago, check again
         if not self.last_checked or (datetime.datetime.now() - self.last_checked).seconds > self.config.ping_interval:
@@ -126,210 +402,474 @@ class Worker():
         
         return self.logged_in
 
+    def new_job(self, job_dic: dict):
+        job = Job.from_dict(job_dic)
+        job.rate_estimator = RateEstimator(window=self.config.rate_window)
+        job.trajectory = Trajectory(self.config.trajectory_points)
+        job.stopping_policy = copy.deepcopy(self.stopping_policy)
+        job.stopping_policy.reset(job.target_entropy)
+        job.memory_estimate = self.cost_model.memory(job)
+        return job
+
     async def get_job(self):
-        job_dic = await self.api_handler.get_job()
-        # Check if we got a job
-        if not job_dic:
-            return False
-        # Extract the job data
-        self.job_id = job_dic["job_id"]
-        self.job_type = job_dic["job_type"]
-        self.job_status = job_dic["job_status"]
-        self.kraus_file_id = job_dic["kraus_id"]
-        self.vector_file_id = job_dic["vector_id"]
-        # Extract the job specific data
-        if self.job_type == "generate_kraus":
-            self.channel_id = job_dic["job_data"]["channel_id"]
-            self.number_kraus = job_dic["job_data"]["number_kraus"]
-            self.input_dimension = job_dic["job_data"]["input_dimension"]
-            self.output_dimension = job_dic["job_data"]["output_dimension"]
-        elif self.job_type == "generate_vector":
-            self.input_dimension = job_dic["job_data"]["input_dimension"]
-            self.channel_id = job_dic["job_data"]["channel_id"]
-        elif self.job_type == "minimize":
-            self.channel_id = job_dic["job_data"]["channel_id"]
-            self.number_kraus = job_dic["job_data"]["number_kraus"]
-            self.input_dimension = job_dic["job_data"]["input_dimension"]
-            self.output_dimension = job_dic["job_data"]["output_dimension"]
-        
-        # Signal that we have a job
-        self.has_job = True
+        # Jobs left over from building the last batch come first, they are already leased
+        if self.pending_jobs:
+            job = self.pending_jobs.popleft()
+        else:
+            # Tell the scheduler what this host can take
+            params = self.job_params()
+            self.long_poll_idle = False
+            if self.config.long_poll and self.api_handler.long_poll_supported is not False:
+                started = time.monotonic()
+                job_dic = await self.api_handler.wait_for_job(self.config.long_poll_wait, params)
+                # A server that answers right away is not long-polling, treat it like an empty poll
+                self.long_poll_idle = bool(not job_dic and self.api_handler.long_poll_supported and time.monotonic() - started >= self.config.long_poll_wait / 2)
+            else:
+                job_dic = await self.api_handler.get_job(params)
+            # Check if we got a job
+            if not job_dic:
+                return False
+            job = self.new_job(job_dic)
+        self.jobs = [job]
+
+        # Minimizations on the same channel can be batched, so the kraus file is only downloaded once
+        if job.job_type == "minimize" and self.config.minimize_batch_size > 1:
+            await self.lease_batch(job)
+
+        # Start the heartbeat for the new leases
+        self.heartbeat.notify()
         # update last check
         self.last_checked = datetime.datetime.now()
         return True
 
-    async def handle_file_download(self):
+    def job_params(self, params: dict = None):
+        """Hints for the scheduler: params, plus what this host can do"""
+        params = dict(params or {})
+        # Without a binary, tell the scheduler we can only generate
+        if not self.can_minimize:
+            params["job_types"] = "generate_vector,generate_kraus"
+        if self.config.advertise_host and self.host_profile:
+            params.update(self.host_profile.params())
+        if self.config.advertise_host and self.variant and self.can_minimize:
+            params["variant"] = self.variant.name
+        return params or None
+
+    async def select_binary(self):
+        # Pick the fastest build that works on this CPU (cached choice, or a short benchmark of each)
+        if not self.config.select_variant or self.config.binary_variant or len(self.variants) < 2:
+            return
+        path = self.data_folder / self.config.binary_choice
+        variant = binary_variants.load_choice(path, self.variants, self.cpu_flags)
+        if variant is None:
+            self.api_handler.status = "Benchmarking binary builds..."
+            variant, results = await binary_variants.benchmark(self.variants, self.config.startup_check_timeout)
+            if variant is None:
+                await self.last_commands.add(f"No build of the binary passed the benchmark, using {self.variant.name}")
+                return
+            binary_variants.save_choice(path, variant, self.variants, self.cpu_flags, results)
+            await self.last_commands.add(f"Binary: {variant.name} ({results[variant.name] / 1e9:.2f} GFLOPS, {len(results)} builds tried)")
+        self.variant = variant
+        self.process_manager.set_executable(variant.path)
+
+    def use_local_generation(self, enabled: bool):
+        return enabled and local_generation.numpy_available() and (self.local_generation_verified or self.config.local_generation_unverified)
+
+    async def verify_local_generation(self):
+        # Locally generated inputs go to real jobs, so they are only used once the binary has read them back
+        try:
+            problem = await asyncio.wait_for(local_generation.verify_with_binary(self.process_manager, self.out_folder), self.config.startup_check_timeout)
+        except asyncio.TimeoutError:
+            problem = f"the binary did not finish the check in {self.config.startup_check_timeout:.0f} s"
+        self.local_generation_verified = problem is None
+        if problem:
+            await self.last_commands.add(f"[Warning] Local generation disabled, the file format is not confirmed: {problem}")
+        else:
+            await self.last_commands.add("Local generation verified against the binary")
+
+    async def calibrate_host(self):
+        # Load the cached profile of this host, or measure it. The measured speed also feeds the cost model.
+        path = self.data_folder / self.config.host_profile
+        profile = calibration.load_profile(path, self.process_manager.executable_path, self.can_minimize, self.config.calibration_max_age)
+        if profile is None:
+            self.api_handler.status = "Calibrating host..."
+            profile = await calibration.calibrate(self.process_manager, use_binary=self.can_minimize, timeout=self.config.startup_check_timeout)
+            # Without a measurement by the binary (e.g. it hung), measure again on the next start
+            if profile.method == "moe" or not self.can_minimize:
+                calibration.save_profile(path, profile)
+            await self.last_commands.add(f"Host calibrated: {profile.cores} cores, {profile.memory / 2**30:.1f} GB, {profile.flops / 1e9:.2f} GFLOPS ({profile.method})")
+        self.host_profile = profile
+        if profile.flops:
+            self.cost_model.flops_per_second = profile.flops
+
+    async def lease_batch(self, first_job: Job):
+        # Ask the server for more minimizations using the same kraus file
+        while len(self.jobs) < self.config.minimize_batch_size:
+            job_dic = await self.api_handler.get_job(self.job_params({"kraus_id": first_job.kraus_file_id}))
+            if not job_dic:
+                break
+            job = self.new_job(job_dic)
+            if job.job_type == "minimize" and job.kraus_file_id == first_job.kraus_file_id:
+                self.jobs.append(job)
+            else:
+                # The server did not honor the hint. Keep the job for later and stop asking.
+                self.pending_jobs.append(job)
+                break
+
+    async def download_input(self, file_id: str, file_type: str):
+        # Files are identified by their id, so one that is already on disk does not need to be downloaded again
+        path = self.in_folder / f"{file_id}_in.dat"
+        known = self.db.get("in_files", dict()).get(file_id)
+        if known and Path(known["path"]).exists():
+            return True
+        link = await self.api_handler.request_download_link(file_id)
+        if not link:
+            print(f"[Error] Failed to get download link for {file_type} file")
+            return False
+        fl = await self.api_handler.download_file(link["download_url"], path, checksum=link.get("sha256"))
+        if not fl:
+            print(f"[Error] Failed to download {file_type} file")
+            return False
+        # Add to db. Use setdefault as the keys don't necessarily exist!
+        self.db.setdefault("in_files", dict())[file_id] = {"type": file_type, "path": str(path)}
+        return True
+
+    async def handle_file_download(self, job: Job):
         # Get the necessary files for the job, if any. This is only relevant for minimization jobs, where both the vector and the kraus operators need to be specified.
-        if self.job_type == "minimize":
-            if not self.vector_file_id or not self.kraus_file_id:
+        if job.job_type == "minimize":
+            if not job.vector_file_id or not job.kraus_file_id:
                 print(f"[Error] Missing vector or kraus file")
                 return False
             # Download the vector file
-            vectorlink = await self.api_handler.request_download_link(self.vector_file_id)
-            if not vectorlink:
-                print(f"[Error] Failed to get download link for vector file")
+            if not await self.download_input(job.vector_file_id, "vector"):
                 return False
-            fl = await self.api_handler.download_file(vectorlink["download_url"], self.in_folder / f"{self.vector_file_id}_in.dat")
-            if not fl:
-                print(f"[Error] Failed to download vector file")
-                return False
-            # Add to db. Use setdefault as the keys don't necessarily exist!
-            self.db.setdefault("in_files", dict())[self.vector_file_id] = {"type": "vector", "path": str(self.in_folder / f"{self.vector_file_id}_in.dat")}
             # Download the kraus file
-            krauslink = await self.api_handler.request_download_link(self.kraus_file_id)
-            if not krauslink:
-                print(f"[Error] Failed to get download link for kraus file")
-                return False
-            fl = await self.api_handler.download_file(krauslink["download_url"], self.in_folder / f"{self.kraus_file_id}_in.dat")
-            if not fl:
-                print(f"[Error] Failed to download kraus file")
+            if not await self.download_input(job.kraus_file_id, "kraus"):
                 return False
-            # Add to db
-            self.db.setdefault("in_files", dict())[self.kraus_file_id] = {"type": "kraus", "path": str(self.in_folder / f"{self.kraus_file_id}_in.dat")}
             # Update the db in the file
-            with open(self.db_path, "w") as file:
-                json.dump(self.db, file)
+            self.save_db()
+        return True
+
+    def save_db(self):
+        # Load the db before the file is truncated, it may not have been used yet
+        db = self.db
+        with open(self.db_path, "w") as file:
+            json.dump(db, file)
+
+    async def run_batch(self):
+        # Hand back jobs that will not fit in memory, before downloading anything for them
+        await self.reject_jobs()
+        # Download the inputs one job at a time, so shared files are only fetched once
+        for job in self.jobs:
+            await self.handle_file_download(job)
+        # Run the jobs of the batch that fit in memory and on the cores side by side. The others wait for the next round.
+        admitted = self.admit_jobs()
+        results = await asyncio.gather(*(self.run_job(job) for job in admitted))
+        done = {job.job_id for job, ok in zip(admitted, results) if ok}
+        # Jobs that are done leave the batch. Failed ones are kept and retried, unless they are no longer ours.
+        self.jobs = [job for job in self.jobs if job.job_id not in done and not job.lease_lost]
+        self.heartbeat.notify()
 
-    async def run_job(self):
-        # Handle file download
-        await self.handle_file_download()
+    def parallel_limit(self):
+        """Number of jobs of a batch that may run at the same time"""
+        if self.config.batch_parallel > 0:
+            return self.config.batch_parallel
+        cores = self.host_profile.cores if self.host_profile else None
+        return max(cores or cpu_count() or 1, 1)
 
+    def admit_jobs(self):
+        """Jobs of the batch that fit in the available memory (and cores) now, packed largest first"""
+        limit = self.parallel_limit()
+        available = cost_model.available_memory() if self.config.admission_control else None
+        if available is None:
+            return self.jobs[:limit]
+        budget = available * self.config.memory_safety_factor
+        admitted = []
+        for job in sorted(self.jobs, key=lambda job: job.memory_estimate, reverse=True):
+            if len(admitted) >= limit:
+                # No room on the cores, this is no memory shortage
+                break
+            if job.memory_estimate <= budget:
+                admitted.append(job)
+                budget -= job.memory_estimate
+                job.deferred_since = None
+            elif job.deferred_since is None:
+                job.deferred_since = time.monotonic()
+        return admitted
+
+    async def reject_jobs(self):
+        # Jobs larger than this host's memory would only be OOM-killed. Give them back so a bigger host can take them.
+        if not self.config.admission_control:
+            return
+        total = cost_model.total_memory()
+        rejected = False
+        for job in list(self.jobs):
+            too_large = total is not None and job.memory_estimate > total * self.config.memory_safety_factor
+            waited = job.deferred_since is not None and time.monotonic() - job.deferred_since > self.config.admission_max_wait
+            if too_large or waited:
+                reason = "more than this host has" if too_large else "not available for too long"
+                await self.last_commands.add(f"[Warning] Handing back job {job.job_id}: needs ~{job.memory_estimate / 2**20:.0f} MB, {reason}")
+                await self.api_handler.cancel_job(job.job_id)
+                self.jobs.remove(job)
+                rejected = True
+        if rejected and not self.jobs:
+            # Do not lease the same job again right away
+            await self.idle(self.poll_delay())
+
+    async def run_job(self, job: Job):
+        if job.lease_lost:
+            return True
+        output_path = self.out_folder / f"{job.job_id}_out.dat"
         # Run the job
-        if self.job_type == "generate_kraus":
+        if job.job_type == "generate_kraus":
             # Need to generate kraus.
-            out = await self.process_manager.run_kraus_generation(self.input_dimension, self.number_kraus, self.out_folder / f"{self.job_id}_out.dat")
-            # Check that execution was successful
+            if self.use_local_generation(self.config.local_kraus_generation):
+                out = await local_generation.run_kraus_generation(job.input_dimension, job.number_kraus, output_path)
+            else:
+                job.started_at = time.monotonic()
+                out = await self.process_manager.run_kraus_generation(job.input_dimension, job.number_kraus, output_path, tag=job.job_id)
+            # Check that execution was successful. A hung process is not tried again, the job goes back to the server.
             if not out or not out[0]:
                 print(f"[Error] Failed to run job")
-                return False
+                return await self.give_up_job(job, output_path) if job.stall_reason else False
             # Add to db
-            self.db.setdefault("out_files", dict())[self.job_id] = {"type": "kraus", "path": str(self.out_folder / f"{self.job_id}_out.dat")}
+            self.db.setdefault("out_files", dict())[job.job_id] = {"type": "kraus", "path": str(output_path)}
             # Save db
-            with open(self.db_path, "w") as file:
-                json.dump(self.db, file)
-        elif self.job_type == "generate_vector":
+            self.save_db()
+        elif job.job_type == "generate_vector":
             # Need to generate vector
-            out = await self.process_manager.run_vector_generation(self.input_dimension, self.out_folder / f"{self.job_id}_out.dat")
-            # Check that execution was successful
+            if self.use_local_generation(self.config.local_vector_generation):
+                out = await local_generation.run_vector_generation(job.input_dimension, output_path)
+            else:
+                job.started_at = time.monotonic()
+                out = await self.process_manager.run_vector_generation(job.input_dimension, output_path, tag=job.job_id)
+            # Check that execution was successful. A hung process is not tried again, the job goes back to the server.
             if not out or not out[0]:
                 print(f"[Error] Failed to run job")
-                return False
+                return await self.give_up_job(job, output_path) if job.stall_reason else False
             # Add to db
-            self.db.setdefault("out_files", dict())[self.job_id] = {"type": "vector", "path": str(self.out_folder / f"{self.job_id}_out.dat")}
+            self.db.setdefault("out_files", dict())[job.job_id] = {"type": "vector", "path": str(output_path)}
             # Save db
-            with open(self.db_path, "w") as file:
-                json.dump(self.db, file)
-        elif self.job_type == "minimize":
+            self.save_db()
+        elif job.job_type == "minimize":
+            if not self.can_minimize:
+                # No binary on this host, give the job back so another worker can take it
+                await self.api_handler.cancel_job(job.job_id)
+                return True
             # Need to minimize
-            out = await self.process_manager.run_singleshot_minimization(self.out_folder / f"{self.job_id}_out.dat", self.in_folder / f"{self.vector_file_id}_in.dat", self.in_folder / f"{self.kraus_file_id}_in.dat")
-            # Check that execution was successful
-            if not out or not out[0]:
+            await self.last_commands.add(f"Job {job.job_id}: ~{job.memory_estimate / 2**20:.0f} MB, ~{self.cost_model.seconds_per_iteration(job) * 1000:.1f} ms per iteration (estimated)")
+            vector_path = self.in_folder / f"{job.vector_file_id}_in.dat"
+            out = await self.run_minimization(job, vector_path, output_path)
+            # A hung minimization is stopped by the watchdog. Restart it from its checkpoint, or give up on it.
+            while job.stall_reason and not job.lease_lost:
+                vector_path = self.restore_checkpoint(job)
+                if vector_path is None:
+                    return await self.give_up_job(job, output_path)
+                out = await self.run_minimization(job, vector_path, output_path)
+            if self.stopped and not job.early_stop_reason:
+                # Cut short by shutdown. The binary may save and exit 0 on SIGTERM, but the result is not final: run() hands the job back.
+                return False
+            # Check that execution was successful. A job stopped by the stopping policy is terminated, but has saved its current vector.
+            if (not out or not out[0]) and not job.early_stop_reason:
                 print(f"[Error] Failed to run job")
                 return False
+            self.remove_checkpoints(job)
             # Add to db
-            self.db.setdefault("out_files", dict())[self.job_id] = {"type": "vector", "path": str(self.out_folder / f"{self.job_id}_out.dat")}                          
+            self.db.setdefault("out_files", dict())[job.job_id] = {"type": "vector", "path": str(output_path)}
             # Save db
-            with open(self.db_path, "w") as file:
-                json.dump(self.db, file)
+            self.save_db()
 
         else:
-            print(f"[Error] Unknown job type: {self.job_type}")
-            # Signal that we no longer have a job (TODO: should we do this?)
-            self.has_job = False
+            print(f"[Error] Unknown job type: {job.job_type}")
+            # Drop the job from the batch (TODO: should we do this?)
+            return True
+
+        if job.lease_lost:
+            # Lost the job while computing, the server will not take the result
+            return True
+        # The result is safe on disk. Journal it, it is reported in the background (drain_outbox) while the next job runs.
+        file_type = "kraus" if job.job_type == "generate_kraus" else "vector"
+        entry = OutboxEntry(job.job_id, job.job_type, file_type, str(output_path), job.current_iterations, job.current_entropy)
+        if self.config.upload_trajectory and self.trajectory_path(job).exists():
+            entry.trajectory = str(self.trajectory_path(job))
+        self.outbox.add(entry)
+        self.outbox_event.set()
+        return True
+
+    async def run_minimization(self, job: Job, vector_path: Path, output_path: Path):
+        predict = self.config.use_prediction and job.target_entropy is not None
+        # After a restart, only the remaining iterations
+        iterations = max(self.config.max_iterations - job.iteration_offset, 1) if self.config.max_iterations > 0 else 0
+        job.started_at = time.monotonic()
+        job.last_progress = None
+        out = await self.process_manager.run_singleshot_minimization(output_path, vector_path, self.in_folder / f"{job.kraus_file_id}_in.dat", predict=predict, target_entropy=job.target_entropy if predict else -1.0, iterations=iterations, checkpointing=self.config.checkpoint_interval > 0, checkpoint_path=str(self.checkpoint_path(job)), checkpoint_interval=self.config.checkpoint_interval, tag=job.job_id)
+        # Also after a failed or stopped run, the history up to there is worth having
+        if self.config.record_trajectory and len(job.trajectory):
+            job.trajectory.save(self.trajectory_path(job))
+        return out
+
+    def trajectory_path(self, job: Job):
+        return self.out_folder / f"{job.job_id}_trajectory.dat"
+
+    def checkpoint_path(self, job: Job):
+        return self.out_folder / f"{job.job_id}_checkpoint.dat"
+
+    def remove_checkpoints(self, job: Job):
+        self.checkpoint_path(job).unlink(missing_ok=True)
+        (self.out_folder / f"{job.job_id}_restart.dat").unlink(missing_ok=True)
+
+    def restore_checkpoint(self, job: Job):
+        """Input vector to restart a stalled minimization from (None if it cannot be restarted)"""
+        checkpoint = self.checkpoint_path(job)
+        if job.restarts >= self.config.stall_restarts or self.config.checkpoint_interval <= 0 or not checkpoint.exists():
+            return None
+        # The restarted process writes the checkpoint again, so it starts from a copy
+        restart_path = self.out_folder / f"{job.job_id}_restart.dat"
+        shutil.copyfile(checkpoint, restart_path)
+        job.restarts += 1
+        # The checkpoint is from the last multiple of checkpoint_interval, the binary counts from 0 again
+        job.iteration_offset += (job.current_iterations - job.iteration_offset) // self.config.checkpoint_interval * self.config.checkpoint_interval
+        job.current_iterations = job.iteration_offset
+        job.rate_estimator.reset()
+        job.stall_reason = None
+        self.api_handler.status = f"Restarting job {job.job_id} from iteration {job.iteration_offset}"
+        return restart_path
+
+    async def give_up_job(self, job: Job, output_path: Path):
+        # A hung job goes back to the server with the furthest state we have, so another worker can continue it
+        await self.last_commands.add(f"[Error] Job {job.job_id} hung ({job.stall_reason}), handing it back")
+        checkpoint = self.checkpoint_path(job)
+        if job.job_type == "minimize" and not output_path.exists() and checkpoint.exists():
+            shutil.copyfile(checkpoint, output_path)
+        await self.hand_back_job(job)
+        self.remove_checkpoints(job)
+        return True
+
+    async def upload_output(self, job_id: int, file_type: str, path: Path, check: bool = False):
+        # get upload link. With check, API errors are raised (see APIHandler).
+        upload_link = await self.api_handler.request_upload_link(check=check)
+        if not upload_link:
+            print(f"[Error] Failed to get upload link")
+            return False
+        # Upload the file
+        if not Path(path).exists():
+            print(f"[Error] Output file {path} not found")
             return False
+        fl = await self.api_handler.upload_file(job_id, file_type, Path(path), upload_link["upload_url"], encodings=upload_link.get("encodings"), check=check)
+        self.api_handler.status = f"Uploaded {file_type} file: {fl}"
+        if not fl:
+            print(f"[Error] Failed to upload {file_type} file")
+            return False
+        return True
 
-        # Upload the results if necessary and update the job status and info
-        # Case 1: generate_kraus
-        if self.job_type == "generate_kraus":
-            # get upload link
-            upload_link = await self.api_handler.request_upload_link()
-            if not upload_link:
-                print(f"[Error] Failed to get upload link")
-                return False
-            # Upload the kraus file
-            # Search for the file in the db
-            file = self.db["out_files"].get(self.job_id)
-            if not file:
-                print(f"[Error] File not found in db")
-                return False
-            fl = await self.api_handler.upload_file(self.job_id, "kraus", Path(file["path"]), upload_link["upload_url"])
-            self.api_handler.status = f"Uploaded kraus file: {fl}"
-            if not fl:
-                print(f"[Error] Failed to upload kraus file")
-                return False
-            # Update the job status
-            fl = await self.api_handler.complete_job(self.job_id)
+    async def report_progress(self, job_id: int, iterations: int, entropy: float):
+        # Update the number of iterations.
+        if iterations > 0:
+            fl = await self.api_handler.update_iterations(job_id, iterations)
             if not fl:
-                print(f"[Error] Failed to update job status")
-                return False
-        # Case 2: generate_vector
-        elif self.job_type == "generate_vector":
-            # get upload link
-            upload_link = await self.api_handler.request_upload_link()
-            if not upload_link:
-                print(f"[Error] Failed to get upload link")
-                return False
-            # Upload the vector file
-            # Search for the file in the db
-            file = self.db["out_files"].get(self.job_id)
-            if not file:
-                print(f"[Error] File not found in db")
+                print(f"[Error] Failed to update iterations")
                 return False
-            fl = await self.api_handler.upload_file(self.job_id, "vector", Path(file["path"]), upload_link["upload_url"])
-            self.api_handler.status = f"Uploaded vector file: {fl}"
+        # Update the entropy value
+        if entropy:
+            fl = await self.api_handler.update_entropy(job_id, entropy)
             if not fl:
-                print(f"[Error] Failed to upload vector file")
-                return False
-            # Update the job status
-            fl = await self.api_handler.complete_job(self.job_id)
-            if not fl:
-                print(f"[Error] Failed to update job status")
-                return False
-        # Case 3: minimize
-        elif self.job_type == "minimize":
-            # get upload link
-            upload_link = await self.api_handler.request_upload_link()
-            if not upload_link:
-                print(f"[Error] Failed to get upload link")
-                return False
-            # Upload the vector file
-            # Search for the file in the db
-            file = self.db["out_files"].get(self.job_id)
-            if not file:
-                print(f"[Error] File not found in db")
-                return False
-            fl = await self.api_handler.upload_file(self.job_id, "vector", Path(file["path"]), upload_link["upload_url"])
-            if not fl:
-                print(f"[Error] Failed to upload vector file")
-                return False
-            # Update the number of iterations.
-            if self.current_iterations > 0:
-                fl = await self.api_handler.update_iterations(self.job_id, self.current_iterations)
-                if not fl:
-                    print(f"[Error] Failed to update iterations")
-                    return
-            # Update the entropy value
-            if self.current_entropy:
-                fl = await self.api_handler.update_entropy(self.job_id, self.current_entropy)
-                if not fl:
-                    print(f"[Error] Failed to update entropy")
-            # Update the job status
-            fl = await self.api_handler.complete_job(self.job_id)
-            if not fl:
-                print(f"[Error] Failed to update job status")
+                print(f"[Error] Failed to update entropy")
                 return False
+        return True
 
-        # Signal that we no longer have a job
-        self.has_job = False
+    ##############################
+    # Result outbox              #
+    ##############################
 
-            
+    async def deliver(self, entry: OutboxEntry):
+        """
+        Report one finished job: upload its output, its progress, and complete it. Returns whether it is done with.
+        A failed API call raises its APIError, a RequestError means the server refused the result for good.
+        """
+        entry.attempts += 1
+        if not entry.uploaded:
+            if not Path(entry.path).exists():
+                # Retrying will not bring the output back. Give the job back, so the server can have it computed again.
+                await self.last_commands.add(f"[Error] Output of job {entry.job_id} is missing ({entry.path}), handing the job back")
+                await self.api_handler.cancel_job(entry.job_id, check=True)
+                return True
+            if not await self.upload_output(entry.job_id, entry.file_type, entry.path, check=True):
+                return False
+            # The trajectory is a nice to have, it does not hold up the result
+            if entry.trajectory and not await self.upload_output(entry.job_id, "trajectory", entry.trajectory):
+                print(f"[Warning] Failed to upload the trajectory of job {entry.job_id}")
+            # Remember the upload, a retry only has to complete the job
+            entry.uploaded = True
+            self.outbox.update(entry)
+        # Case: minimize. Update the progress before completing
+        if entry.job_type == "minimize":
+            await self.report_progress(entry.job_id, entry.iterations, entry.entropy)
+        # Update the job status
+        await self.api_handler.complete_job(entry.job_id, check=True)
+        return True
 
+    async def drain_outbox(self):
+        # Runs in the background: deliver journaled results, retrying with backoff while the API is unreachable
+        while not self.stopped:
+            failed = False
+            for entry in self.outbox:
+                if self.stopped or self.api_handler.circuit_breaker.is_open:
+                    failed = True
+                    break
+                try:
+                    done = await self.deliver(entry)
+                except RequestError as e:
+                    # The server rejected the result for good (e.g. the lease was lost), retrying will not help
+                    await self.last_commands.add(f"[Error] Result of job {entry.job_id} rejected: {e.message}")
+                    done = True
+                except APIError:
+                    done = False
+                if done:
+                    self.outbox.remove(entry.job_id)
+                    self.heartbeat.notify()
+                else:
+                    failed = True
+                    self.outbox.update(entry)
+            if failed:
+                delay = max(self.outbox_backoff.next_delay(), self.api_handler.circuit_breaker.remaining)
+            else:
+                self.outbox_backoff.reset()
+                delay = self.config.ping_interval
+            # Wait for a new result (or stop), but retry failed ones after delay
+            self.outbox_event.clear()
+            try:
+                await asyncio.wait_for(self.outbox_event.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def hand_back_job(self, job: Job):
+        # If minimization was running, we should update the server with the current vector and info, then cancel the job so the server can reassign it.
+        # Jobs that never got to run (e.g. pending ones) have no output and are simply cancelled.
+        if job.lease_lost:
+            return True
+        output_path = self.out_folder / f"{job.job_id}_out.dat"
+        if job.job_type == "minimize" and output_path.exists():
+            self.db.setdefault("out_files", dict())[job.job_id] = {"type": "vector", "path": str(output_path)}
+            if not await self.upload_output(job.job_id, "vector", output_path):
+                return False
+            await self.report_progress(job.job_id, job.current_iterations, job.current_entropy)
+        # Update the job status to pending, so it can be resumed later
+        fl = await self.api_handler.cancel_job(job.job_id)
+        if not fl:
+            print(f"[Error] Failed to update job status")
+            return False
         return True
-    
 
-    async def parse_line(self, line):
+    ##############################
+    # Process output             #
+    ##############################
+
+    async def parse_line(self, line, job_id=None):
+        # find the job the line belongs to. Lines of other runs (calibration, checks, a job already done) are only logged.
+        job = self.find_job(job_id)
         # add line to queue
-        await self.last_commands.add(line)
+        await self.last_commands.add(line if job and len(self.jobs) < 2 else f"[{job_id}] {line}")
+        if not job:
+            return
         # check if the line contains the entropy value of the current iteration
         # Regex pattern
         pattern = r"\[\s*Iteration\s*(\d+)\s*\].*Entropy:\s*([\d\.]+)"
@@ -338,10 +878,19 @@ class Worker():
         # debug
         # If we have a match, extract the values
         if match:
-            self.current_iterations = int(match.group(1))  # Extracted iteration number
-            self.current_entropy = float(match.group(2))     # Extracted entropy value
-    
-
+            job.last_progress = time.monotonic()
+            job.current_iterations = job.iteration_offset + int(match.group(1))  # Extracted iteration number
+            job.current_entropy = float(match.group(2))     # Extracted entropy value
+            job.rate_estimator.add(job.current_iterations, job.current_entropy)
+            if self.config.record_trajectory:
+                job.trajectory.add(job.current_iterations, job.current_entropy)
+            # Check if the minimization should be terminated early
+            if job.job_type == "minimize" and not job.early_stop_reason:
+                reason = job.stopping_policy.check(job.rate_estimator)
+                if reason:
+                    job.early_stop_reason = reason
+                    await self.last_commands.add(f"[Early stop] {reason}")
+                    self.process_manager.stop_process(job.job_id)
 
     async def consume_output(self, queue):
         while True:
@@ -354,25 +903,230 @@ class Worker():
             if item is None:
                 break  # Stop on sentinel
 
-            await self.parse_line(item)
+            tag, line = item
+            await self.parse_line(line, tag)
             await asyncio.sleep(0)
 
+    async def consume_errors(self, queue):
+        # The binary's stderr only goes to the log
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            tag, line = item
+            self.log_line(f"[stderr{'' if tag is None else f' {tag}'}] {line}")
+
+    def log_line(self, line: str):
+        self.log.add(f"{datetime.datetime.now():%m-%d %H:%M:%S} {line}")
+
+    def leased_jobs(self):
+        """{job_id: lease duration} of every job we hold a lease on"""
+        # Jobs waiting for the next batch hold a lease as well
+        leases = {job.job_id: job.lease_duration for job in self.jobs + list(self.pending_jobs) if not job.lease_lost}
+        # Results waiting in the outbox are still leased until the server accepts them
+        for job_id in self.outbox.job_ids:
+            leases.setdefault(job_id, None)
+        return leases
+
     async def ping_server(self):
+        # Heartbeat: ping every lease when it is due, and sleep until the next one (or until the leases change)
+        while not self.stopped:
+            self.heartbeat.sync(self.leased_jobs())
+            if self.api_handler.circuit_breaker.is_open:
+                # The API is down, ping again once the breaker allows it
+                try:
+                    await asyncio.wait_for(self.stop_event.wait(), timeout=self.api_handler.circuit_breaker.remaining)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for job_id in self.heartbeat.due():
+                await self.send_heartbeat(job_id)
+            await self.heartbeat.wait()
+
+    async def send_heartbeat(self, job_id: int):
+        job = self.find_job(job_id)
+        # Piggyback the latest progress of running minimizations
+        progress = (job.current_iterations, job.current_entropy) if job and job.job_type == "minimize" else ()
+        try:
+            response = await self.api_handler.ping_job(job_id, *progress, check=True)
+        except RequestError:
+            # The server refused this ping: the lease is gone, stop working on the job right away
+            self.heartbeat.failed(job_id, lost=True)
+            if job:
+                await self.abandon_job(job)
+        except APIError:
+            # The ping did not get through, try again soon
+            self.heartbeat.failed(job_id)
+        else:
+            self.heartbeat.renewed(job_id, response.get("lease_duration") if isinstance(response, dict) else None)
+
+
+    ##############################
+    # Suspend / resume           #
+    ##############################
+
+    async def watch_suspend(self):
+        # Runs in the background: notice when the machine was asleep, and check that our leases survived it
+        self.suspend_detector.reset()
+        while not self.stopped:
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout=self.config.suspend_check_interval)
+            except asyncio.TimeoutError:
+                pass
+            gap = self.suspend_detector.check()
+            if gap is not None and not self.stopped:
+                await self.last_commands.add(f"Woke up after {format_duration(gap)} asleep, checking leases...")
+                await self.revalidate_leases()
+
+    async def revalidate_leases(self):
+        """Ask the server about every leased job: resume paused ones, keep running ones, abandon the rest"""
+        for job in self.jobs + list(self.pending_jobs):
+            try:
+                status = await self.api_handler.get_status(job.job_id, check=True)
+                job_status = status.get("job_status") if isinstance(status, dict) else None
+                if job_status == "paused":
+                    response = await self.api_handler.resume_job(job.job_id, check=True)
+                    self.heartbeat.renewed(job.job_id, response.get("lease_duration") if isinstance(response, dict) else None)
+                    lost = False
+                elif job_status == "running":
+                    # Renew the lease right away (send_heartbeat abandons the job if the server refuses, e.g. because
+                    # it was given to someone else meanwhile)
+                    await self.send_heartbeat(job.job_id)
+                    lost = False
+                else:
+                    # Requeued, completed or cancelled: the server gave up on us
+                    lost = True
+            except RequestError:
+                # Unknown job, or the server refused to resume it
+                lost = True
+            except APIError:
+                # The API could not be reached, the regular pings decide later
+                lost = False
+            if lost and not job.lease_lost:
+                await self.abandon_job(job)
 
+    async def abandon_job(self, job: Job):
+        # Stop working on a job that is no longer ours. run_batch drops it from the batch.
+        job.lease_lost = True
+        if job in self.pending_jobs:
+            self.pending_jobs.remove(job)
+        self.process_manager.stop_process(job.job_id)
+        self.heartbeat.notify()
+        await self.last_commands.add(f"[Warning] Lease on job {job.job_id} lost, abandoning it")
+
+    ##############################
+    # Stall watchdog             #
+    ##############################
+
+    async def watch_stalls(self):
+        # Runs in the background: stop the processes that hang (see StallWatchdog). run_job restarts or hands back the job.
+        last = time.monotonic()
         while not self.stopped:
-            # check that we have a job
-            if self.running and self.has_job:
-                # if that is the case, ping the server
-                await self.api_handler.ping_job(self.job_id)
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout=self.config.watchdog_interval)
+            except asyncio.TimeoutError:
+                pass
+            now = time.monotonic()
+            if self.governor.paused:
+                # Frozen processes make no progress, that is no stall
+                self.watchdog.shift(self.jobs, now - last)
+            last = now
+            stalled = []
+            for job in list(self.jobs):
+                if self.stopped or job.stall_reason or job.lease_lost or job.job_id not in self.process_manager.processes:
+                    continue
+                reason = self.watchdog.check(job, self.config.max_iterations, now)
+                if reason:
+                    job.stall_reason = reason
+                    await self.last_commands.add(f"[Warning] Job {job.job_id} stalled: {reason}, stopping it")
+                    stalled.append(job)
+            await asyncio.gather(*(self.process_manager.terminate_process(job.job_id, self.config.kill_grace) for job in stalled))
 
-            await asyncio.sleep(self.config.job_ping_interval)
-        
+    ##############################
+    # Diagnostics                #
+    ##############################
 
+    async def monitor_loop(self):
+        # Runs for as long as the interface (or the headless runner), also while the worker is stopped
+        if self.config.log_slow_callbacks:
+            diagnostics.log_slow_callbacks(asyncio.get_running_loop(), self.data_folder / self.config.slow_callback_log, self.config.slow_callback, self.loop_monitor)
+        await self.loop_monitor.run(self.report_lag, self.config.loop_lag_warning)
+
+    async def report_lag(self, lag: float):
+        await self.last_commands.add(f"[Warning] Event loop blocked for {lag:.1f} s")
+
+    def toggle_profiler(self):
+        """Start a sampling profile, or stop it and save it. Returns the path of the saved profile (None on start)."""
+        if not self.profiler.running:
+            self.profiler.start()
+            self.api_handler.status = "Profiling... (SIGUSR1 or 'p' again to stop)"
+            return None
+        self.profiler.stop()
+        folder = self.data_folder / self.config.profile_folder
+        makedirs(folder, exist_ok=True)
+        path = folder / f"profile-{datetime.datetime.now():%Y%m%d-%H%M%S}.folded"
+        self.profiler.write(path)
+        top = ", ".join(f"{function.split(' ')[0]} {share:.0%}" for function, share in self.profiler.top())
+        self.api_handler.status = f"Profile saved to {path} ({self.profiler.samples} samples, top: {top or 'n/a'})"
+        return path
+
+    ##############################
+    # Resource governor          #
+    ##############################
+
+    async def govern(self):
+        # Runs in the background: throttle the running processes while the host is busy, in use or on battery
+        while not self.stopped:
+            if self.running:
+                self.governor.update([process.pid for process in self.process_manager.all_processes()])
+                await self.apply_governor()
+            else:
+                self.process_manager.resume_process()
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout=self.governor.config.check_interval)
+            except asyncio.TimeoutError:
+                pass
+        # Never leave processes frozen
+        self.process_manager.resume_process()
+
+    async def apply_governor(self):
+        # Applied on every check, so processes started since the last one are covered as well
+        if self.governor.state == PAUSE:
+            self.process_manager.suspend_process()
+        else:
+            self.process_manager.resume_process()
+            self.process_manager.renice_process(self.governor.config.niceness if self.governor.state == NICE else 0)
+        # Tell the server about long pauses, so it does not wait for progress
+        if self.governor.paused and self.governor.duration >= self.governor.config.report_pause_after and not self.pause_reported:
+            for job in self.jobs:
+                await self.api_handler.pause_job(job.job_id)
+            self.pause_reported = True
+        elif not self.governor.paused and self.pause_reported:
+            for job in self.jobs:
+                await self.api_handler.resume_job(job.job_id)
+            self.pause_reported = False
+
+    def poll_delay(self):
+        """Seconds to wait before the next job request, after an empty or failed one"""
+        delay = self.poll_backoff.next_delay()
+        # The server knows best how busy it is
+        if self.api_handler.retry_after is not None:
+            delay = min(max(delay, self.api_handler.retry_after), self.config.poll_max_interval)
+        return delay
+
+    async def idle(self, delay: float):
+        """Sleep for delay seconds, or until the worker is woken up (e.g. stopped)"""
+        self.wake_event.clear()
+        try:
+            await asyncio.wait_for(self.wake_event.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
 
     def start(self):
         if not self.running:
             self.running = True
             self.stopped = False
+            self.stop_event.clear()
 
             loop = asyncio.get_event_loop()
             self.task = loop.create_task(self.worker_main())
@@ -383,85 +1137,159 @@ class Worker():
     def stop(self):
         self.running = False
         self.stopped = True
+        # Do not wait out a poll delay
+        self.wake_event.set()
+        self.outbox_event.set()
+        self.stop_event.set()
+        self.heartbeat.notify()
         #Actually stop the running processes from the process manager
         print("Stopping the running process...")
         self.process_manager.stop_process()
 
+    ##############################
+    # Shutdown                   #
+    ##############################
+
+    def install_signal_handlers(self, loop=None):
+        """Shut down gracefully on SIGTERM and SIGINT (systemctl stop, preemption, Ctrl+C)"""
+        loop = loop or asyncio.get_event_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.request_shutdown, sig)
+            except (NotImplementedError, RuntimeError):
+                # Not available on this platform (e.g. Windows), keep the default behaviour
+                pass
+        if hasattr(signal, "SIGUSR1"):
+            try:
+                loop.add_signal_handler(signal.SIGUSR1, self.toggle_profiler)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+    def request_shutdown(self, sig=None):
+        # Signal handler: start the shutdown once, the caller awaits shutdown_task
+        if self.shutdown_task is None:
+            name = signal.Signals(sig).name if sig else "shutdown request"
+            self.api_handler.status = f"Received {name}, handing back jobs..."
+            self.shutdown_task = asyncio.get_event_loop().create_task(self.shutdown())
+
+    async def shutdown(self):
+        """
+        Stop the worker: the binary saves its vector on SIGTERM, which is uploaded with the progress before the job is
+        cancelled, so the server can reassign it right away. Gives up after config.shutdown_deadline seconds and just
+        releases the leases.
+        """
+        if self.task and not self.task.done():
+            self.stop()
+            try:
+                await asyncio.wait_for(asyncio.shield(self.task), timeout=self.config.shutdown_deadline)
+            except asyncio.TimeoutError:
+                # Out of time: kill what is left and cancel the jobs without uploading
+                self.process_manager.kill_process()
+                self.task.cancel()
+                leased = self.jobs + list(self.pending_jobs)
+                try:
+                    await asyncio.wait_for(asyncio.gather(*(self.api_handler.cancel_job(job.job_id) for job in leased)), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+        # Flush the state to disk. Undelivered results stay in the outbox for the next start.
+        self.save_db()
+        self.outbox.save()
+        self.log.flush()
+
 # function to run the worker
     async def worker_main(self):
 
         parse_task = asyncio.create_task(self.consume_output(self.process_manager.stdout_queue)) # This task will run in the background, consuming the output of the process
+        errors_task = asyncio.create_task(self.consume_errors(self.process_manager.stderr_queue)) # This task will run in the background, logging the errors of the process
         ping_task = asyncio.create_task(self.ping_server()) # This task will run in the background, pinging the server every 30 seconds
+        outbox_task = asyncio.create_task(self.drain_outbox()) # This task will run in the background, reporting finished jobs
+        suspend_task = asyncio.create_task(self.watch_suspend()) # This task will run in the background, checking the leases after a suspend
+        governor_task = asyncio.create_task(self.govern()) if self.config.governor else None # This task will run in the background, throttling the processes
+        watchdog_task = asyncio.create_task(self.watch_stalls()) if self.config.watchdog else None # This task will run in the background, stopping hung processes
+
+        # Choose the build of the binary first, the pool and the calibration use it
+        if self.can_minimize:
+            await self.select_binary()
+
+        # Check the format of locally generated files before they are used
+        if (self.config.local_vector_generation or self.config.local_kraus_generation) and self.can_minimize and not self.local_generation_verified:
+            await self.verify_local_generation()
+
+        # Warm up the process pool, if enabled. Falls back to one-shot exec if the binary does not support it.
+        if self.config.process_pool_size > 0:
+            await self.process_manager.start_pool(ProcessPoolConfig(size=self.config.process_pool_size, max_jobs_per_process=self.config.process_pool_max_jobs))
+
+        # Measure the host before asking for jobs (cached after the first time)
+        if self.config.calibrate and self.host_profile is None:
+            await self.calibrate_host()
 
         # Run the async worker
-        await asyncio.create_task(worker.run())
+        await asyncio.create_task(self.run())
+
+        # Shut the warm processes down
+        await self.process_manager.close_pool()
 
         # Wait for the pinging task to finish (it will since worker has stopped)
         await ping_task
+        # Undelivered results stay in the outbox file and are delivered on the next start
+        await outbox_task
+        await suspend_task
+        if governor_task:
+            await governor_task
+        if watchdog_task:
+            await watchdog_task
 
         # Stop consuming output by sending a sentinel (None)
         await self.process_manager.stdout_queue.put(None)
+        await self.process_manager.stderr_queue.put(None)
 
         # Wait for background tasks to finish
         await parse_task
+        await errors_task
 
 
 
     async def run(self):
         while True:
             if self.running:
+                if self.api_handler.circuit_breaker.is_open:
+                    # The API is down: do not touch the network until the breaker lets a trial request through
+                    self.next_poll = datetime.datetime.now() + datetime.timedelta(seconds=self.api_handler.circuit_breaker.remaining)
+                    await self.idle(self.api_handler.circuit_breaker.remaining)
+                    continue
+                if not self.has_job and self.governor.paused:
+                    # No new work while the host needs its CPU
+                    await self.idle(self.governor.config.check_interval)
+                    continue
                 if not self.has_job:
-                    # Get a new job
+                    # Get a new job. Back off while there is none, ask again right away after a success.
                     if not await self.get_job():
-                        await asyncio.sleep(1)
+                        if self.long_poll_idle:
+                            # The server held the request and had nothing for us, subscribe again right away
+                            continue
+                        delay = self.poll_delay()
+                        self.next_poll = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+                        await self.idle(delay)
                         continue
+                    self.poll_backoff.reset()
+                    self.next_poll = None
                 else:
-                    # Run the job
-                    await self.run_job()
-                    await asyncio.sleep(1)
+                    # Run the jobs
+                    await self.run_batch()
+                    # Failed jobs stay in the batch and are retried, but not in a tight loop
+                    if self.has_job and not self.stopped:
+                        await asyncio.sleep(1)
             if self.stopped:
-                # The running process is already stopped in the self.stop method, otherwise we never exit run_job().
+                # The running processes are already stopped in the self.stop method, otherwise we never exit run_batch().
                 # Either run_job was running non minimizing tasks, in which case it finished running normally, or it was running a minimization task, in which case it was stopped by the stop method.
-                # If minimization was running, we should update the server with the current vector and info, then cancel the job so the server can reassign it.
-                if self.job_type == "minimize":
-                    # Assume that self.job_id is still set
-                    # get upload link
-                    upload_link = await self.api_handler.request_upload_link()
-                    if not upload_link:
-                        print(f"[Error] Failed to get upload link")
-                        return False
-                    # Upload the vector file
-                    # Search for the file in the db
-                    file = self.db["out_files"].get(self.job_id)
-                    if not file:
-                        print(f"[Error] File not found in db")
-                        return False
-                    fl = await self.api_handler.upload_file(self.job_id, "vector", Path(file["path"]), upload_link["upload_url"])
-                    if not fl:
-                        print(f"[Error] Failed to upload vector file")
-                        return False
-                    # Update the number of iterations.
-                    if self.current_iterations > 0:
-                        fl = await self.api_handler.update_iterations(self.job_id, self.current_iterations)
-                        if not fl:
-                            print(f"[Error] Failed to update iterations")
-                            return
-                    # Update the entropy value
-                    if self.current_entropy:
-                        fl = await self.api_handler.update_entropy(self.job_id, self.current_entropy)
-                        if not fl:
-                            print(f"[Error] Failed to update entropy")
-                    # Update the job status to pending, so it can be resumed later
-                    fl = await self.api_handler.cancel_job(self.job_id)
-                    if not fl:
-                        print(f"[Error] Failed to update job status")
-                        return False                
-
-
+                # Hand back whatever is still leased, so the server can reassign it.
+                await asyncio.gather(*(self.hand_back_job(job) for job in self.jobs + list(self.pending_jobs)))
+                self.jobs = []
+                self.pending_jobs.clear()
                 break
 
 
+# Configuration of the worker run by moe.py. The worker itself is built by the interface (or the headless runner)
+# once it is up, so importing this module does not touch the disk.
 worker_config = WorkerConfig()
-worker_config.api_url ="http://apiv1.quantum-hive.com"
-
-worker = Worker(worker_config)
\ No newline at end of file
+worker_config.api_url ="http://apiv1.quantum-hive.com"
\ No newline at end of file
@@ -0,0 +1,268 @@
+# A local stand-in for the QuantumHive API, for developing and testing the worker without the real server.
+# It keeps everything in memory (files on disk in a temporary folder) and implements the endpoints used by
+# src/api_handler.py, including long-poll job assignment (/jobs/subscribe) and job leases.
+#
+# Run from the repository root:
+#   python tools/stand_in_server.py --port 3000 --jobs 5 --interval 30
+# and point the worker at it (WorkerConfig.api_url = "http://localhost:3000"). Any username/password logs in.
+import argparse
+import asyncio
+import gzip
+import hashlib
+import itertools
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src import local_generation
+from src.cost_model import CostModel
+from src.job import Job
+
+
+class StandInServer():
+    def __init__(self, folder: Path, lease_duration: float = 90.0):
+        self.folder = folder
+        self.lease_duration = lease_duration
+        self.tokens = set()
+        self.refresh_tokens = set()
+        self.queue = [] # Jobs waiting to be leased
+        self.jobs = dict() # job_id -> job dict (with lease info)
+        self.files = dict() # file_id -> path
+        self.uploads = dict() # session_id -> list of chunks
+        self.ids = itertools.count(1)
+        self.job_available = asyncio.Condition()
+        self.log = []
+
+    ##############################
+    # Job creation               #
+    ##############################
+
+    def add_file(self, path: Path):
+        file_id = uuid.uuid4().hex
+        self.files[file_id] = path
+        return file_id
+
+    async def add_job(self, job_type: str = "generate_vector", input_dimension: int = 8, output_dimension: int = 8, number_kraus: int = 2):
+        job_id = next(self.ids)
+        job = {"job_id": job_id, "job_type": job_type, "job_status": "pending", "kraus_id": None, "vector_id": None,
+               "job_data": {"channel_id": 1, "input_dimension": input_dimension, "output_dimension": output_dimension, "number_kraus": number_kraus},
+               "lease_duration": self.lease_duration}
+        if job_type == "minimize":
+            # Inputs for a minimization, generated with the local fast path
+            kraus_path, vector_path = self.folder / f"kraus_{job_id}.dat", self.folder / f"vector_{job_id}.dat"
+            local_generation.generate_kraus_file(input_dimension, number_kraus, kraus_path)
+            local_generation.generate_vector_file(input_dimension, vector_path)
+            job["kraus_id"], job["vector_id"] = self.add_file(kraus_path), self.add_file(vector_path)
+        self.jobs[job_id] = job
+        self.queue.append(job_id)
+        async with self.job_available:
+            self.job_available.notify_all()
+        return job
+
+    def expire_leases(self):
+        now = time.monotonic()
+        for job in self.jobs.values():
+            if job["job_status"] == "running" and job["lease_expires"] < now:
+                job["job_status"] = "pending"
+                self.queue.append(job["job_id"])
+                self.log.append(("lease_expired", job["job_id"]))
+
+    def lease(self, params):
+        self.expire_leases()
+        for job_id in self.queue:
+            job = self.jobs[job_id]
+            if "kraus_id" in params and job["kraus_id"] != params["kraus_id"]:
+                continue
+            if "job_types" in params and job["job_type"] not in params["job_types"].split(","):
+                continue
+            # Size-aware assignment: skip jobs that would not fit in the memory the worker advertises
+            if "memory" in params and CostModel().memory(Job.from_dict(job)) > int(params["memory"]) * 2**20:
+                continue
+            self.queue.remove(job_id)
+            job["job_status"] = "running"
+            job["lease_expires"] = time.monotonic() + self.lease_duration
+            self.log.append(("leased", job_id))
+            return {k: v for k, v in job.items() if k != "lease_expires"}
+        return None
+
+    ##############################
+    # Handlers                   #
+    ##############################
+
+    def authorized(self, request):
+        return request.headers.get("Authorization", "").removeprefix("Bearer ") in self.tokens
+
+    def issue_tokens(self):
+        access, refresh = uuid.uuid4().hex, uuid.uuid4().hex
+        self.tokens.add(access)
+        self.refresh_tokens.add(refresh)
+        return {"access_token": access, "refresh_token": refresh}
+
+    async def login(self, request):
+        await request.post()
+        self.log.append(("login",))
+        return web.json_response(self.issue_tokens())
+
+    async def refresh(self, request):
+        if request.headers.get("refresh") not in self.refresh_tokens:
+            return web.Response(status=401, text="Invalid refresh token")
+        self.refresh_tokens.discard(request.headers.get("refresh"))
+        return web.json_response(self.issue_tokens())
+
+    async def ping(self, request):
+        if not self.authorized(request):
+            return web.Response(status=401, text="Invalid token")
+        return web.json_response({"message": "pong"})
+
+    async def request_job(self, request):
+        if not self.authorized(request):
+            return web.Response(status=401)
+        job = self.lease(request.query)
+        return web.json_response(job) if job else web.Response(status=204)
+
+    async def subscribe(self, request):
+        if not self.authorized(request):
+            return web.Response(status=401)
+        wait = float(request.query.get("wait", 60))
+        deadline = time.monotonic() + wait
+        async with self.job_available:
+            while True:
+                job = self.lease(request.query)
+                if job:
+                    return web.json_response(job)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return web.Response(status=204)
+                try:
+                    await asyncio.wait_for(self.job_available.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def job_action(self, request):
+        if not self.authorized(request):
+            return web.Response(status=401)
+        action = request.match_info["action"]
+        form = await request.post()
+        self.expire_leases()
+        job = self.jobs.get(int(form["job_id"]))
+        if not job:
+            return web.Response(status=404, text="Job not found")
+        self.log.append((action, job["job_id"]) + tuple(v for k, v in form.items() if k != "job_id"))
+        if action == "ping":
+            if job["job_status"] != "running":
+                return web.Response(status=409, text="Lease lost")
+            job["lease_expires"] = time.monotonic() + self.lease_duration
+            # Progress may come along with the ping
+            if "num_iterations" in form:
+                job["iterations"] = int(form["num_iterations"])
+            if "entropy" in form:
+                job["entropy"] = float(form["entropy"])
+            return web.json_response({"lease_duration": self.lease_duration})
+        if action == "complete":
+            job["job_status"] = "completed"
+        elif action == "cancel":
+            job["job_status"] = "pending"
+            self.queue.append(job["job_id"])
+        elif action == "pause":
+            job["job_status"] = "paused"
+        elif action == "resume":
+            job["job_status"] = "running"
+            job["lease_expires"] = time.monotonic() + self.lease_duration
+        elif action == "update-iterations":
+            job["iterations"] = int(form["num_iterations"])
+        elif action == "update-entropy":
+            job["entropy"] = float(form["entropy"])
+        return web.json_response({"job_id": job["job_id"], "job_status": job["job_status"]})
+
+    async def request_upload(self, request):
+        if not self.authorized(request):
+            return web.Response(status=401)
+        return web.json_response({"upload_url": "/files/upload", "encodings": ["gzip"]})
+
+    async def upload(self, request):
+        if not self.authorized(request):
+            return web.Response(status=401)
+        form = await request.post()
+        chunk = form["file"].file.read()
+        if form.get("content_encoding") == "gzip":
+            chunk = gzip.decompress(chunk)
+        chunks = self.uploads.setdefault(form["session_id"], dict())
+        chunks[int(form["chunk_index"])] = chunk
+        if len(chunks) == int(form["total_chunks"]):
+            path = self.folder / f"upload_{form['job_id']}_{form['file_type']}.dat"
+            path.write_bytes(b"".join(chunks[i] for i in sorted(chunks)))
+            self.add_file(path)
+            self.log.append(("uploaded", int(form["job_id"]), form["file_type"], path.stat().st_size))
+        return web.json_response({"message": "ok"})
+
+    async def request_download(self, request):
+        if not self.authorized(request):
+            return web.Response(status=401)
+        file_id = (await request.json())["file_id"]
+        if file_id not in self.files:
+            return web.Response(status=404)
+        digest = hashlib.sha256(self.files[file_id].read_bytes()).hexdigest()
+        return web.json_response({"download_url": f"/files/download/{file_id}", "sha256": digest})
+
+    async def download(self, request):
+        if not self.authorized(request):
+            return web.Response(status=401)
+        path = self.files.get(request.match_info["file_id"])
+        return web.FileResponse(path) if path else web.Response(status=404)
+
+    def app(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post("/auth/login", self.login)
+        app.router.add_post("/auth/refresh", self.refresh)
+        app.router.add_get("/auth/ping", self.ping)
+        app.router.add_get("/jobs/request", self.request_job)
+        app.router.add_get("/jobs/subscribe", self.subscribe)
+        app.router.add_post("/jobs/{action}", self.job_action)
+        app.router.add_post("/files/request-upload", self.request_upload)
+        app.router.add_post("/files/upload", self.upload)
+        app.router.add_post("/files/request-download/", self.request_download)
+        app.router.add_get("/files/download/{file_id}", self.download)
+        return app
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument("--jobs", type=int, default=3, help="jobs available at startup")
+    parser.add_argument("--interval", type=float, default=0, help="add a job every interval seconds (0 = never)")
+    parser.add_argument("--job-type", default="generate_vector", choices=["generate_vector", "generate_kraus", "minimize"])
+    parser.add_argument("--dimension", type=int, default=8)
+    parser.add_argument("--lease", type=float, default=90.0, help="lease duration in seconds")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        server = StandInServer(Path(folder), args.lease)
+        for _ in range(args.jobs):
+            await server.add_job(args.job_type, args.dimension, args.dimension)
+        runner = web.AppRunner(server.app())
+        await runner.setup()
+        await web.TCPSite(runner, "localhost", args.port).start()
+        print(f"Stand-in server listening on http://localhost:{args.port}")
+        try:
+            while True:
+                if args.interval > 0:
+                    await asyncio.sleep(args.interval)
+                    job = await server.add_job(args.job_type, args.dimension, args.dimension)
+                    print(f"Added job {job['job_id']}")
+                else:
+                    await asyncio.sleep(3600)
+        finally:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass